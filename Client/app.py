@@ -1,19 +1,24 @@
-from Client.tcp_client import TCPClient
+from Client.tcp_client import TCPClientPool
+from Client.notification_queue import NotificationQueue
 
 from flask import Flask, render_template, request, jsonify, redirect, url_for, session, flash
 
 import time
-import base64
 import os
 
 from datetime import datetime
-from Client.database import Database
+from Client.database import Database, USER_SEARCH_LIMIT
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)  
 app.secret_key = os.urandom(24)  
 
-tcp_client = TCPClient(server_host='localhost', server_port=5001)
+# each Flask request thread checks out its own server connection
+tcp_client = TCPClientPool(server_host='localhost', server_port=5001)
+
+# mirror calls to the server go through a background queue so a slow or
+# down server never holds up the HTTP response
+notifications = NotificationQueue(tcp_client)
 
 
 # comment_manager = CommentManager()
@@ -22,6 +27,15 @@ tcp_client = TCPClient(server_host='localhost', server_port=5001)
 upload_images = []
 db = Database()
 
+@app.teardown_request
+def release_database(exception=None):
+    # every request runs on a new thread, its connections go back to the pool for the next one
+    db.release()
+
+# /home renders the first page of images, the rest are fetched from /api/images as the user scrolls
+IMAGE_PAGE_SIZE = 24
+MAX_IMAGE_PAGE_SIZE = 200
+
 
 @app.route('/')
 def login():
@@ -46,7 +60,7 @@ def register():
         success, result = db.create_user(username, password, email)
         
         if success:
-            tcp_client.send_request("REGISTER", {
+            notifications.notify("REGISTER", {
                 "username": username,
                 "user_id": result
             })
@@ -72,7 +86,7 @@ def process_login():
         session['user_id'] = user_id
         session['username'] = username
         
-        tcp_client.send_request("LOGIN", {
+        notifications.notify("LOGIN", {
             "username": username,
             "user_id": user_id
         })
@@ -84,7 +98,7 @@ def process_login():
 @app.route('/logout')
 def logout():
     if 'username' in session:
-        tcp_client.send_request("LOGOUT", {
+        notifications.notify("LOGOUT", {
             "username": session['username'],
             "user_id": session['user_id']
         })
@@ -99,20 +113,40 @@ def index():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    images = db.get_all_images()
+    images = db.get_all_images(limit=IMAGE_PAGE_SIZE)
     user = db.get_user(session['user_id'])
     
     # Mark images as saved or not
-    for image in images:
-        image['is_saved'] = db.is_image_saved_by_user(session['user_id'], image['id'])
+    db.mark_saved(images, session['user_id'])
     
-    # Get unique categories for filtering
-    categories = []
-    for image in images:
-        if image['category'] and image['category'] not in categories:
-            categories.append(image['category'])
+    # Categories of the whole feed, not just this first page
+    categories = db.get_categories()
     
-    return render_template('index.html', images=images, user=user, categories=categories)
+    next_cursor = db.feed_cursor(images[-1]) if len(images) == IMAGE_PAGE_SIZE else None
+    
+    return render_template('index.html', images=images, user=user, categories=categories, next_cursor=next_cursor)
+
+@app.route('/api/images')
+def api_images():
+    """The next page of the home feed, cursor is the next_cursor of the page already shown"""
+    if 'user_id' not in session:
+        return jsonify({"success": False, "message": "You must be logged in to view images"})
+    
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit', IMAGE_PAGE_SIZE, type=int)
+    if limit < 1:
+        return jsonify({"success": False, "message": "limit must be a positive integer"})
+    limit = min(limit, MAX_IMAGE_PAGE_SIZE)
+    
+    try:
+        images = db.get_all_images(cursor, limit)
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)})
+    db.mark_saved(images, session['user_id'])
+    
+    next_cursor = db.feed_cursor(images[-1]) if len(images) == limit else None
+    
+    return jsonify({"success": True, "images": images, "next_cursor": next_cursor})
 
 @app.route('/saved')
 def saved():
@@ -140,7 +174,7 @@ def save_image():
     success = db.save_image_for_user(session['user_id'], image_id)
     
     if success:
-        tcp_client.send_request("SAVE_IMAGE", {
+        notifications.notify("SAVE_IMAGE", {
             "user_id": session['user_id'],
             "image_id": image_id
         })
@@ -160,7 +194,7 @@ def unsave_image():
     
     if success:
         # Notify TCP server
-        tcp_client.send_request("UNSAVE_IMAGE", {
+        notifications.notify("UNSAVE_IMAGE", {
             "user_id": session['user_id'],
             "image_id": image_id
         })
@@ -243,24 +277,20 @@ def upload_image():
     with open(image_path, 'wb') as f:
         f.write(image_content)
     
-    # Encode image to base64 
-    base64_image = base64.b64encode(image_content).decode('utf-8')
-    
-    # Save to database
+    # Save to database, the bytes go in its blob store
     image_url = f"./static/uploads/{image_filename}"
-    image_id = db.upload_image(image_url, caption, tags, session['user_id'], base64_image)
+    image_id = db.upload_image(image_url, caption, tags, session['user_id'], image_content)
     
-    # Notify TCP server
+    # Notify TCP server, the image bytes go as a raw binary frame instead of base64
     image_data = {
         "id": image_id,
         "url": image_url,
         "caption": caption,
         "category": tags,
-        "user_id": session['user_id'],
-        "image": base64_image
+        "user_id": session['user_id']
     }
     
-    tcp_client.send_request("UPLOAD_IMAGE", image_data)
+    notifications.notify("UPLOAD_IMAGE", image_data, payload_path=image_path)
     
     return redirect(url_for('index'))
 
@@ -286,7 +316,7 @@ def save_comment():
     
     if success:
         
-        tcp_client.send_request("ADD_COMMENT", {
+        notifications.notify("ADD_COMMENT", {
             "user_id": session['user_id'],
             "image_id": image_id,
             "text": comment_text
@@ -330,6 +360,7 @@ def search():
                     for user in tcp_results:
                         if user['id'] not in existing_ids:
                             results.append(user)
+                    results = results[:USER_SEARCH_LIMIT]
             except Exception as e:
                 print(f"Error searching users via TCP: {str(e)}")
         
@@ -348,12 +379,10 @@ def search():
                 if success:
                     # Merge results, avoiding duplicates
                     existing_ids = [image['id'] for image in results]
-                    for image in tcp_results:
-                        if image['id'] not in existing_ids:
-                            # Make sure to check if the image is saved by the current user
-                            if 'is_saved' not in image:
-                                image['is_saved'] = db.is_image_saved_by_user(session['user_id'], image['id'])
-                            results.append(image)
+                    new_images = [image for image in tcp_results if image['id'] not in existing_ids]
+                    # Make sure to check if the images are saved by the current user
+                    db.mark_saved([image for image in new_images if 'is_saved' not in image], session['user_id'])
+                    results.extend(new_images)
             except Exception as e:
                 print(f"Error searching posts via TCP: {str(e)}")
         
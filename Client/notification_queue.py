@@ -0,0 +1,172 @@
+import logging
+import threading
+import itertools
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger('TCPClient')
+
+# Notifications that cancel each other out if both are still waiting to be sent
+OPPOSITE_COMMANDS = {
+    "SAVE_IMAGE": "UNSAVE_IMAGE",
+    "UNSAVE_IMAGE": "SAVE_IMAGE"
+}
+
+class NotificationQueue:
+    """
+    Background queue for the notifications the Client app mirrors to the TCP
+    server after a local write. Routes call notify() and return right away,
+    a worker thread sends the queue in batches and retries with backoff
+    while the server is slow or down.
+
+    Delivery is at least once: a notification whose reply timed out is sent
+    again, so a command the server isn't idempotent about (ADD_COMMENT) can
+    be applied twice
+    """
+
+    def __init__(self, client, max_size=1000, batch_size=50, max_retries=5, base_delay=0.5, max_delay=30):
+        self.client = client  # anything with a send_request method
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.items = OrderedDict()  # coalescing key -> notification, oldest first
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+        self.in_flight = 0
+        self.failures = 0
+        self.dropped = 0
+        self.next_attempt = 0  # time.monotonic() before which the worker is backing off
+        self.flush_requested = False  # only flush() skips the backoff
+        self.worker = None
+
+    def key(self, command, data):
+        # save/unsave of the same image by the same user share a key so they can coalesce
+        if command in OPPOSITE_COMMANDS:
+            return ("saved", data.get("user_id"), data.get("image_id"))
+        return ("once", next(self.counter))
+
+    def add(self, key, notification, front=False):
+        """Queue a notification, coalescing it with a pending one. Call with the lock held"""
+        pending = self.items.get(key)
+
+        if pending is not None:
+            if OPPOSITE_COMMANDS.get(pending["command"]) == notification["command"]:
+                # e.g. a save followed by an unsave of the same image, neither needs sending
+                del self.items[key]
+                logger.info(f"Notifications cancelled out: {pending['command']} + {notification['command']}")
+                return
+            if front:
+                # a newer copy of this notification is already waiting
+                return
+
+        if key not in self.items and len(self.items) >= self.max_size:
+            oldest_key, oldest = self.items.popitem(last=False)
+            self.dropped += 1
+            logger.warning(f"Notification queue full, dropped {oldest['command']}")
+
+        self.items[key] = notification
+        if front:
+            self.items.move_to_end(key, last=False)
+
+    def notify(self, command, data, payload_path=None):
+        """Queue a notification for the server without waiting for it to be sent"""
+        notification = {"command": command, "data": data, "payload_path": payload_path, "attempts": 0}
+
+        with self.condition:
+            self.add(self.key(command, data), notification)
+            self.start_worker()
+            # while backing off the new notification waits with the rest
+            if not self.backing_off():
+                self.condition.notify_all()
+
+    def backing_off(self):
+        return time.monotonic() < self.next_attempt and not self.flush_requested
+
+    def start_worker(self):
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.run, daemon=True)
+            self.worker.start()
+
+    def take_batch(self):
+        batch = []
+        while self.items and len(batch) < self.batch_size:
+            batch.append(self.items.popitem(last=False))
+        self.in_flight = len(batch)
+        return batch
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.items or self.backing_off():
+                    self.condition.wait(max(0, self.next_attempt - time.monotonic()) if self.items else None)
+                self.flush_requested = False
+                batch = self.take_batch()
+
+            unsent = self.send_batch(batch)
+
+            with self.condition:
+                for key, notification in reversed(unsent):
+                    notification["attempts"] += 1
+                    if notification["attempts"] > self.max_retries:
+                        self.dropped += 1
+                        logger.error(f"Giving up on {notification['command']} after {self.max_retries} retries")
+                    else:
+                        self.add(key, notification, front=True)
+                self.in_flight = 0
+                self.condition.notify_all()
+
+                if unsent:
+                    self.failures += 1
+                    delay = min(self.max_delay, self.base_delay * 2 ** (self.failures - 1))
+                    logger.warning(f"Server unreachable, retrying {len(unsent)} notifications in {delay:.1f}s")
+                    self.next_attempt = time.monotonic() + delay
+                else:
+                    self.failures = 0
+                    self.next_attempt = 0
+
+    def send_batch(self, batch):
+        """Send a batch in order, returns the notifications that didn't reach the server"""
+        index = 0
+        while index < len(batch):
+            # runs of plain notifications share one BATCH round trip, uploads carry a payload so go alone
+            run = []
+            while index + len(run) < len(batch) and not batch[index + len(run)][1]["payload_path"]:
+                run.append(batch[index + len(run)])
+
+            if len(run) > 1:
+                success, results = self.client.send_batch([(n["command"], n["data"]) for key, n in run])
+                if success:
+                    index += len(run)
+                    continue
+                # an older server without BATCH, or it's unreachable, fall back to one at a time
+            else:
+                run = [batch[index]]
+
+            for key, notification in run:
+                if not self.send_one(notification):
+                    # the server is unreachable, the rest of the batch would fail too
+                    return batch[index:]
+                index += 1
+
+        return []
+
+    def send_one(self, notification):
+        if notification["payload_path"]:
+            success, response = self.client.send_request(notification["command"], notification["data"], payload_path=notification["payload_path"])
+        else:
+            success, response = self.client.send_request(notification["command"], notification["data"])
+        return success
+
+    def pending(self):
+        with self.condition:
+            return len(self.items) + self.in_flight
+
+    def flush(self, timeout=10):
+        """Retry right away and wait until the queue is empty, returns False on timeout"""
+        with self.condition:
+            self.flush_requested = True
+            self.condition.notify_all()
+            return self.condition.wait_for(lambda: not self.items and not self.in_flight, timeout)
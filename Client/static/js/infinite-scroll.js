@@ -0,0 +1,140 @@
+// infinite-scroll.js - loads the next page of the home feed from /api/images when the bottom is reached
+
+document.addEventListener('DOMContentLoaded', function() {
+    const sentinel = document.querySelector('#load-more');
+    const grid = document.querySelector('#masonry-grid');
+    if (!sentinel || !grid) {
+        return;
+    }
+
+    let nextCursor = sentinel.getAttribute('data-next-cursor');
+    let loading = false;
+
+    const observer = new IntersectionObserver(entries => {
+        if (entries[0].isIntersecting) {
+            loadNextPage();
+        }
+    }, { rootMargin: '400px' });
+    observer.observe(sentinel);
+
+    function loadNextPage() {
+        if (loading || !nextCursor) {
+            return;
+        }
+        loading = true;
+
+        fetch('/api/images?cursor=' + encodeURIComponent(nextCursor))
+        .then(response => response.json())
+        .then(data => {
+            if (!data.success) {
+                throw new Error(data.message);
+            }
+
+            const cards = data.images.map(createCard);
+            cards.forEach(card => {
+                hideIfFiltered(card);
+                grid.appendChild(card);
+            });
+
+            const masonry = Masonry.data(grid) || new Masonry(grid);
+            masonry.appended(cards);
+            imagesLoaded(grid).on('progress', function() {
+                masonry.layout();
+            });
+
+            nextCursor = data.next_cursor;
+            if (!nextCursor) {
+                observer.disconnect();
+                sentinel.remove();
+            }
+        })
+        .catch(error => {
+            console.error('Error:', error);
+            sentinel.textContent = 'Couldnt load more posts, please try again later.';
+            observer.disconnect();
+            nextCursor = null;
+        })
+        .finally(() => {
+            loading = false;
+            // with a filter on, a page can add nothing visible and leave the sentinel in view,
+            // the observer won't fire again for that so keep going until it's pushed down
+            if (nextCursor && sentinel.getBoundingClientRect().top < window.innerHeight + 400) {
+                loadNextPage();
+            }
+        });
+    }
+
+    // new cards follow the category filter picked in home-filter.js
+    function hideIfFiltered(card) {
+        const active = document.querySelector('[data-filter].active');
+        const filter = active ? active.getAttribute('data-filter') : 'all';
+        const category = card.querySelector('.card-text').textContent;
+        if (filter !== 'all' && category !== filter) {
+            card.style.display = 'none';
+        }
+    }
+
+    // same markup as image-grid.html
+    function createCard(image) {
+        const card = document.createElement('div');
+        card.className = 'card';
+
+        const img = document.createElement('img');
+        img.src = image.url;
+        img.className = 'card-img-top';
+        img.alt = image.caption || '';
+        img.setAttribute('data-id', image.id);
+        img.setAttribute('data-caption', image.caption || '');
+        img.setAttribute('data-category', image.category || '');
+        img.setAttribute('data-bs-toggle', 'modal');
+        img.setAttribute('data-bs-target', '#imageModal');
+
+        const body = document.createElement('div');
+        body.className = 'card-body';
+
+        const title = document.createElement('h5');
+        title.className = 'card-title';
+        title.textContent = image.caption || '';
+
+        const category = document.createElement('p');
+        category.className = 'card-text';
+        category.textContent = image.category || '';
+
+        const button = document.createElement('button');
+        button.setAttribute('data-id', image.id);
+        setSaved(button, image.is_saved);
+        button.addEventListener('click', toggleSaved);
+
+        body.append(title, category, button);
+        card.append(img, body);
+        return card;
+    }
+
+    function setSaved(button, saved) {
+        button.textContent = saved ? 'Remove from Vault' : 'Save to Vault';
+        button.className = saved ? 'btn btn-danger unsave-btn' : 'btn btn-success save-btn';
+    }
+
+    function toggleSaved() {
+        const saved = this.classList.contains('unsave-btn');
+
+        fetch(saved ? '/unsave_image' : '/save_image', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ image_id: this.getAttribute('data-id') })
+        })
+        .then(response => response.json())
+        .then(data => {
+            alert(data.message);
+            if (data.success) {
+                setSaved(this, !saved);
+            }
+        })
+        .catch(error => {
+            console.error('Error:', error);
+            alert('Couldnt update your vault, please try again later.');
+        });
+    }
+});
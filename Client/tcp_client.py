@@ -1,8 +1,15 @@
 import socket
 import json
+import base64
 import logging
 import hashlib
+import os
+import struct
+import zlib
+import threading
 import time
+from collections import namedtuple
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 
 
 # Logging structure for btoh clent and server
@@ -24,14 +31,441 @@ class FilterStaticRequests(logging.Filter):
 
 logger.addFilter(FilterStaticRequests())
 
-class TCPClient:
-    def __init__(self, server_host='localhost', server_port=5001):
+# Every packet on the wire is a fixed header followed by the JSON body.
+# The header is 1 byte of flags and the body length as a 4 byte big-endian int
+FRAME_HEADER = struct.Struct('!BI')
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# Set on frames carrying raw bytes (like an uploaded image) instead of JSON
+FRAME_FLAG_BINARY = 0x01
+
+# Negotiated in the HELLO/WELCOME handshake at connect time. Version 1 is a
+# server from before the handshake, which only understands legacy packets
+PROTOCOL_VERSION = 2
+CAPABILITIES = ("split_packets", "compression", "binary_payloads", "pipelining", "events")
+
+class FrameError(Exception):
+    """Raised when a frame can't be read off the socket"""
+
+# Set on frames holding a split packet: a 4 byte envelope length, the header and
+# footer as a small JSON envelope, then the body JSON bytes the checksum covers.
+# The body is serialized once and its checksum is taken over exactly those bytes
+FRAME_FLAG_SPLIT = 0x02
+ENVELOPE_LENGTH = struct.Struct('!I')
+
+CHECKSUM_ALGORITHMS = {
+    "crc32": lambda data: format(zlib.crc32(data), '08x'),
+    "adler32": lambda data: format(zlib.adler32(data), '08x'),
+    "md5": lambda data: hashlib.md5(data).hexdigest()
+}
+DEFAULT_CHECKSUM = "crc32"
+
+class ChecksumError(ValueError):
+    """Raised when a packet body doesn't match its checksum"""
+    
+    def __init__(self, message, header=None):
+        super().__init__(message)
+        self.header = header if isinstance(header, dict) else {}
+
+def serialize_packet(body):
+    return json.dumps(body).encode('utf-8')
+
+def wrap_packet(header, body_bytes, algorithm, checksum):
+    """Put the envelope in front of an already serialized split packet body"""
+    footer = {"checksum": checksum, "algorithm": algorithm}
+    envelope = json.dumps({"header": dict(header, size=len(body_bytes)), "footer": footer}).encode('utf-8')
+    return [ENVELOPE_LENGTH.pack(len(envelope)), envelope, body_bytes]
+
+def encode_packet(header, body, algorithm=DEFAULT_CHECKSUM):
+    """Serialize a split packet, returns the frame payload as a list of byte strings"""
+    body_bytes = serialize_packet(body)
+    return wrap_packet(header, body_bytes, algorithm, CHECKSUM_ALGORITHMS[algorithm](body_bytes))
+
+def decode_packet(frame):
+    """Parse and verify a split packet, raises ValueError if it's malformed"""
+    view = memoryview(frame)
+    if len(view) < ENVELOPE_LENGTH.size:
+        raise ValueError("Packet too short for an envelope")
+    
+    (envelope_size,) = ENVELOPE_LENGTH.unpack_from(view)
+    body_start = ENVELOPE_LENGTH.size + envelope_size
+    if body_start > len(view):
+        raise ValueError("Packet envelope runs past the end of the frame")
+    
+    envelope = json.loads(str(view[ENVELOPE_LENGTH.size:body_start], 'utf-8'))
+    if not isinstance(envelope, dict) or not isinstance(envelope.get('footer'), dict):
+        raise ValueError("Packet envelope is missing its footer")
+    
+    footer = envelope['footer']
+    body_view = view[body_start:]
+    checksum = CHECKSUM_ALGORITHMS.get(footer.get('algorithm'))
+    if checksum is None or checksum(body_view) != footer.get('checksum'):
+        raise ChecksumError("Packet checksum validation failed", envelope.get('header'))
+    
+    return {"header": envelope.get('header') or {}, "body": json.loads(str(body_view, 'utf-8')), "footer": footer}
+
+def frame_size(payload):
+    return len(payload) if isinstance(payload, (bytes, bytearray)) else sum(len(part) for part in payload)
+
+def join_frame(payload, flags=0):
+    """Frame header plus payload (bytes or a list of parts) in one buffer, copied once"""
+    parts = [payload] if isinstance(payload, (bytes, bytearray)) else payload
+    return b''.join([FRAME_HEADER.pack(flags, frame_size(parts)), *parts])
+
+# Set on frames whose payload is zlib compressed. Each side only compresses
+# once the other has said it accepts "zlib" in a packet header
+FRAME_FLAG_COMPRESSED = 0x04
+COMPRESSION = "zlib"
+COMPRESSION_THRESHOLD = 1024  # smaller payloads, like PING/PONG, go out as they are
+
+def compress_frame(payload, flags=0, threshold=COMPRESSION_THRESHOLD):
+    """Compress a frame payload of at least threshold bytes, returns the flags and payload"""
+    parts = [payload] if isinstance(payload, (bytes, bytearray)) else payload
+    size = frame_size(parts)
+    if size < threshold:
+        return flags, payload
+    
+    compressor = zlib.compressobj()
+    compressed = b''.join([compressor.compress(part) for part in parts] + [compressor.flush()])
+    if len(compressed) >= size:
+        # already compressed data (like an embedded JPEG) doesn't shrink
+        return flags, payload
+    return flags | FRAME_FLAG_COMPRESSED, compressed
+
+def decompress_frame(frame):
+    """Inflate a compressed frame payload, raises ValueError if it's corrupt or too big"""
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(frame, MAX_FRAME_SIZE)
+    except zlib.error as e:
+        raise ValueError(f"Corrupt compressed frame: {str(e)}") from e
+    if decompressor.unconsumed_tail:
+        raise ValueError(f"Compressed frame inflates past the {MAX_FRAME_SIZE} byte limit")
+    if not decompressor.eof:
+        raise ValueError("Compressed frame is truncated")
+    return data
+
+# Set on frames encoded with the compact codec: a struct-packed envelope, the
+# checksum, then [command, data, tables] as JSON. Lists of same-shaped rows in
+# data (images, users, results) go in tables as column names plus value arrays,
+# so the keys aren't repeated on every row
+FRAME_FLAG_COMPACT = 0x08
+COMPACT_HEADER = struct.Struct('!IIBB')  # sequence number, reply_to (0 for none), checksum algorithm, checksum length
+CHECKSUM_IDS = {"crc32": 1, "adler32": 2, "md5": 3}
+CHECKSUM_NAMES = {number: name for name, number in CHECKSUM_IDS.items()}
+
+def pack_tables(data):
+    """Split lists of same-shaped rows out of data, returns the rest of data and the tables"""
+    if not isinstance(data, dict):
+        return data, {}
+    
+    tables = {}
+    for key, value in data.items():
+        if isinstance(value, list) and len(value) > 1 and isinstance(value[0], dict):
+            columns = list(value[0])
+            if all(isinstance(row, dict) and list(row) == columns for row in value):
+                tables[key] = [columns, [list(row.values()) for row in value]]
+    
+    if tables:
+        data = {key: value for key, value in data.items() if key not in tables}
+    return data, tables
+
+def serialize_compact(body):
+    data, tables = pack_tables(body.get("data"))
+    return json.dumps([body["command"], data, tables]).encode('utf-8')
+
+def wrap_compact(header, body_bytes, algorithm, checksum):
+    """Put the envelope in front of an already serialized compact packet body"""
+    checksum = bytes.fromhex(checksum)
+    envelope = COMPACT_HEADER.pack(header.get("sequence_number") or 0, header.get("reply_to") or 0,
+                                   CHECKSUM_IDS[algorithm], len(checksum))
+    return [envelope, checksum, body_bytes]
+
+def encode_compact(header, body, algorithm=DEFAULT_CHECKSUM):
+    """Serialize a compact packet, returns the frame payload as a list of byte strings"""
+    body_bytes = serialize_compact(body)
+    return wrap_compact(header, body_bytes, algorithm, CHECKSUM_ALGORITHMS[algorithm](body_bytes))
+
+def decode_compact(frame):
+    """Parse and verify a compact packet into the same shape as a split packet, raises ValueError if it's malformed"""
+    view = memoryview(frame)
+    if len(view) < COMPACT_HEADER.size:
+        raise ValueError("Packet too short for a compact envelope")
+    
+    sequence_number, reply_to, algorithm_id, checksum_size = COMPACT_HEADER.unpack_from(view)
+    header = {"sequence_number": sequence_number, "reply_to": reply_to or None}
+    body_start = COMPACT_HEADER.size + checksum_size
+    algorithm = CHECKSUM_NAMES.get(algorithm_id)
+    if algorithm is None or body_start > len(view):
+        raise ChecksumError("Compact packet has an unknown checksum", header)
+    
+    body_view = view[body_start:]
+    checksum = view[COMPACT_HEADER.size:body_start].hex()
+    if CHECKSUM_ALGORITHMS[algorithm](body_view) != checksum:
+        raise ChecksumError("Packet checksum validation failed", header)
+    
+    body = json.loads(str(body_view, 'utf-8'))
+    if not isinstance(body, list) or len(body) != 3:
+        raise ValueError("Compact packet body isn't [command, data, tables]")
+    
+    command, data, tables = body
+    if tables:
+        try:
+            data = dict(data)
+            for key, (columns, rows) in tables.items():
+                data[key] = [dict(zip(columns, row)) for row in rows]
+        except (AttributeError, TypeError, ValueError) as e:
+            raise ValueError(f"Malformed compact packet tables: {str(e)}") from e
+    
+    return {"header": header, "body": {"command": command, "data": data}, "footer": {"checksum": checksum, "algorithm": algorithm}}
+
+# Body codecs a connection can agree on in the handshake, most preferred first.
+# Every codec marks its frames with its own flag, so frames decode on their own.
+# serialize and wrap are the two halves of encode, so a serialized body can be reused
+Codec = namedtuple('Codec', ['name', 'flag', 'encode', 'decode', 'serialize', 'wrap'])
+CODECS = {
+    "compact": Codec("compact", FRAME_FLAG_COMPACT, encode_compact, decode_compact, serialize_compact, wrap_compact),
+    "json": Codec("json", FRAME_FLAG_SPLIT, encode_packet, decode_packet, serialize_packet, wrap_packet)
+}
+
+def codec_for_flags(flags):
+    """The codec a frame was encoded with, None for a legacy single document packet"""
+    for codec in CODECS.values():
+        if flags & codec.flag:
+            return codec
+    return None
+
+class FrameReader:
+    """
+    Buffered frame reader for one socket. The receive buffer is reused between
+    calls and any bytes past the end of a frame are kept for the next one
+    """
+    
+    def __init__(self, sock, chunk_size=64 * 1024):
+        self.sock = sock
+        self.chunk_size = chunk_size
+        self.buffer = bytearray(chunk_size)
+        self.start = 0  # first unread byte
+        self.end = 0    # one past the last received byte
+    
+    def pending(self):
+        return self.end - self.start
+    
+    def _fill(self, size):
+        """Receive until at least size unread bytes are buffered, False on a clean close"""
+        while self.end - self.start < size:
+            if self.start + size > len(self.buffer):
+                # not enough room after the unread bytes, move them to the front (and grow if needed)
+                pending = self.end - self.start
+                if size > len(self.buffer):
+                    buffer = bytearray(max(size, len(self.buffer) * 2))
+                    buffer[:pending] = self.buffer[self.start:self.end]
+                    self.buffer = buffer
+                else:
+                    self.buffer[:pending] = self.buffer[self.start:self.end]
+                self.start, self.end = 0, pending
+            
+            with memoryview(self.buffer) as view:
+                count = self.sock.recv_into(view[self.end:])
+            
+            if count == 0:
+                if self.end == self.start:
+                    return False
+                raise FrameError(f"Connection closed with {self.end - self.start} bytes of a frame buffered")
+            self.end += count
+            
+        return True
+    
+    def read_frame(self):
+        """Return the flags and body of the next frame, or None if the server closed the connection"""
+        if not self._fill(FRAME_HEADER.size):
+            return None
+        
+        flags, size = FRAME_HEADER.unpack_from(self.buffer, self.start)
+        if size > MAX_FRAME_SIZE:
+            raise FrameError(f"Frame of {size} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+        
+        self._fill(FRAME_HEADER.size + size)
+        body_start = self.start + FRAME_HEADER.size
+        body = bytes(self.buffer[body_start:body_start + size])
+        self.start = body_start + size
+        
+        if self.start == self.end:
+            self.start = self.end = 0
+            # don't hang on to a huge buffer after one big reply
+            if len(self.buffer) > self.chunk_size * 16:
+                self.buffer = bytearray(self.chunk_size)
+        
+        return flags, body
+
+class RequestHelpers:
+    """
+    Higher level requests shared by TCPClient and TCPClientPool, anything
+    with a send_request method can use them
+    """
+    
+    # searching posts and users
+    def search(self, query, search_type="posts", user_id=None):
+        """
+        Search for posts or users
+        """
+        search_data = {
+            "query": query,
+            "type": search_type
+        }
+        
+        if user_id:
+            search_data["user_id"] = user_id
+        
+        logger.info(f"Performing search: '{query}' (Type: {search_type})")
+        success, response = self.send_request("SEARCH", search_data)
+        
+        if success and response and 'body' in response and 'data' in response['body']:
+            results = response['body']['data'].get('results', [])
+            logger.info(f"Search returned {len(results)} results")
+            return True, results
+        else:
+            logger.warning(f"Search failed for '{query}'")
+            return False, []
+    
+    def get_images(self, cursor=None, limit=None):
+        """
+        Get a page of images from the server. Pass the returned next_cursor
+        to get the page after it, it is None once the last page is reached
+        """
+        page_data = {}
+        if cursor is not None:
+            page_data["cursor"] = cursor
+        if limit is not None:
+            page_data["limit"] = limit
+        
+        success, response = self.send_request("GET_IMAGES", page_data)
+        
+        if success and response and 'body' in response and response['body'].get('command') == "IMAGES":
+            data = response['body']['data']
+            return True, data['images'], data.get('next_cursor')
+        else:
+            logger.warning(f"Failed to get images after cursor {cursor}")
+            return False, [], None
+    
+    def get_changes(self, since=None):
+        """
+        Get the catalog changes after the since mark, see GET_CHANGES. Returns
+        the changes, the mark to pass next time and whether more are waiting
+        """
+        change_data = {} if since is None else {"since": since}
+        
+        success, response = self.send_request("GET_CHANGES", change_data)
+        
+        if success and response and 'body' in response and response['body'].get('command') == "CHANGES":
+            data = response['body']['data']
+            logger.info(f"Got {len(data['changes'])} changes since {since}")
+            return True, data['changes'], data['since'], data['more']
+        else:
+            logger.warning(f"Failed to get changes since {since}")
+            return False, [], since, False
+    
+    # UPDATED saving images
+    def save_image(self, image_id, user_id):
+        """
+        Save an image to the user's vault
+        """
+        save_data = {
+            "image_id": image_id,
+            "user_id": user_id
+        }
+        
+        logger.info(f"Saving image: ID={image_id} for user ID={user_id}")
+        success, response = self.send_request("SAVE_IMAGE", save_data)
+        
+        if success and response and 'body' in response:
+            command = response['body'].get('command', '')
+            if command == "SAVE_IMAGE_SUCCESS":
+                logger.info(f"Image {image_id} saved successfully")
+                return True, "Image saved to vault"
+            else:
+                logger.warning(f"Save image failed: {response['body'].get('data', {}).get('message', 'Unknown error')}")
+                return False, response['body'].get('data', {}).get('message', "Failed to save image")
+        else:
+            logger.warning(f"Failed to save image {image_id}")
+            return False, "Communication error"
+    
+    # UPDATED LOGIC for unsaving images
+    def unsave_image(self, image_id, user_id):
+        """
+        Remove an image from the user's vault
+        """
+        unsave_data = {
+            "image_id": image_id,
+            "user_id": user_id
+        }
+        
+        logger.info(f"Removing saved image: ID={image_id} for user ID={user_id}")
+        success, response = self.send_request("UNSAVE_IMAGE", unsave_data)
+        
+        if success and response and 'body' in response:
+            command = response['body'].get('command', '')
+            if command == "UNSAVE_IMAGE_SUCCESS":
+                logger.info(f"Image {image_id} removed from saved")
+                return True, "Image removed from vault"
+            else:
+                logger.warning(f"Unsave image failed: {response['body'].get('data', {}).get('message', 'Unknown error')}")
+                return False, response['body'].get('data', {}).get('message', "Failed to remove image")
+        else:
+            logger.warning(f"Failed to unsave image {image_id}")
+            return False, "Communication error"
+    
+    def send_batch(self, commands):
+        """
+        Run several commands in one round trip. commands is a list of
+        (command, data) pairs, the results come back in the same order
+        """
+        batch_data = {
+            "commands": [{"command": command, "data": data} for command, data in commands]
+        }
+        
+        logger.info(f"Sending batch of {len(commands)} commands")
+        success, response = self.send_request("BATCH", batch_data)
+        
+        if success and response and 'body' in response:
+            if response['body'].get('command') == "BATCH_RESULTS":
+                return True, response['body']['data']['results']
+            logger.warning(f"Batch failed: {response['body'].get('data', {}).get('message', 'Unknown error')}")
+            return False, response['body'].get('data', {}).get('message', "Batch failed")
+        else:
+            logger.warning("Failed to send batch")
+            return False, "Communication error"
+
+
+class TCPClient(RequestHelpers):
+    def __init__(self, server_host='localhost', server_port=5001, checksum_algorithm=DEFAULT_CHECKSUM,
+                 compression_threshold=COMPRESSION_THRESHOLD, username=None, password=None, session_token=None,
+                 codecs=tuple(CODECS)):
         self.server_host = server_host
         self.server_port = server_port
+        # optionally bind the connection to a user, by password or a session token from LOGIN/REGISTER.
+        # The server then fills in user_id itself
+        self.username = username
+        self.password = password
+        self.session_token = session_token
+        self.user_id = None  # who the server bound, from WELCOME
+        self.protocol_version = None
+        self.capabilities = None  # what the server agreed to in WELCOME, None before the handshake
+        self.codecs = codecs  # offered in HELLO, the server picks one
+        self.codec = CODECS["json"]
+        self.checksum_algorithm = checksum_algorithm  # a key of CHECKSUM_ALGORITHMS, the server replies in kind
+        self.compression_threshold = compression_threshold  # None turns compression off
+        self.compress_requests = False  # set once the server says it accepts compressed frames
         self.socket = None
+        self.reader = None
         self.connected = False
         self.sequence_number = 0
         self.current_user = None
+        # pipelining: futures waiting on a response, keyed by request sequence number
+        self.pending = {}
+        self.send_lock = threading.Lock()
+        self.dispatcher = None
+        self.event_callback = None  # called with the data of each EVENT the server pushes
         
     def connect(self):
         try:
@@ -42,6 +476,10 @@ class TCPClient:
             logger.info(f"Connected to server at {self.server_host}:{self.server_port}")
             
             self.connected = True
+            if not self.hello():
+                logger.error("Handshake with server failed")
+                self.disconnect()
+                return False
             return True
             
         except Exception as e:
@@ -49,53 +487,106 @@ class TCPClient:
             self.connected = False
             return False
     
+    def hello(self):
+        """Negotiate the protocol version and capabilities, returns False if the server didn't answer"""
+        self.protocol_version = None
+        self.capabilities = None
+        self.codec = CODECS["json"]
+        
+        offered = [capability for capability in CAPABILITIES
+                   if capability != "compression" or self.compression_threshold is not None]
+        data = {"version": PROTOCOL_VERSION, "capabilities": offered, "codecs": list(self.codecs)}
+        if self.session_token:
+            data.update(session_token=self.session_token, username=self.username)
+        elif self.username and self.password:
+            data.update(username=self.username, password=self.password)
+        
+        success, response = self.send_request("HELLO", data)
+        if not success:
+            return False
+        
+        if response['body']['command'] == "WELCOME":
+            welcome = response['body'].get('data', {})
+            self.protocol_version = welcome.get('version', PROTOCOL_VERSION)
+            self.capabilities = set(welcome.get('capabilities') or [])
+            self.codec = CODECS.get(welcome.get('codec'), CODECS["json"])
+            self.user_id = welcome.get('user_id')
+            # reconnects bind with the token, while this server process lasts
+            self.session_token = welcome.get('session_token') or self.session_token
+            if (self.session_token or self.password) and self.user_id is None:
+                logger.warning(f"Server didn't bind user {self.username} to the connection")
+        else:
+            # a server from before the handshake, stick to what every server understands
+            self.protocol_version = 1
+            self.capabilities = set()
+        
+        self.compress_requests = "compression" in self.capabilities
+        logger.info(f"Negotiated protocol version {self.protocol_version} with capabilities "
+                    f"{sorted(self.capabilities)} and the {self.codec.name} codec")
+        return True
+    
+    def supports(self, capability):
+        # until the handshake has happened assume the server is as new as we are
+        return self.capabilities is None or capability in self.capabilities
+    
+    def attach_payload(self, data, payload_path):
+        """Describe a payload file in the request data, returns the data and the binary frame size"""
+        if not self.supports("binary_payloads"):
+            # older servers take the image base64 encoded in the request itself
+            with open(payload_path, 'rb') as f:
+                return dict(data, image=base64.b64encode(f.read()).decode('utf-8')), None
+        
+        payload_size = os.path.getsize(payload_path)
+        return dict(data, payload_size=payload_size, filename=os.path.basename(payload_path)), payload_size
+    
     def disconnect(self): # pragma: no cover
         """Disconnect from the server"""
-        if self.socket:
-            self.socket.close()
-            self.socket = None
+        sock, self.socket = self.socket, None
+        if sock:
+            try:
+                # wakes up the dispatcher thread if it's blocked reading
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        self.reader = None
         self.connected = False
         logger.info("Disconnected from server")
     
-    def send_request(self, command, data):
+    def send_request(self, command, data, payload_path=None):
+        """
+        Send a request and wait for the response. If payload_path is given the
+        file is sent raw in a binary frame right after the JSON request
+        """
+        if self.dispatcher is not None:
+            # requests are being pipelined on this connection, so wait on a future like they do
+            future = self.send_request_async(command, data, payload_path)
+            try:
+                return True, future.result(timeout=10)
+            except FutureTimeoutError:
+                logger.warning("No response received from server")
+                return False, "No response from server"
+            except Exception as e:
+                return False, str(e)
+        
         if not self.connected:
             if not self.connect():
                 return False, "Failed to connect to server"
+        
+        payload_size = None
+        if payload_path:
+            data, payload_size = self.attach_payload(data, payload_path)
                 
         # Create request packet
-        packet = self.create_packet(command, data)
+        sequence_number, flags, payload = self.encode_request(command, data)
         #ALL NAMING FUNCTIONS THAT SERVER SHOULD CALL
         try:
-            packet_json = json.dumps(packet)
-            self.socket.sendall(packet_json.encode('utf-8'))
-            
-            user_info = ""
-            if command == "LOGIN" and data.get('username'):
-                self.current_user = data.get('username')
-                user_info = f"[User: {self.current_user}] "
-            elif self.current_user and command != "LOGOUT":
-                user_info = f"[User: {self.current_user}] "
+            self.send_frame(payload, flags)
             
-            logger.info(f"{user_info}SENDING REQUEST: Command={command}")
+            if payload_size is not None:
+                self.send_payload(payload_path, payload_size)
             
-            if command in ["LOGIN", "REGISTER", "LOGOUT", "SAVE_IMAGE", "UNSAVE_IMAGE", "UPLOAD_IMAGE", "ADD_COMMENT", "SEARCH"]:
-                if command == "LOGIN":
-                    logger.info(f"Login attempt for user '{data.get('username')}'")
-                elif command == "REGISTER":
-                    logger.info(f"Registering new user '{data.get('username')}'")
-                elif command == "LOGOUT":
-                    logger.info(f"User '{self.current_user}' logging out")
-                    self.current_user = None
-                elif command == "SAVE_IMAGE":
-                    logger.info(f"User '{self.current_user}' saving image ID: {data.get('image_id')}")
-                elif command == "UNSAVE_IMAGE":
-                    logger.info(f"User '{self.current_user}' removing saved image ID: {data.get('image_id')}")
-                elif command == "UPLOAD_IMAGE":
-                    logger.info(f"User '{self.current_user}' uploading image: {data.get('caption')}")
-                elif command == "ADD_COMMENT":
-                    logger.info(f"User '{self.current_user}' adding comment to image ID: {data.get('image_id')}")
-                elif command == "SEARCH":
-                    logger.info(f"User '{self.current_user}' searching for '{data.get('query')}' (Type: {data.get('type', 'posts')})")
+            user_info = self.log_request(command, data)
             
             response = self.receive_response()
             
@@ -111,7 +602,194 @@ class TCPClient:
             self.disconnect()
             return False, str(e)
     
+    def log_request(self, command, data):
+        user_info = ""
+        if command == "LOGIN" and data.get('username'):
+            self.current_user = data.get('username')
+            user_info = f"[User: {self.current_user}] "
+        elif self.current_user and command != "LOGOUT":
+            user_info = f"[User: {self.current_user}] "
+        
+        logger.info(f"{user_info}SENDING REQUEST: Command={command}")
+        
+        if command in ["LOGIN", "REGISTER", "LOGOUT", "SAVE_IMAGE", "UNSAVE_IMAGE", "UPLOAD_IMAGE", "ADD_COMMENT", "SEARCH"]:
+            if command == "LOGIN":
+                logger.info(f"Login attempt for user '{data.get('username')}'")
+            elif command == "REGISTER":
+                logger.info(f"Registering new user '{data.get('username')}'")
+            elif command == "LOGOUT":
+                logger.info(f"User '{self.current_user}' logging out")
+                self.current_user = None
+            elif command == "SAVE_IMAGE":
+                logger.info(f"User '{self.current_user}' saving image ID: {data.get('image_id')}")
+            elif command == "UNSAVE_IMAGE":
+                logger.info(f"User '{self.current_user}' removing saved image ID: {data.get('image_id')}")
+            elif command == "UPLOAD_IMAGE":
+                logger.info(f"User '{self.current_user}' uploading image: {data.get('caption')}")
+            elif command == "ADD_COMMENT":
+                logger.info(f"User '{self.current_user}' adding comment to image ID: {data.get('image_id')}")
+            elif command == "SEARCH":
+                logger.info(f"User '{self.current_user}' searching for '{data.get('query')}' (Type: {data.get('type', 'posts')})")
+        
+        return user_info
+    
+    def send_request_async(self, command, data, payload_path=None):
+        """
+        Send a request without waiting for the reply, so several can be in flight
+        on one connection. Returns a Future for the response packet, responses
+        are matched to requests by the reply_to sequence number the server echoes
+        """
+        future = Future()
+        
+        if not self.connected:
+            if not self.connect():
+                future.set_exception(ConnectionError("Failed to connect to server"))
+                return future
+        
+        if not self.supports("pipelining"):
+            future.set_exception(ConnectionError("Server doesn't support pipelined requests"))
+            return future
+        
+        payload_size = None
+        if payload_path:
+            data, payload_size = self.attach_payload(data, payload_path)
+        
+        with self.send_lock:
+            sequence_number, flags, payload = self.encode_request(command, data)
+            self.pending[sequence_number] = future
+            self.start_dispatcher()
+            
+            try:
+                self.send_frame(payload, flags)
+                if payload_size is not None:
+                    self.send_payload(payload_path, payload_size)
+            except Exception as e:
+                logger.error(f"Error sending request: {str(e)}")
+                self.pending.pop(sequence_number, None)
+                future.set_exception(e)
+                self.disconnect()
+                return future
+        
+        self.log_request(command, data)
+        return future
+    
+    def subscribe(self, topics, callback):
+        """
+        Have the server push events for topics: "images" for new uploads,
+        "comments:<image_id>" and "saves:<user_id>" for the user this client is
+        bound to. callback gets each event's data on the dispatcher thread.
+        Returns whether it worked and the topics now subscribed
+        """
+        if not self.connected and not self.connect():
+            return False, "Failed to connect to server"
+        if not self.supports("events"):
+            return False, "Server doesn't push events"
+        
+        self.event_callback = callback
+        # events arrive without a reply_to, only the dispatcher can tell them apart from replies
+        future = self.send_request_async("SUBSCRIBE", {"topics": list(topics)})
+        try:
+            response = future.result(timeout=10)
+        except FutureTimeoutError:
+            logger.warning("No response received from server")
+            return False, "No response from server"
+        except Exception as e:
+            return False, str(e)
+        
+        if response['body']['command'] == "SUBSCRIBED":
+            logger.info(f"Subscribed to {response['body']['data']['topics']}")
+            return True, response['body']['data']['topics']
+        logger.warning(f"Subscribe failed: {response['body'].get('data', {}).get('message', 'Unknown error')}")
+        return False, response['body'].get('data', {}).get('message', "Subscribe failed")
+    
+    def start_dispatcher(self):
+        if self.dispatcher is None:
+            self.dispatcher = threading.Thread(target=self.dispatch_responses, args=(self.socket,), daemon=True)
+            self.dispatcher.start()
+    
+    def dispatch_responses(self, sock):
+        """Read responses for pipelined requests and resolve the futures waiting on them"""
+        reader = FrameReader(sock)
+        error = None
+        
+        try:
+            while self.socket is sock:
+                try:
+                    received = reader.read_frame()
+                except socket.timeout:
+                    # nothing buffered is lost, just keep waiting
+                    continue
+                
+                if received is None:
+                    error = ConnectionError("Server closed the connection")
+                    break
+                
+                try:
+                    response = self.decode_response(*received)
+                except ChecksumError as e:
+                    future = self.pending.pop(e.header.get('reply_to'), None)
+                    if future is not None:
+                        future.set_exception(e)
+                    continue
+                except ValueError:
+                    logger.warning("Invalid JSON in server response")
+                    continue
+                
+                if response.get('body', {}).get('command') == "EVENT":
+                    if self.event_callback is not None:
+                        try:
+                            self.event_callback(response['body']['data'])
+                        except Exception as e:
+                            logger.error(f"Error in event callback: {str(e)}")
+                    continue
+                
+                future = self.pending.pop(response.get('header', {}).get('reply_to'), None)
+                if future is None:
+                    logger.warning(f"Unexpected response from server: {response.get('body', {}).get('command')}")
+                else:
+                    logger.info(f"RECEIVED RESPONSE: {response['body']['command']}")
+                    future.set_result(response)
+                    
+        except Exception as e:
+            error = e
+        finally:
+            with self.send_lock:
+                pending, self.pending = self.pending, {}
+                self.dispatcher = None
+            
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(error or ConnectionError("Disconnected from server"))
+            
+            if error and self.socket is sock:
+                logger.error(f"Error receiving response: {str(error)}")
+                self.disconnect()
+    
+    def encode_request(self, command, data):
+        """Serialize a request with the negotiated codec, returns its sequence number, frame flags and payload"""
+        if not self.supports("split_packets"):
+            packet = self.create_packet(command, data)
+            return self.sequence_number, 0, json.dumps(packet).encode('utf-8')
+        
+        self.sequence_number += 1
+        header = {
+            "source": "CLIENT",
+            "destination": "SERVER",
+            "sequence_number": self.sequence_number
+        }
+        if self.compression_threshold is not None:
+            header["compression"] = COMPRESSION
+        
+        body = {"command": command, "data": data}
+        payload = self.codec.encode(header, body, self.checksum_algorithm)
+        
+        if self.compress_requests and self.compression_threshold is not None:
+            flags, payload = compress_frame(payload, self.codec.flag, self.compression_threshold)
+            return self.sequence_number, flags, payload
+        return self.sequence_number, self.codec.flag, payload
+    
     def create_packet(self, command, data):
+        """Build a request packet in the legacy single document format, checksummed with MD5"""
         self.sequence_number += 1
         
         body = {
@@ -143,115 +821,200 @@ class TCPClient:
     def validate_checksum(self, data, checksum):
         return self.calculate_checksum(data) == checksum
     
+    def send_frame(self, payload, flags=0):
+        self.socket.sendall(join_frame(payload, flags))
+    
+    def send_payload(self, path, size):
+        """Send a file as a binary frame without loading it into memory"""
+        self.socket.sendall(FRAME_HEADER.pack(FRAME_FLAG_BINARY, size))
+        with open(path, 'rb') as f:
+            self.socket.sendfile(f, count=size)
+    
+    def receive_frame(self):
+        if self.reader is None or self.reader.sock is not self.socket:
+            self.reader = FrameReader(self.socket)
+        return self.reader.read_frame()
+    
+    def decode_response(self, flags, frame):
+        """Parse a response frame, raises ChecksumError if it fails validation"""
+        if flags & FRAME_FLAG_COMPRESSED:
+            frame = decompress_frame(frame)
+        
+        codec = codec_for_flags(flags)
+        if codec is not None:
+            response = codec.decode(frame)
+            if self.capabilities is None:
+                # no handshake, the server says whether it takes compressed requests in each header
+                self.compress_requests = response['header'].get('compression') == COMPRESSION
+            return response
+        
+        # a server from before split packets sends the whole packet as one JSON document
+        response = json.loads(frame)
+        if not self.validate_response(response):
+            raise ChecksumError("Invalid response from server", response.get('header') if isinstance(response, dict) else None)
+        return response
+    
+    def validate_response(self, response):
+        # Validate header
+        if 'header' not in response:
+            logger.warning("Invalid response format - missing header")
+            return False
+            
+        # Validate checksum
+        if 'footer' in response and 'checksum' in response['footer']:
+            if not self.validate_checksum(json.dumps(response['body']), response['footer']['checksum']):
+                logger.warning("Response checksum validation failed")
+                return False
+        else:
+            logger.warning("Missing checksum in server response")
+            return False
+        
+        return True
+    
     def receive_response(self, timeout=10):
         self.socket.settimeout(timeout)
         
         try:
-            data = self.socket.recv(8192).decode('utf-8')
-            if not data:
+            received = self.receive_frame()
+            if received is None or not received[1]:
                 logger.warning("Received empty response from server")
                 return None
                 
-           
-            response = json.loads(data)
-            
-            # Validate header
-            if 'header' not in response:
-                logger.warning("Invalid response format - missing header")
-                return None
-                
-            # Validate checksum
-            if 'footer' in response and 'checksum' in response['footer']:
-                if not self.validate_checksum(json.dumps(response['body']), response['footer']['checksum']):
-                    logger.warning("Response checksum validation failed")
-                    return None
-            else:
-                logger.warning("Missing checksum in server response")
-                return None
-                
-            return response
+            return self.decode_response(*received)
                 
         except socket.timeout:
+            # a late reply would be read as the answer to the next request, so start over
             logger.warning("Timeout waiting for server response")
+            self.disconnect()
+            return None
+        except FrameError as e:
+            logger.error(f"Framing error in server response: {str(e)}")
+            self.disconnect()
+            return None
+        except ChecksumError as e:
+            logger.warning(f"Rejected server response: {str(e)}")
             return None
-        except json.JSONDecodeError:
+        except ValueError:
             logger.warning("Invalid JSON in server response")
             return None
         except Exception as e:
             logger.error(f"Error receiving response: {str(e)}")
             return None
+
+
+class TCPClientPool(RequestHelpers):
+    """
+    Pool of TCPClient connections shared by the Flask request threads. Every
+    request checks out its own connection so parallel page loads get parallel
+    round trips to the server instead of queueing on one socket
+    """
     
-    # searching posts and users
-    def search(self, query, search_type="posts", user_id=None):
-        """
-        Search for posts or users
-        """
-        search_data = {
-            "query": query,
-            "type": search_type
-        }
+    def __init__(self, server_host='localhost', server_port=5001, max_size=8,
+                 idle_timeout=300, health_check_after=30, checkout_timeout=10):
+        self.server_host = server_host
+        self.server_port = server_port
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+        self.checkout_timeout = checkout_timeout
+        self.idle = []  # (client, last_used) pairs, oldest first
+        self.size = 0   # open connections, idle or checked out
+        self.condition = threading.Condition()
+        self.connected = False  # did the last request reach the server
+    
+    def create_client(self):
+        return TCPClient(server_host=self.server_host, server_port=self.server_port)
+    
+    def evict_idle(self):
+        """Close connections idle for longer than idle_timeout, call with the lock held"""
+        now = time.monotonic()
+        while self.idle and now - self.idle[0][1] > self.idle_timeout:
+            client, last_used = self.idle.pop(0)
+            client.disconnect()
+            self.size -= 1
+    
+    def checkout(self, timeout=None):
+        """Get a connected client, or None if none is free before the timeout"""
+        if timeout is None:
+            timeout = self.checkout_timeout
+        deadline = time.monotonic() + timeout
         
-        if user_id:
-            search_data["user_id"] = user_id
+        with self.condition:
+            while True:
+                self.evict_idle()
+                if self.idle:
+                    client, last_used = self.idle.pop()
+                    break
+                if self.size < self.max_size:
+                    self.size += 1
+                    client, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning("Timed out waiting for a free server connection")
+                    return None
+                self.condition.wait(remaining)
         
-        logger.info(f"Performing search: '{query}' (Type: {search_type})")
-        success, response = self.send_request("SEARCH", search_data)
+        # connecting and health checks happen outside the lock
+        if client is None:
+            client = self.create_client()
+            if not client.connect():
+                self.discard(client)
+                self.connected = False
+                return None
+        elif time.monotonic() - last_used > self.health_check_after and not self.ping(client):
+            logger.info("Dropping pooled connection that failed its health check")
+            self.discard(client)
+            return self.checkout(max(0, deadline - time.monotonic()))
         
-        if success and response and 'body' in response and 'data' in response['body']:
-            results = response['body']['data'].get('results', [])
-            logger.info(f"Search returned {len(results)} results")
-            return True, results
-        else:
-            logger.warning(f"Search failed for '{query}'")
-            return False, []
+        return client
     
-    # UPDATED saving images
-    def save_image(self, image_id, user_id):
-        """
-        Save an image to the user's vault
-        """
-        save_data = {
-            "image_id": image_id,
-            "user_id": user_id
-        }
-        
-        logger.info(f"Saving image: ID={image_id} for user ID={user_id}")
-        success, response = self.send_request("SAVE_IMAGE", save_data)
-        
-        if success and response and 'body' in response:
-            command = response['body'].get('command', '')
-            if command == "SAVE_IMAGE_SUCCESS":
-                logger.info(f"Image {image_id} saved successfully")
-                return True, "Image saved to vault"
+    def checkin(self, client):
+        with self.condition:
+            if client.connected:
+                self.idle.append((client, time.monotonic()))
             else:
-                logger.warning(f"Save image failed: {response['body'].get('data', {}).get('message', 'Unknown error')}")
-                return False, response['body'].get('data', {}).get('message', "Failed to save image")
-        else:
-            logger.warning(f"Failed to save image {image_id}")
-            return False, "Communication error"
+                self.size -= 1
+            self.condition.notify()
     
-    # UPDATED LOGIC for unsaving images
-    def unsave_image(self, image_id, user_id):
-        """
-        Remove an image from the user's vault
-        """
-        unsave_data = {
-            "image_id": image_id,
-            "user_id": user_id
-        }
+    def discard(self, client):
+        client.disconnect()
+        with self.condition:
+            self.size -= 1
+            self.condition.notify()
+    
+    def ping(self, client):
+        success, response = client.send_request("PING", {"timestamp": time.time()})
+        return success and response['body']['command'] == "PONG"
+    
+    def connect(self):
+        """Make sure the server is reachable, keeps the connection for the next request"""
+        client = self.checkout()
+        if client is None:
+            return False
+        self.checkin(client)
+        self.connected = True
+        return True
+    
+    def disconnect(self):
+        """Close all idle connections, checked out ones close when they come back"""
+        with self.condition:
+            while self.idle:
+                client, last_used = self.idle.pop()
+                client.disconnect()
+                self.size -= 1
+        self.connected = False
+    
+    def send_request(self, command, data, payload_path=None):
+        client = self.checkout()
+        if client is None:
+            self.connected = False
+            return False, "Failed to connect to server"
         
-        logger.info(f"Removing saved image: ID={image_id} for user ID={user_id}")
-        success, response = self.send_request("UNSAVE_IMAGE", unsave_data)
+        try:
+            success, response = client.send_request(command, data, payload_path)
+        finally:
+            self.checkin(client)
         
-        if success and response and 'body' in response:
-            command = response['body'].get('command', '')
-            if command == "UNSAVE_IMAGE_SUCCESS":
-                logger.info(f"Image {image_id} removed from saved")
-                return True, "Image removed from vault"
-            else:
-                logger.warning(f"Unsave image failed: {response['body'].get('data', {}).get('message', 'Unknown error')}")
-                return False, response['body'].get('data', {}).get('message', "Failed to remove image")
-        else:
-            logger.warning(f"Failed to unsave image {image_id}")
-            return False, "Communication error"
-    
+        self.connected = client.connected
+        return success, response
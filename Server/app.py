@@ -6,7 +6,7 @@ import logging
 # Now we can import directly since database.py is in the server directory
 import os
 import logging
-from tcp_server import TCPServer
+from tcp_server import TCPServer, AsyncTCPServer
 from database import Database
 
 # Create a separate logger for the Flask app
@@ -31,6 +31,9 @@ socket_server = None
 tcp_log_file = 'server_log.txt'
 tcp_log_file = 'server_log.txt'
 
+# TCP server engine, 'threaded' (a thread per connection) or 'async' (asyncio)
+TCP_SERVER_ENGINE = os.environ.get('TCP_SERVER_ENGINE', 'threaded')
+
 @app.route('/')
 def index():
     return render_template('servergui.html')
@@ -51,7 +54,7 @@ def start_server_route():
         with open(tcp_log_file, 'w') as f:
             f.write("TCP Server starting...\n")
             
-        start_socket_server()
+        start_socket_server(request.args.get('engine'))
         flask_logger.info("TCP Server started via web interface")
         return jsonify({"status": "success", "message": "Server started successfully"})
     except Exception as e:
@@ -115,12 +118,24 @@ def get_logs():
     
     return jsonify({"logs": logs})
 
-def start_socket_server():
+@app.route('/cache_stats')
+def cache_stats():
+    if socket_server is None or socket_server.response_cache is None:
+        return jsonify({"status": "warning", "message": "Response cache is not running"})
+    return jsonify({"status": "success", "stats": socket_server.response_cache.stats()})
+
+def start_socket_server(engine=None):
     """Start the TCP server in a separate thread"""
     global socket_server
     
+    engine = engine or TCP_SERVER_ENGINE
+    
     # Initialize the server with the database
-    socket_server = TCPServer(port=5001, db=db)
+    if engine == 'async':
+        socket_server = AsyncTCPServer(port=5001, db=db)
+    else:
+        socket_server = TCPServer(port=5001, db=db)
+    flask_logger.info(f"Using the {engine} TCP server engine")
     
     # Start the server in a new thread
     server_thread = threading.Thread(target=socket_server.start)
@@ -144,4 +159,8 @@ if __name__ == '__main__':
     print("#" * 70)
     print("\n")
     
-    app.run(debug=False, host='0.0.0.0', port=5000)
\ No newline at end of file
+    try:
+        app.run(debug=False, host='0.0.0.0', port=5000)
+    finally:
+        if socket_server is not None:
+            socket_server.stop()
\ No newline at end of file
@@ -1,10 +1,15 @@
 import sqlite3
 import os
+import re
 import hashlib
 import json
 from datetime import datetime
 import base64
+import binascii
 import logging
+import threading
+from pathlib import Path
+from contextlib import contextmanager
 
 # Set up logging
 logging.basicConfig(
@@ -15,27 +20,454 @@ logging.basicConfig(
 )
 db_logger = logging.getLogger('Database')
 
+# prepared statements sqlite3 keeps per connection, the queries below are fixed
+# strings so with long-lived connections each is only compiled once per thread
+STATEMENT_CACHE_SIZE = 256
+
+# PRAGMAs run on every new connection. With WAL readers work from a snapshot
+# instead of waiting on the writer, and synchronous=NORMAL only syncs at
+# checkpoints, a power cut can lose the last commits but not corrupt the file
+STORAGE_PROFILES = {
+    "default": {
+        "journal_mode": "DELETE",
+        "synchronous": "FULL"
+    },
+    "wal": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 64 * 1024 * 1024,
+        "cache_size": -16000,  # negative is KiB, so 16 MB per connection
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000
+    }
+}
+DEFAULT_STORAGE_PROFILE = "wal"
+# settings only a connection that can write may change, the others apply to readers too
+WRITER_PRAGMAS = {"journal_mode", "synchronous"}
+
+# How many posts search_images returns, best matches first
+SEARCH_LIMIT = 50
+# Only the newest matching posts are ranked, so a word that's in half the
+# posts costs no more than a rare one
+SEARCH_CANDIDATES = 1000
+# Matches "cafe" to "café". remove_diacritics 2 needs SQLite 3.27
+SEARCH_TOKENIZER = 'unicode61 remove_diacritics 2'
+
+# How many users search_users returns, closest names first
+USER_SEARCH_LIMIT = 20
+# Names fetched from the trigram index before they're scored
+USER_SEARCH_CANDIDATES = 200
+# Share of trigrams a misspelt name has to have in common with the query
+USER_SEARCH_SIMILARITY = 0.3
+
+def fts5_available(connection, tokenize):
+    """Whether this SQLite was built with FTS5 and takes this exact tokenize option"""
+    try:
+        connection.execute(f"CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(text, tokenize='{tokenize}')")
+        connection.execute('DROP TABLE temp.fts5_probe')
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+def create_search_index(connection):
+    """
+    Full-text index over image captions and categories for search_images,
+    kept in step with images by triggers. Skipped where SQLite has no FTS5,
+    search_images then falls back to LIKE
+    """
+    if not fts5_available(connection, SEARCH_TOKENIZER):
+        return
+    
+    statements = [
+        # external content, the text itself stays in images
+        f'''CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5(
+            caption, category, content='images', content_rowid='id', tokenize='{SEARCH_TOKENIZER}'
+        )''',
+        '''CREATE TRIGGER IF NOT EXISTS images_fts_insert AFTER INSERT ON images
+        BEGIN
+            INSERT INTO images_fts (rowid, caption, category) VALUES (NEW.id, NEW.caption, NEW.category);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS images_fts_delete AFTER DELETE ON images
+        BEGIN
+            INSERT INTO images_fts (images_fts, rowid, caption, category) VALUES ('delete', OLD.id, OLD.caption, OLD.category);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS images_fts_update AFTER UPDATE OF caption, category ON images
+        BEGIN
+            INSERT INTO images_fts (images_fts, rowid, caption, category) VALUES ('delete', OLD.id, OLD.caption, OLD.category);
+            INSERT INTO images_fts (rowid, caption, category) VALUES (NEW.id, NEW.caption, NEW.category);
+        END''',
+        # index the posts that are already there
+        "INSERT INTO images_fts (images_fts) VALUES ('rebuild')"
+    ]
+    
+    for statement in statements:
+        connection.execute(statement)
+
+def create_user_search_index(connection):
+    """
+    Trigram index over usernames for search_users, kept in step with users
+    by triggers. Names are indexed padded like trigrams() pads them, so it's
+    contentless rather than reading users. Skipped where SQLite has no
+    trigram tokenizer (before 3.34), search_users then falls back to LIKE
+    """
+    if not fts5_available(connection, 'trigram'):
+        return
+    
+    statements = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS users_trigram USING fts5(username, content='', tokenize='trigram')",
+        '''CREATE TRIGGER IF NOT EXISTS users_trigram_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO users_trigram (rowid, username) VALUES (NEW.id, '  ' || NEW.username || ' ');
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_trigram_delete AFTER DELETE ON users
+        BEGIN
+            INSERT INTO users_trigram (users_trigram, rowid, username) VALUES ('delete', OLD.id, '  ' || OLD.username || ' ');
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_trigram_update AFTER UPDATE OF username ON users
+        BEGIN
+            INSERT INTO users_trigram (users_trigram, rowid, username) VALUES ('delete', OLD.id, '  ' || OLD.username || ' ');
+            INSERT INTO users_trigram (rowid, username) VALUES (NEW.id, '  ' || NEW.username || ' ');
+        END''',
+        "INSERT INTO users_trigram (rowid, username) SELECT id, '  ' || username || ' ' FROM users"
+    ]
+    
+    for statement in statements:
+        connection.execute(statement)
+
+def trigrams(text):
+    """
+    Every run of three characters in text, ignoring case. Padded at the
+    start and end like pg_trgm, so the ends of a name count for more and a
+    typo in a short name still leaves some trigrams in common
+    """
+    text = '  ' + text.lower() + ' '
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def name_similarity(query, username):
+    """
+    How close a username is to what was searched for, higher is closer:
+    exact matches, then names containing the query, then by the share of
+    trigrams the two have in common
+    """
+    query, username = query.lower(), username.lower()
+    query_grams, name_grams = trigrams(query), trigrams(username)
+    shared = len(query_grams & name_grams) / (len(query_grams | name_grams) or 1)
+    return (username == query, query in username, shared)
+
+def image_bytes(image_data):
+    """
+    The bytes of an image given as bytes or, as older clients send it and
+    image_data used to hold it, base64 text. Text that isn't base64 is kept
+    as it is
+    """
+    if isinstance(image_data, bytes):
+        return image_data
+    try:
+        return base64.b64decode(image_data, validate=True)
+    except (binascii.Error, ValueError):
+        return str(image_data).encode('utf-8')
+
+def store_blob(connection, data):
+    """
+    Put image bytes in the blob store and return their blobs id. The store is
+    content addressed, the same bytes uploaded twice are only kept once
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    connection.execute('INSERT OR IGNORE INTO blobs (hash, size, data) VALUES (?, ?, ?)', (digest, len(data), data))
+    return connection.execute('SELECT id FROM blobs WHERE hash = ?', (digest,)).fetchone()[0]
+
+def read_blob(connection, blob_id):
+    """The bytes stored under blob_id, read through incremental blob I/O where sqlite3 has it (Python 3.11+)"""
+    if not hasattr(connection, 'blobopen'):
+        row = connection.execute('SELECT data FROM blobs WHERE id = ?', (blob_id,)).fetchone()
+        return row[0] if row else None
+    try:
+        with connection.blobopen('blobs', 'data', blob_id, readonly=True) as blob:
+            return blob.read()
+    except sqlite3.OperationalError:  # no such row
+        return None
+
+def move_image_data_to_blobs(connection):
+    """
+    Move the base64 image_data of existing images into the blobs table as
+    raw bytes and drop the column, so reading images rows never pulls in
+    image payloads. SQLite before 3.35 can't drop a column, there it's left
+    in place, empty
+    """
+    connection.execute('''CREATE TABLE IF NOT EXISTS blobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        hash TEXT UNIQUE NOT NULL,
+        size INTEGER NOT NULL,
+        data BLOB NOT NULL
+    )''')
+    connection.execute('ALTER TABLE images ADD COLUMN blob_id INTEGER REFERENCES blobs (id)')
+    
+    # one image in memory at a time, however many there are
+    image_ids = [row[0] for row in connection.execute('SELECT id FROM images WHERE image_data IS NOT NULL')]
+    for image_id in image_ids:
+        image_data = connection.execute('SELECT image_data FROM images WHERE id = ?', (image_id,)).fetchone()[0]
+        blob_id = store_blob(connection, image_bytes(image_data))
+        connection.execute('UPDATE images SET blob_id = ? WHERE id = ?', (blob_id, image_id))
+    
+    if sqlite3.sqlite_version_info >= (3, 35):
+        connection.execute('ALTER TABLE images DROP COLUMN image_data')
+    else:
+        connection.execute('UPDATE images SET image_data = NULL')
+
+def fts_query(query):
+    """Turn what the user typed into an FTS5 query: every word has to match the start of a word"""
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', query))
+
+def split_cursor(cursor):
+    """
+    A page cursor is the sort key and id of the last image already sent, so
+    the next page is still found after that image is deleted or unsaved
+    """
+    key, separator, image_id = str(cursor).rpartition('|')
+    if not separator:
+        raise ValueError("cursor must be the next_cursor of an earlier page")
+    return key, int(image_id)
+
+# Schema migrations, applied in order by migrate(). MIGRATIONS[n] takes a
+# database from PRAGMA user_version n to n + 1, so new ones only ever go on the
+# end. A step is a SQL statement or a function called with the connection.
+# migrate() is kept the same in Client/database.py and Server/database.py
+MIGRATIONS = [
+    # 1: the original tables
+    [
+        '''CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            email TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        '''CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            url TEXT NOT NULL,
+            caption TEXT,
+            category TEXT,
+            user_id INTEGER,
+            is_default INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            image_data TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS comments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            image_id INTEGER NOT NULL,
+            user_id INTEGER,
+            text TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (image_id) REFERENCES images (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS saved_images (
+            user_id INTEGER NOT NULL,
+            image_id INTEGER NOT NULL,
+            saved_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, image_id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (image_id) REFERENCES images (id)
+        )'''
+    ],
+    # 2: keyset pagination walks these in order, so a page costs the same however deep it is
+    [
+        'CREATE INDEX IF NOT EXISTS idx_images_feed ON images (is_default, id)',
+        'CREATE INDEX IF NOT EXISTS idx_saved_images_feed ON saved_images (user_id, saved_at, image_id)'
+    ],
+    # 3: images, saves and comments log themselves to change_log, whichever code path writes them
+    [
+        # AUTOINCREMENT so a change id is never handed out twice, clients sync from the last one they saw
+        '''CREATE TABLE IF NOT EXISTS change_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            entity TEXT NOT NULL,
+            action TEXT NOT NULL,
+            entity_id INTEGER NOT NULL,
+            image_id INTEGER,
+            user_id INTEGER,
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+    ] + [
+        f'''CREATE TRIGGER IF NOT EXISTS log_{entity}_{action} AFTER {event} ON {table}
+        BEGIN
+            INSERT INTO change_log (entity, action, entity_id, image_id, user_id)
+            VALUES ('{entity}', '{action}', {row}.{entity_id}, {row}.{image_id}, {row}.user_id);
+        END'''
+        for table, entity, entity_id, image_id in [
+            ('images', 'image', 'id', 'id'),
+            ('comments', 'comment', 'id', 'image_id'),
+            ('saved_images', 'save', 'image_id', 'image_id')
+        ]
+        for event, action, row in [('INSERT', 'created', 'NEW'), ('DELETE', 'deleted', 'OLD')]
+    ],
+    # 4: indexes for the other per-image and per-user lookups, which were full table scans
+    [
+        'CREATE INDEX IF NOT EXISTS idx_comments_image ON comments (image_id, timestamp)',  # get_comments
+        'CREATE INDEX IF NOT EXISTS idx_comments_user ON comments (user_id)',  # get_comment_count
+        'CREATE INDEX IF NOT EXISTS idx_images_user ON images (user_id, is_default)'  # get_uploaded_count
+    ],
+    # 5: full-text search over posts
+    [create_search_index],
+    # 6: trigram search over usernames
+    [create_user_search_index],
+    # 7: image bytes live in their own table
+    [move_image_data_to_blobs],
+    # 8: the feed's category filter reads these from the index alone
+    [
+        'CREATE INDEX IF NOT EXISTS idx_images_category ON images (category)'
+    ]
+]
+
+def migrate(connection, migrations=MIGRATIONS):
+    """
+    Bring a database's schema up to date, returns the user_version it was at.
+    Each migration commits together with its version bump, so a failure
+    leaves the database at the last migration that fully applied
+    """
+    started_at = connection.execute('PRAGMA user_version').fetchone()[0]
+    
+    while True:
+        # IMMEDIATE takes the write lock first, so two processes starting at once don't both migrate
+        connection.execute('BEGIN IMMEDIATE')
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+        if version >= len(migrations):
+            connection.rollback()
+            return started_at
+        
+        try:
+            for step in migrations[version]:
+                if callable(step):
+                    step(connection)
+                else:
+                    connection.execute(step)
+            connection.execute(f'PRAGMA user_version = {version + 1}')
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+
+
 class Database:
-    def __init__(self, db_name='preppersdb.sqlite'):
+    """
+    Every thread gets its own long-lived sqlite3 connections, opened on first
+    use, so TCP handler and Flask threads never share a connection or cursor.
+    Calls that only read go through a second, read-only connection. profile
+    is a key of STORAGE_PROFILES or a dict of PRAGMAs
+    """
+    
+    def __init__(self, db_name='preppersdb.sqlite', profile=DEFAULT_STORAGE_PROFILE):
         self.db_name = db_name
-        self.connection = None
-        self.cursor = None
+        self.profile = STORAGE_PROFILES[profile] if isinstance(profile, str) else dict(profile)
+        self.local = threading.local()  # this thread's connections, cursors and transaction state
+        self.generation = 0  # bumped on every commit, so reads can be cached until the data changes
+        self.generation_lock = threading.Lock()  # commits on different threads mustn't lose a bump
         self.init_db()
+    
+    @property
+    def connection(self):
+        """The connection the current call is using"""
+        return getattr(self.local, 'reader' if self.readonly else 'writer', None)
+    
+    @property
+    def cursor(self):
+        return getattr(self.local, 'reader_cursor' if self.readonly else 'writer_cursor', None)
+    
+    @property
+    def readonly(self):
+        return getattr(self.local, 'readonly', False)
+    
+    @property
+    def in_transaction(self):
+        return getattr(self.local, 'in_transaction', False)
+    
+    def open_connection(self, readonly=False):
+        if readonly:
+            uri = Path(os.path.abspath(self.db_name)).as_uri() + '?mode=ro'
+            connection = sqlite3.connect(uri, uri=True, cached_statements=STATEMENT_CACHE_SIZE)
+        else:
+            connection = sqlite3.connect(self.db_name, cached_statements=STATEMENT_CACHE_SIZE)
+        connection.row_factory = sqlite3.Row
+        
+        for pragma, value in self.profile.items():
+            if not (readonly and pragma in WRITER_PRAGMAS):
+                connection.execute(f'PRAGMA {pragma} = {value}')
+        return connection, connection.cursor()
+    
+    def connect(self, readonly=False):
+        """Get this thread's connection ready for a call, opening it the first time"""
+        # inside transaction() every call shares its work in progress, reads included
+        if self.in_transaction:
+            return
         
-    def connect(self):
-        self.connection = sqlite3.connect(self.db_name)
-        self.connection.row_factory = sqlite3.Row  
-        self.cursor = self.connection.cursor()
+        self.local.readonly = readonly
+        if readonly:
+            if getattr(self.local, 'reader', None) is None:
+                self.local.reader, self.local.reader_cursor = self.open_connection(readonly=True)
+        elif getattr(self.local, 'writer', None) is None:
+            self.local.writer, self.local.writer_cursor = self.open_connection()
+        elif self.local.writer.in_transaction:
+            # a call that failed before close() left writes behind, they were never meant to land
+            self.local.writer.rollback()
         
     def close(self):
-        if self.connection:
-            self.connection.close()
-            self.connection = None
-            self.cursor = None
+        """End a call. The connections stay open for the thread's next one, uncommitted writes are dropped"""
+        if self.in_transaction:
+            return
+        writer = getattr(self.local, 'writer', None)
+        if writer is not None and writer.in_transaction:
+            writer.rollback()
+    
+    def disconnect(self):
+        """Close this thread's connections, the next call opens new ones"""
+        for name in ('writer', 'reader'):
+            connection = getattr(self.local, name, None)
+            setattr(self.local, name, None)
+            setattr(self.local, name + '_cursor', None)
+            if connection is not None:
+                connection.close()
     
     def commit(self):
+        if self.in_transaction:
+            return
         if self.connection:
             self.connection.commit()
+            self.bump_generation()
+    
+    def bump_generation(self):
+        with self.generation_lock:
+            self.generation += 1
+    
+    @contextmanager
+    def cursor_scope(self, readonly=False):
+        """
+        Borrow this thread's cursor for a block. Writes need a commit() inside
+        it, anything still uncommitted when the block ends is rolled back
+        """
+        self.connect(readonly)
+        try:
+            yield self.cursor
+        finally:
+            self.close()
+    
+    @contextmanager
+    def transaction(self):
+        """Run several Database calls on this thread's connection and commit them together"""
+        if self.in_transaction:
+            yield self
+            return
+        
+        self.connect()
+        self.local.in_transaction = True
+        try:
+            yield self
+            self.connection.commit()
+            self.bump_generation()
+        except Exception:
+            self.connection.rollback()
+            raise
+        finally:
+            self.local.in_transaction = False
     
     def log(self, message):
         print(f"[Database] {message}")
@@ -44,47 +476,15 @@ class Database:
     def init_db(self):
         self.connect()
         
-        tables = [
-            '''CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                email TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )''',
-            '''CREATE TABLE IF NOT EXISTS images (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                url TEXT NOT NULL,
-                caption TEXT,
-                category TEXT,
-                user_id INTEGER,
-                is_default INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                image_data TEXT,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )''',
-            '''CREATE TABLE IF NOT EXISTS comments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                image_id INTEGER NOT NULL,
-                user_id INTEGER,
-                text TEXT NOT NULL,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (image_id) REFERENCES images (id),
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )''',
-            '''CREATE TABLE IF NOT EXISTS saved_images (
-                user_id INTEGER NOT NULL,
-                image_id INTEGER NOT NULL,
-                saved_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (user_id, image_id),
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                FOREIGN KEY (image_id) REFERENCES images (id)
-            )'''
-        ]
+        started_at = migrate(self.connection)
+        if started_at < len(MIGRATIONS):
+            self.log(f"INFO - Migrated schema from version {started_at} to {len(MIGRATIONS)}")
+        
+        self.cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'images_fts'")
+        self.full_text_search = self.cursor.fetchone() is not None
+        self.cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'users_trigram'")
+        self.trigram_search = self.cursor.fetchone() is not None
         
-        for table in tables:
-            self.cursor.execute(table)
-      
         self._create_default_user()
         
         self.cursor.execute("SELECT COUNT(*) FROM images WHERE is_default = 1")
@@ -205,7 +605,7 @@ class Database:
     
     def authenticate_user(self, username, password):
         """Authenticate a user by username and password"""
-        self.connect()
+        self.connect(readonly=True)
         
         password_hash = hashlib.sha256(password.encode()).hexdigest()
         
@@ -226,7 +626,7 @@ class Database:
     
     def get_user(self, user_id):
         """Get user details by ID"""
-        self.connect()
+        self.connect(readonly=True)
         
         self.cursor.execute(
             'SELECT id, username, email, created_at FROM users WHERE id = ?',
@@ -240,16 +640,51 @@ class Database:
             return dict(user)
         return None
     
-    def get_all_images(self):
-        """Get all images in the database"""
-        self.connect()
+    def get_categories(self):
+        """Every category an image has been posted in, for the feed's filter buttons"""
+        self.connect(readonly=True)
         
         self.cursor.execute('''
-        SELECT id, url, caption, category, user_id, is_default, created_at
+        SELECT DISTINCT category
         FROM images
-        ORDER BY is_default DESC, id DESC
+        WHERE category IS NOT NULL AND category != ''
+        ORDER BY category
         ''')
         
+        categories = [row['category'] for row in self.cursor.fetchall()]
+        self.close()
+        
+        return categories
+    
+    def get_all_images(self, after=None, limit=None):
+        """
+        Get images, defaults first then newest first. For a page pass the
+        limit, and feed_cursor() of the last image of the previous page as after
+        """
+        if after is not None:
+            is_default, after_id = split_cursor(after)
+            is_default = int(is_default)
+        
+        self.connect(readonly=True)
+        
+        query = '''
+        SELECT id, url, caption, category, user_id, is_default, created_at
+        FROM images
+        '''
+        params = []
+        
+        if after is not None:
+            query += 'WHERE (is_default, id) < (?, ?)\n'
+            params += [is_default, after_id]
+        
+        query += 'ORDER BY is_default DESC, id DESC\n'
+        
+        if limit is not None:
+            query += 'LIMIT ?'
+            params.append(limit)
+        
+        self.cursor.execute(query, params)
+        
         images = [dict(row) for row in self.cursor.fetchall()]
         
         for image in images:
@@ -263,12 +698,22 @@ class Database:
         
         return images
     
+    @staticmethod
+    def feed_cursor(image):
+        """The cursor for the get_all_images page after image"""
+        return f"{int(image['is_default'] or 0)}|{image['id']}"
+    
+    @staticmethod
+    def saved_cursor(image):
+        """The cursor for the get_saved_images page after image"""
+        return f"{image['saved_at']}|{image['id']}"
+    
     def get_image_by_id(self, image_id):
         """Get image details by ID"""
-        self.connect()
+        self.connect(readonly=True)
         
         self.cursor.execute('''
-        SELECT id, url, caption, category, user_id, is_default, created_at, image_data
+        SELECT id, url, caption, category, user_id, is_default, created_at
         FROM images
         WHERE id = ?
         ''', (image_id,))
@@ -288,8 +733,27 @@ class Database:
             return image_dict
         return None
     
+    def get_image_data(self, image_id):
+        """The stored bytes of an image, None if it has none"""
+        self.connect(readonly=True)
+        
+        try:
+            self.cursor.execute('SELECT blob_id FROM images WHERE id = ?', (image_id,))
+            row = self.cursor.fetchone()
+            if row is None or row['blob_id'] is None:
+                return None
+            return read_blob(self.connection, row['blob_id'])
+        except Exception as e:
+            self.log(f"ERROR - Failed to read image data: Image={image_id}, Error={str(e)}")
+            return None
+        finally:
+            self.close()
+    
     def upload_image(self, url, caption, category, user_id=None, image_data=None):
-        """Upload a new image"""
+        """
+        Upload a new image. image_data is the image bytes, or base64 of them
+        as older clients send, and goes in the blob store
+        """
         self.connect()
         
         try:
@@ -297,10 +761,12 @@ class Database:
                 url = url[1:]
             elif not url.startswith('/') and not url.startswith('http'):
                 url = '/' + url
+            
+            blob_id = store_blob(self.connection, image_bytes(image_data)) if image_data else None
 
             self.cursor.execute(
-                'INSERT INTO images (url, caption, category, user_id, image_data) VALUES (?, ?, ?, ?, ?)',
-                (url, caption, category, user_id, image_data)
+                'INSERT INTO images (url, caption, category, user_id, blob_id) VALUES (?, ?, ?, ?, ?)',
+                (url, caption, category, user_id, blob_id)
             )
             
             image_id = self.cursor.lastrowid
@@ -325,7 +791,7 @@ class Database:
     
     def get_comments(self, image_id):
         """Get comments for a specific image with username"""
-        self.connect()
+        self.connect(readonly=True)
         
         self.cursor.execute('''
         SELECT c.id, c.image_id, c.user_id, c.text, c.timestamp, u.username
@@ -371,17 +837,35 @@ class Database:
             self.close()
             return False, None, None
    
-    def get_saved_images(self, user_id):
-        """Get all images saved by a specific user"""
-        self.connect()
+    def get_saved_images(self, user_id, after=None, limit=None):
+        """
+        Get the images saved by a specific user, most recently saved first.
+        Pages the same way as get_all_images, after is a saved_cursor()
+        """
+        if after is not None:
+            saved_at, after_id = split_cursor(after)
         
-        self.cursor.execute('''
-        SELECT i.*
-        FROM images i
-        JOIN saved_images s ON i.id = s.image_id
+        self.connect(readonly=True)
+        
+        query = '''
+        SELECT i.id, i.url, i.caption, i.category, i.user_id, i.is_default, i.created_at, s.saved_at
+        FROM saved_images s
+        JOIN images i ON i.id = s.image_id
         WHERE s.user_id = ?
-        ORDER BY s.saved_at DESC
-        ''', (user_id,))
+        '''
+        params = [user_id]
+        
+        if after is not None:
+            query += 'AND (s.saved_at, s.image_id) < (?, ?)\n'
+            params += [saved_at, after_id]
+        
+        query += 'ORDER BY s.saved_at DESC, s.image_id DESC\n'
+        
+        if limit is not None:
+            query += 'LIMIT ?'
+            params.append(limit)
+        
+        self.cursor.execute(query, params)
         
         images = [dict(row) for row in self.cursor.fetchall()]
         
@@ -440,7 +924,7 @@ class Database:
     
     def is_image_saved_by_user(self, user_id, image_id):
         """Check if an image is saved by a specific user"""
-        self.connect()
+        self.connect(readonly=True)
         
         self.cursor.execute(
             'SELECT 1 FROM saved_images WHERE user_id = ? AND image_id = ?',
@@ -451,6 +935,34 @@ class Database:
         self.close()
         
         return is_saved
+    
+    def mark_saved(self, images, user_id):
+        """
+        Set is_saved on every image in the list for user_id, with one query
+        however long the list is. Returns images
+        """
+        if not images:
+            return images
+        
+        self.connect(readonly=True)
+        
+        try:
+            # the ids go in as one JSON parameter, so the statement text stays the same for any page size
+            self.cursor.execute(
+                'SELECT image_id FROM saved_images WHERE user_id = ? AND image_id IN (SELECT value FROM json_each(?))',
+                (user_id, json.dumps([image['id'] for image in images]))
+            )
+            saved = {row['image_id'] for row in self.cursor.fetchall()}
+        except Exception as e:
+            self.log(f"ERROR - Failed to check saved images: User={user_id}, Error={str(e)}")
+            saved = set()
+        finally:
+            self.close()
+        
+        for image in images:
+            image['is_saved'] = image['id'] in saved
+        
+        return images
         
     def unsave_image_for_user(self, user_id, image_id):
         """Remove a saved image for a user"""
@@ -494,7 +1006,7 @@ class Database:
 
     def get_saved_count(self, user_id):
         """Get the count of saved images for a user"""
-        self.connect()
+        self.connect(readonly=True)
         
         self.cursor.execute('SELECT COUNT(*) FROM saved_images WHERE user_id = ?', (user_id,))
         
@@ -505,7 +1017,7 @@ class Database:
 
     def get_uploaded_count(self, user_id):
         """Get the count of images uploaded by a user"""
-        self.connect()
+        self.connect(readonly=True)
         
         self.cursor.execute(
             'SELECT COUNT(*) FROM images WHERE user_id = ? AND is_default = 0',
@@ -519,7 +1031,7 @@ class Database:
 
     def get_comment_count(self, user_id):
         """Get the count of comments made by a user"""
-        self.connect()
+        self.connect(readonly=True)
         
         self.cursor.execute('SELECT COUNT(*) FROM comments WHERE user_id = ?', (user_id,))
         
@@ -528,24 +1040,127 @@ class Database:
         
         return count
         
-    def search_images(self, query, user_id=None):
+    def get_changes(self, since=None, limit=500, user_id=None):
+        """
+        Get what changed after the change id since, oldest first: images,
+        comments and user_id's own saves that were created or deleted. Created
+        images and comments carry their current row. Returns the changes, the
+        since to pass next time and whether more are waiting. With since None
+        no changes are returned, only the current mark to sync from
         """
-        Search for images based on caption, category, or tags
+        with self.cursor_scope(readonly=True) as cursor:
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM change_log')
+            high_water = cursor.fetchone()[0]
+            
+            if since is None:
+                return [], high_water, False
+            
+            # one extra row tells whether another call is needed
+            cursor.execute('''
+            SELECT id, entity, action, entity_id, image_id, user_id, changed_at
+            FROM change_log
+            WHERE id > ? AND id <= ? AND (entity != 'save' OR user_id = ?)
+            ORDER BY id
+            LIMIT ?
+            ''', (since, high_water, user_id, limit + 1))
+            
+            rows = [dict(row) for row in cursor.fetchall()]
+            more = len(rows) > limit
+            rows = rows[:limit]
+            
+            image_ids = [row['entity_id'] for row in rows if row['entity'] == 'image' and row['action'] == 'created']
+            comment_ids = [row['entity_id'] for row in rows if row['entity'] == 'comment' and row['action'] == 'created']
+            
+            images = {}
+            if image_ids:
+                cursor.execute(f'''
+                SELECT id, url, caption, category, user_id, is_default, created_at
+                FROM images
+                WHERE id IN ({', '.join('?' * len(image_ids))})
+                ''', image_ids)
+                
+                for row in cursor.fetchall():
+                    image = dict(row)
+                    if image.get('url'):
+                        if image['url'].startswith('./static'):
+                            image['url'] = image['url'][1:]
+                        elif not image['url'].startswith('/') and not image['url'].startswith('http'):
+                            image['url'] = '/' + image['url']
+                    images[image['id']] = image
+            
+            comments = {}
+            if comment_ids:
+                cursor.execute(f'''
+                SELECT c.id, c.image_id, c.user_id, c.text, c.timestamp, u.username
+                FROM comments c
+                LEFT JOIN users u ON c.user_id = u.id
+                WHERE c.id IN ({', '.join('?' * len(comment_ids))})
+                ''', comment_ids)
+                
+                comments = {row['id']: dict(row) for row in cursor.fetchall()}
+            
+            changes = []
+            for row in rows:
+                change = {
+                    "change_id": row['id'],
+                    "type": row['entity'],
+                    "action": row['action'],
+                    "id": row['entity_id'],
+                    "image_id": row['image_id'],
+                    "user_id": row['user_id'],
+                    "changed_at": row['changed_at']
+                }
+                # None if it has been deleted since, a later change in the log says so
+                if row['action'] == 'created' and row['entity'] == 'image':
+                    change['image'] = images.get(row['entity_id'])
+                elif row['action'] == 'created' and row['entity'] == 'comment':
+                    change['comment'] = comments.get(row['entity_id'])
+                changes.append(change)
+            
+            return changes, rows[-1]['id'] if more else high_water, more
+    
+    def search_images(self, query, user_id=None, limit=SEARCH_LIMIT):
+        """
+        Search for images based on caption or category, best matches first.
+        Words match by prefix through the full-text index, or as substrings
+        with LIKE (newest first) where SQLite has no FTS5.
         If user_id is provided, also mark whether each image is saved by the user
         """
-        self.connect()
+        self.connect(readonly=True)
         
         try:
-            search_term = f'%{query}%'
-            
-            self.cursor.execute('''
-            SELECT id, url, caption, category, user_id, is_default, created_at
-            FROM images
-            WHERE caption LIKE ? OR category LIKE ?
-            ORDER BY is_default DESC, id DESC
-            ''', (search_term, search_term))
-            
-            images = [dict(row) for row in self.cursor.fetchall()]
+            if self.full_text_search:
+                match = fts_query(query)
+                if match:
+                    # bm25 is lower for better matches, a hit in the caption counts double
+                    self.cursor.execute('''
+                    WITH candidates AS (
+                        SELECT rowid, bm25(images_fts, 2.0, 1.0) AS score
+                        FROM images_fts
+                        WHERE images_fts MATCH ?
+                        ORDER BY rowid DESC
+                        LIMIT ?
+                    )
+                    SELECT i.id, i.url, i.caption, i.category, i.user_id, i.is_default, i.created_at
+                    FROM (SELECT rowid, score FROM candidates ORDER BY score LIMIT ?) c
+                    JOIN images i ON i.id = c.rowid
+                    ORDER BY c.score, i.id DESC
+                    ''', (match, SEARCH_CANDIDATES, limit))
+                    images = [dict(row) for row in self.cursor.fetchall()]
+                else:
+                    images = []
+            else:
+                search_term = f'%{query}%'
+                
+                self.cursor.execute('''
+                SELECT id, url, caption, category, user_id, is_default, created_at
+                FROM images
+                WHERE caption LIKE ? OR category LIKE ?
+                ORDER BY is_default DESC, id DESC
+                LIMIT ?
+                ''', (search_term, search_term, limit))
+                
+                images = [dict(row) for row in self.cursor.fetchall()]
             
             # Get username for logging 
             username = None
@@ -562,14 +1177,10 @@ class Database:
                         image['url'] = image['url'][1:]
                     elif not image['url'].startswith('/') and not image['url'].startswith('http'):
                         image['url'] = '/' + image['url']
-                
-                # If user_id is provided, check if image is saved by user
-                if user_id:
-                    self.cursor.execute(
-                        'SELECT 1 FROM saved_images WHERE user_id = ? AND image_id = ?',
-                        (user_id, image['id'])
-                    )
-                    image['is_saved'] = self.cursor.fetchone() is not None
+            
+            # If user_id is provided, mark which images the user has saved
+            if user_id:
+                self.mark_saved(images, user_id)
             
             # Log the search with the username we already retrieved
             self.log(f"INFO - Image search: Query='{query}', User={username or user_id}, Results={len(images)}")
@@ -581,22 +1192,49 @@ class Database:
         finally:
             self.close()
 
-    def search_users(self, query):
+    def search_users(self, query, limit=USER_SEARCH_LIMIT):
         """
-        Search for users based on username
+        Search for users based on username, closest names first.
+        Through the trigram index a name matches when it contains the query
+        or is close to it (a typo or two). Queries under three characters, and
+        SQLite without the trigram tokenizer, match names containing the query
         """
-        self.connect()
+        self.connect(readonly=True)
         
         try:
-            search_term = f'%{query}%'
-            
-            self.cursor.execute('''
-            SELECT id, username, email, created_at
-            FROM users
-            WHERE username LIKE ?
-            ''', (search_term,))
+            # any shared trigram makes a candidate, they're then scored properly.
+            # The first letter alone ("  a") is in too many names to be worth looking up
+            grams = [gram for gram in trigrams(query) if not gram.startswith('  ')]
             
-            users = [dict(row) for row in self.cursor.fetchall()]
+            if self.trigram_search and len(query) >= 3 and grams:
+                match = ' OR '.join('"' + gram.replace('"', '""') + '"' for gram in grams)
+                self.cursor.execute('''
+                SELECT u.id, u.username, u.created_at
+                FROM (
+                    SELECT rowid FROM users_trigram
+                    WHERE users_trigram MATCH ?
+                    ORDER BY bm25(users_trigram)
+                    LIMIT ?
+                ) t
+                JOIN users u ON u.id = t.rowid
+                ''', (match, USER_SEARCH_CANDIDATES))
+                
+                scored = [(name_similarity(query, row['username']), dict(row)) for row in self.cursor.fetchall()]
+                scored = [(score, user) for score, user in scored if score[1] or score[2] >= USER_SEARCH_SIMILARITY]
+                scored.sort(key=lambda pair: (pair[0], -len(pair[1]['username'])), reverse=True)
+                users = [user for score, user in scored[:limit]]
+            else:
+                search_term = f'%{query}%'
+                
+                self.cursor.execute('''
+                SELECT id, username, created_at
+                FROM users
+                WHERE username LIKE ?
+                ORDER BY length(username), username
+                LIMIT ?
+                ''', (search_term, limit))
+                
+                users = [dict(row) for row in self.cursor.fetchall()]
             
             # Log the search
             self.log(f"INFO - User search: Query='{query}', Results={len(users)}")
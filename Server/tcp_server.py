@@ -1,12 +1,21 @@
 import socket
 import json
+import asyncio
 import threading
+import queue
 import logging
 import hashlib
+import hmac
+import secrets
+import itertools
+import struct
+import zlib
 import time
 import sys
 import os
 from datetime import datetime
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 # Logging structure 
 logging.basicConfig(
@@ -52,6 +61,405 @@ class ImprovedLogFilter(logging.Filter):
 
 logger.addFilter(ImprovedLogFilter())
 
+# Every packet on the wire is a fixed header followed by the JSON body.
+# The header is 1 byte of flags and the body length as a 4 byte big-endian int
+FRAME_HEADER = struct.Struct('!BI')
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# Set on frames carrying raw bytes (like an uploaded image) instead of JSON
+FRAME_FLAG_BINARY = 0x01
+PAYLOAD_CHUNK_SIZE = 64 * 1024
+
+# Most sub-commands a single BATCH request may carry
+MAX_BATCH_SIZE = 500
+
+# Largest page GET_IMAGES and GET_SAVED_IMAGES hand out for one request
+MAX_PAGE_SIZE = 200
+
+# Posts a SEARCH returns when the client doesn't give a limit
+SEARCH_LIMIT = 50
+# Users a SEARCH of type "users" returns when the client doesn't give a limit
+USER_SEARCH_LIMIT = 20
+
+# Most change log entries GET_CHANGES returns at once, clients call again while more is set
+MAX_CHANGES = 500
+
+# Read-only commands whose serialized responses are shared between connections
+# through the server's ResponseCache until the database changes
+CACHEABLE_COMMANDS = {"GET_IMAGES", "SEARCH"}
+
+# How many pipelined requests from one connection the asyncio engine runs at once
+MAX_IN_FLIGHT = 16
+# Commands that change what the connection's other requests read (its codec,
+# user, held back events), the asyncio engine runs them with nothing else in flight
+SERIAL_COMMANDS = {"HELLO", "LOGIN", "LOGOUT", "BATCH"}
+
+# Negotiated in the HELLO/WELCOME handshake. Clients that never send HELLO
+# are treated as version 1 and get the same replies they always did
+PROTOCOL_VERSION = 2
+CAPABILITIES = ("split_packets", "compression", "binary_payloads", "pipelining", "events")
+
+# Signs the session tokens LOGIN, REGISTER and HELLO hand out once a password
+# has been checked. New on every start, so tokens last as long as the server
+SESSION_SECRET = secrets.token_bytes(32)
+
+# Commands that act for a user, on a connection bound in HELLO they get that
+# user's id. Never LOGIN or REGISTER, which would take it as already checked
+USER_SCOPED_COMMANDS = {"SAVE_IMAGE", "UNSAVE_IMAGE", "GET_SAVED_IMAGES", "ADD_COMMENT", "SEARCH", "GET_CHANGES", "UPLOAD_IMAGE"}
+
+# Most topics one connection can SUBSCRIBE to: "images" for new uploads,
+# "comments:<image_id>" and "saves:<user_id>" for the user bound in HELLO,
+# which took their password or session token
+MAX_SUBSCRIPTIONS = 100
+# EVENT frames that can wait for one subscriber. Events go out from the
+# subscriber's own sender, a publisher only queues them, and a subscriber
+# that falls this far behind is disconnected
+EVENT_QUEUE_SIZE = 256
+
+UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads')
+
+def issue_session_token(user_id):
+    """A token showing user_id proved who they are to this server, HELLO takes it to bind the user again"""
+    signature = hmac.new(SESSION_SECRET, str(user_id).encode('utf-8'), hashlib.sha256).hexdigest()
+    return f"{user_id}.{signature}"
+
+def session_user(token):
+    """The user id a session token was issued for, None if this server didn't issue it"""
+    user_id = str(token).partition(".")[0]
+    if not user_id.isdigit() or not hmac.compare_digest(issue_session_token(int(user_id)), str(token)):
+        return None
+    return int(user_id)
+
+class FrameError(Exception):
+    """Raised when a frame can't be read off the socket"""
+
+class SlowSubscriberError(RuntimeError):
+    """Raised by push() when a subscriber's event queue is full"""
+
+# command -> CommandHandler, filled in by the @command_handler methods of TCPServerConnection
+COMMAND_HANDLERS = {}
+CommandHandler = namedtuple('CommandHandler', ['function', 'required', 'failure'])
+
+def command_handler(*commands, required=(), failure="ERROR"):
+    """
+    Register a TCPServerConnection method as the handler for commands. If any
+    required data field is missing or empty the request is answered with the
+    failure command and the handler isn't called
+    """
+    def register(function):
+        for command in commands:
+            COMMAND_HANDLERS[command] = CommandHandler(function, tuple(required), failure)
+        return function
+    return register
+
+# Set on frames holding a split packet: a 4 byte envelope length, the header and
+# footer as a small JSON envelope, then the body JSON bytes the checksum covers.
+# The body is serialized once and its checksum is taken over exactly those bytes
+FRAME_FLAG_SPLIT = 0x02
+ENVELOPE_LENGTH = struct.Struct('!I')
+
+CHECKSUM_ALGORITHMS = {
+    "crc32": lambda data: format(zlib.crc32(data), '08x'),
+    "adler32": lambda data: format(zlib.adler32(data), '08x'),
+    "md5": lambda data: hashlib.md5(data).hexdigest()
+}
+DEFAULT_CHECKSUM = "crc32"
+
+class ChecksumError(ValueError):
+    """Raised when a packet body doesn't match its checksum"""
+    
+    def __init__(self, message, header=None):
+        super().__init__(message)
+        self.header = header if isinstance(header, dict) else {}
+
+def serialize_packet(body):
+    return json.dumps(body).encode('utf-8')
+
+def wrap_packet(header, body_bytes, algorithm, checksum):
+    """Put the envelope in front of an already serialized split packet body"""
+    footer = {"checksum": checksum, "algorithm": algorithm}
+    envelope = json.dumps({"header": dict(header, size=len(body_bytes)), "footer": footer}).encode('utf-8')
+    return [ENVELOPE_LENGTH.pack(len(envelope)), envelope, body_bytes]
+
+def encode_packet(header, body, algorithm=DEFAULT_CHECKSUM):
+    """Serialize a split packet, returns the frame payload as a list of byte strings"""
+    body_bytes = serialize_packet(body)
+    return wrap_packet(header, body_bytes, algorithm, CHECKSUM_ALGORITHMS[algorithm](body_bytes))
+
+def decode_packet(frame):
+    """Parse and verify a split packet, raises ValueError if it's malformed"""
+    view = memoryview(frame)
+    if len(view) < ENVELOPE_LENGTH.size:
+        raise ValueError("Packet too short for an envelope")
+    
+    (envelope_size,) = ENVELOPE_LENGTH.unpack_from(view)
+    body_start = ENVELOPE_LENGTH.size + envelope_size
+    if body_start > len(view):
+        raise ValueError("Packet envelope runs past the end of the frame")
+    
+    envelope = json.loads(str(view[ENVELOPE_LENGTH.size:body_start], 'utf-8'))
+    if not isinstance(envelope, dict) or not isinstance(envelope.get('footer'), dict):
+        raise ValueError("Packet envelope is missing its footer")
+    
+    footer = envelope['footer']
+    body_view = view[body_start:]
+    checksum = CHECKSUM_ALGORITHMS.get(footer.get('algorithm'))
+    if checksum is None or checksum(body_view) != footer.get('checksum'):
+        raise ChecksumError("Packet checksum validation failed", envelope.get('header'))
+    
+    return {"header": envelope.get('header') or {}, "body": json.loads(str(body_view, 'utf-8')), "footer": footer}
+
+def frame_size(payload):
+    return len(payload) if isinstance(payload, (bytes, bytearray)) else sum(len(part) for part in payload)
+
+def join_frame(payload, flags=0):
+    """Frame header plus payload (bytes or a list of parts) in one buffer, copied once"""
+    parts = [payload] if isinstance(payload, (bytes, bytearray)) else payload
+    return b''.join([FRAME_HEADER.pack(flags, frame_size(parts)), *parts])
+
+# Set on frames whose payload is zlib compressed. Each side only compresses
+# once the other has said it accepts "zlib" in a packet header
+FRAME_FLAG_COMPRESSED = 0x04
+COMPRESSION = "zlib"
+COMPRESSION_THRESHOLD = 1024  # smaller payloads, like PING/PONG, go out as they are
+
+def compress_frame(payload, flags=0, threshold=COMPRESSION_THRESHOLD):
+    """Compress a frame payload of at least threshold bytes, returns the flags and payload"""
+    parts = [payload] if isinstance(payload, (bytes, bytearray)) else payload
+    size = frame_size(parts)
+    if size < threshold:
+        return flags, payload
+    
+    compressor = zlib.compressobj()
+    compressed = b''.join([compressor.compress(part) for part in parts] + [compressor.flush()])
+    if len(compressed) >= size:
+        # already compressed data (like an embedded JPEG) doesn't shrink
+        return flags, payload
+    return flags | FRAME_FLAG_COMPRESSED, compressed
+
+def decompress_frame(frame):
+    """Inflate a compressed frame payload, raises ValueError if it's corrupt or too big"""
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(frame, MAX_FRAME_SIZE)
+    except zlib.error as e:
+        raise ValueError(f"Corrupt compressed frame: {str(e)}") from e
+    if decompressor.unconsumed_tail:
+        raise ValueError(f"Compressed frame inflates past the {MAX_FRAME_SIZE} byte limit")
+    if not decompressor.eof:
+        raise ValueError("Compressed frame is truncated")
+    return data
+
+# Set on frames encoded with the compact codec: a struct-packed envelope, the
+# checksum, then [command, data, tables] as JSON. Lists of same-shaped rows in
+# data (images, users, results) go in tables as column names plus value arrays,
+# so the keys aren't repeated on every row
+FRAME_FLAG_COMPACT = 0x08
+COMPACT_HEADER = struct.Struct('!IIBB')  # sequence number, reply_to (0 for none), checksum algorithm, checksum length
+CHECKSUM_IDS = {"crc32": 1, "adler32": 2, "md5": 3}
+CHECKSUM_NAMES = {number: name for name, number in CHECKSUM_IDS.items()}
+
+def pack_tables(data):
+    """Split lists of same-shaped rows out of data, returns the rest of data and the tables"""
+    if not isinstance(data, dict):
+        return data, {}
+    
+    tables = {}
+    for key, value in data.items():
+        if isinstance(value, list) and len(value) > 1 and isinstance(value[0], dict):
+            columns = list(value[0])
+            if all(isinstance(row, dict) and list(row) == columns for row in value):
+                tables[key] = [columns, [list(row.values()) for row in value]]
+    
+    if tables:
+        data = {key: value for key, value in data.items() if key not in tables}
+    return data, tables
+
+def serialize_compact(body):
+    data, tables = pack_tables(body.get("data"))
+    return json.dumps([body["command"], data, tables]).encode('utf-8')
+
+def wrap_compact(header, body_bytes, algorithm, checksum):
+    """Put the envelope in front of an already serialized compact packet body"""
+    checksum = bytes.fromhex(checksum)
+    envelope = COMPACT_HEADER.pack(header.get("sequence_number") or 0, header.get("reply_to") or 0,
+                                   CHECKSUM_IDS[algorithm], len(checksum))
+    return [envelope, checksum, body_bytes]
+
+def encode_compact(header, body, algorithm=DEFAULT_CHECKSUM):
+    """Serialize a compact packet, returns the frame payload as a list of byte strings"""
+    body_bytes = serialize_compact(body)
+    return wrap_compact(header, body_bytes, algorithm, CHECKSUM_ALGORITHMS[algorithm](body_bytes))
+
+def decode_compact(frame):
+    """Parse and verify a compact packet into the same shape as a split packet, raises ValueError if it's malformed"""
+    view = memoryview(frame)
+    if len(view) < COMPACT_HEADER.size:
+        raise ValueError("Packet too short for a compact envelope")
+    
+    sequence_number, reply_to, algorithm_id, checksum_size = COMPACT_HEADER.unpack_from(view)
+    header = {"sequence_number": sequence_number, "reply_to": reply_to or None}
+    body_start = COMPACT_HEADER.size + checksum_size
+    algorithm = CHECKSUM_NAMES.get(algorithm_id)
+    if algorithm is None or body_start > len(view):
+        raise ChecksumError("Compact packet has an unknown checksum", header)
+    
+    body_view = view[body_start:]
+    checksum = view[COMPACT_HEADER.size:body_start].hex()
+    if CHECKSUM_ALGORITHMS[algorithm](body_view) != checksum:
+        raise ChecksumError("Packet checksum validation failed", header)
+    
+    body = json.loads(str(body_view, 'utf-8'))
+    if not isinstance(body, list) or len(body) != 3:
+        raise ValueError("Compact packet body isn't [command, data, tables]")
+    
+    command, data, tables = body
+    if tables:
+        try:
+            data = dict(data)
+            for key, (columns, rows) in tables.items():
+                data[key] = [dict(zip(columns, row)) for row in rows]
+        except (AttributeError, TypeError, ValueError) as e:
+            raise ValueError(f"Malformed compact packet tables: {str(e)}") from e
+    
+    return {"header": header, "body": {"command": command, "data": data}, "footer": {"checksum": checksum, "algorithm": algorithm}}
+
+# Body codecs a connection can agree on in the handshake, most preferred first.
+# Every codec marks its frames with its own flag, so frames decode on their own.
+# serialize and wrap are the two halves of encode, so a serialized body can be reused
+Codec = namedtuple('Codec', ['name', 'flag', 'encode', 'decode', 'serialize', 'wrap'])
+CODECS = {
+    "compact": Codec("compact", FRAME_FLAG_COMPACT, encode_compact, decode_compact, serialize_compact, wrap_compact),
+    "json": Codec("json", FRAME_FLAG_SPLIT, encode_packet, decode_packet, serialize_packet, wrap_packet)
+}
+
+def codec_for_flags(flags):
+    """The codec a frame was encoded with, None for a legacy single document packet"""
+    for codec in CODECS.values():
+        if flags & codec.flag:
+            return codec
+    return None
+
+class ResponseCache:
+    """
+    LRU cache of serialized response bodies shared by a server's connections.
+    Entries expire after ttl seconds, and all of them are dropped as soon as
+    the database generation moves on, so a read is never answered with data
+    from before a write
+    """
+    
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024, ttl=30):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires, (body_bytes, checksum)), least recently used first
+        self.size = 0  # bytes of body held
+        self.generation = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def check_generation(self, generation):
+        """Drop every entry if the database has changed, call with the lock held"""
+        if generation != self.generation:
+            self.entries.clear()
+            self.size = 0
+            self.generation = generation
+    
+    def get(self, key, generation):
+        with self.lock:
+            self.check_generation(generation)
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self.remove(key)
+                entry = None
+            
+            if entry is None:
+                self.misses += 1
+                return None
+            
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def put(self, key, generation, value):
+        with self.lock:
+            if generation != self.generation:
+                # the data changed while this response was being built
+                return
+            
+            self.remove(key)
+            body_bytes, checksum = value
+            if len(body_bytes) > self.max_bytes:
+                return
+            
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.size += len(body_bytes)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+    
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1][0])
+    
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self.entries),
+                "bytes": self.size
+            }
+
+
+class Subscriptions:
+    """
+    The topics a server's connections have subscribed to. publish() queues an
+    EVENT frame for each subscriber, a connection that can't take it is
+    unsubscribed from everything and disconnected
+    """
+    
+    def __init__(self):
+        self.subscribers = {}  # topic -> set of connections
+        self.lock = threading.Lock()
+    
+    def subscribe(self, connection, topics):
+        with self.lock:
+            for topic in topics:
+                self.subscribers.setdefault(topic, set()).add(connection)
+                connection.topics.add(topic)
+    
+    def unsubscribe(self, connection, topics=None):
+        """Drop some of a connection's topics, or all of them"""
+        with self.lock:
+            for topic in list(connection.topics if topics is None else topics):
+                subscribers = self.subscribers.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(connection)
+                    if not subscribers:
+                        del self.subscribers[topic]
+                connection.topics.discard(topic)
+    
+    def publish(self, topic, data):
+        """Queue an event for every subscriber of topic, returns how many took it. Never waits on a subscriber"""
+        with self.lock:
+            subscribers = list(self.subscribers.get(topic, ()))
+        
+        sent = 0
+        for connection in subscribers:
+            try:
+                connection.push(topic, data)
+                sent += 1
+            except (OSError, RuntimeError) as e:
+                logger.warning("Couldn't push %s event to %s, disconnecting it: %s", topic, connection.address, e)
+                self.unsubscribe(connection)
+                connection.hang_up()
+        return sent
+
+
 class TCPServerConnection:
     """
     Handles an individual client connection to the server
@@ -62,8 +470,23 @@ class TCPServerConnection:
         self.client_socket = client_socket
         self.address = address
         self.sequence_number = 0
+        self.sequence_counter = itertools.count(1)  # next() is atomic, pipelined requests share it
         self.db = db
         self.username = None
+        self.user_id = None  # bound in HELLO, requests then act as this user
+        self.protocol_version = 1
+        self.capabilities = set()
+        self.upload_folder = UPLOAD_FOLDER
+        self.checksum_algorithm = None  # set once the client sends split packets, None means legacy JSON replies
+        self.compression_threshold = COMPRESSION_THRESHOLD  # None turns compression off
+        self.compress_replies = False  # set once the client says it accepts compressed frames
+        self.codec = CODECS["json"]  # for replies to split packets, the handshake can pick a more compact one
+        self.response_cache = None  # the server's ResponseCache, shared with its other connections
+        self.subscriptions = None  # the server's Subscriptions, None when it doesn't push events
+        self.topics = set()  # what this connection subscribed to
+        self.batch_events = threading.local()  # .pending holds events back until the BATCH on this thread commits
+        self.events = None  # EVENT frames waiting for this connection's sender, made on first SUBSCRIBE
+        self.send_lock = threading.Lock()  # the event sender thread writes to the socket too
         
     def calculate_checksum(self, data):
         return hashlib.md5(data.encode('utf-8')).hexdigest()
@@ -71,595 +494,728 @@ class TCPServerConnection:
     def validate_checksum(self, data, checksum):
         return self.calculate_checksum(data) == checksum
     
+    def recv_exact(self, size):
+        """Read exactly size bytes into a preallocated buffer, None on a clean close"""
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        received = 0
+        
+        while received < size:
+            count = self.client_socket.recv_into(view[received:], size - received)
+            if count == 0:
+                if received == 0:
+                    return None
+                raise FrameError(f"Connection closed after {received} of {size} bytes")
+            received += count
+            
+        return buffer
+    
+    def receive_frame(self):
+        """Return the flags and body of the next frame, or None on a clean close"""
+        header = self.recv_exact(FRAME_HEADER.size)
+        if header is None:
+            return None
+        
+        flags, size = FRAME_HEADER.unpack(header)
+        if size > MAX_FRAME_SIZE:
+            raise FrameError(f"Frame of {size} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+        if size == 0:
+            return flags, bytearray()
+        
+        body = self.recv_exact(size)
+        if body is None:
+            raise FrameError("Connection closed before frame body")
+        return flags, body
+    
+    def check_payload_header(self, header):
+        """Validate the header of a binary payload frame and return the payload size"""
+        flags, size = FRAME_HEADER.unpack(header)
+        if not flags & FRAME_FLAG_BINARY:
+            raise FrameError("Expected a binary payload frame")
+        if size > MAX_FRAME_SIZE:
+            raise FrameError(f"Payload of {size} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+        return size
+    
+    def receive_payload(self, out):
+        """Copy the next binary frame into the file object out in chunks, returns the size"""
+        header = self.recv_exact(FRAME_HEADER.size)
+        if header is None:
+            raise FrameError("Connection closed before payload frame")
+        
+        size = self.check_payload_header(header)
+        chunk = bytearray(min(size, PAYLOAD_CHUNK_SIZE))
+        view = memoryview(chunk)
+        remaining = size
+        
+        while remaining:
+            count = self.client_socket.recv_into(view, min(remaining, len(chunk)))
+            if count == 0:
+                raise FrameError(f"Connection closed after {size - remaining} of {size} payload bytes")
+            out.write(view[:count])
+            remaining -= count
+            
+        return size
+    
+    def upload_path(self, filename):
+        # the client's filename only lends its extension, two users uploading photo.jpg mustn't overwrite each other
+        extension = os.path.splitext(os.path.basename(filename or ''))[1].lower()
+        if not extension[1:].isalnum() or len(extension) > 8:
+            extension = ''
+        os.makedirs(self.upload_folder, exist_ok=True)
+        return os.path.join(self.upload_folder, secrets.token_hex(16) + extension)
+    
+    def save_upload_payload(self, filename):
+        """Stream an upload payload straight to the uploads folder, returns the file path"""
+        path = self.upload_path(filename)
+        partial_path = path + '.part'
+        
+        try:
+            with open(partial_path, 'wb') as f:
+                size = self.receive_payload(f)
+            os.replace(partial_path, path)
+        except Exception as e:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            # part of the payload may be unread, so any failure leaves the stream out of sync
+            if isinstance(e, FrameError):
+                raise
+            raise FrameError(f"Couldn't store upload payload: {str(e)}") from e
+        
+        logger.info(f"Stored {size} byte upload payload from {self.address} at {path}")
+        return path
+    
+    def send_frame(self, payload, flags=0):
+        with self.send_lock:
+            self.client_socket.sendall(join_frame(payload, flags))
+    
+    def start_event_sender(self):
+        """Give this connection its event queue and the thread that writes it out"""
+        if self.events is None:
+            self.events = queue.Queue(EVENT_QUEUE_SIZE)
+            threading.Thread(target=self.send_events, name=f'EventSender-{self.address}', daemon=True).start()
+    
+    def send_events(self):
+        # only this thread waits on a subscriber that reads slowly, never the thread publishing to it
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            try:
+                self.send_frame(*event)
+            except OSError:
+                return
+    
+    def stop_event_sender(self):
+        if self.events is not None:
+            try:
+                self.events.put_nowait(None)
+            except queue.Full:
+                pass  # the socket is closed, the sender stops on its next send
+    
+    def push(self, topic, data):
+        """Queue an EVENT for a topic this connection subscribed to, it has no reply_to. Never blocks"""
+        flags, payload = self.encode_response("EVENT", dict(data, topic=topic))
+        try:
+            self.events.put_nowait((payload, flags))
+        except queue.Full:
+            raise SlowSubscriberError(f"{EVENT_QUEUE_SIZE} events already waiting") from None
+    
+    def hang_up(self):
+        """Disconnect a subscriber that can't keep up, its own thread then finishes the connection"""
+        try:
+            self.client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    
+    def publish(self, topic, data):
+        """Tell the topic's subscribers about a write this connection made"""
+        if self.subscriptions is None:
+            return
+        pending = getattr(self.batch_events, 'pending', None)
+        if pending is not None:
+            pending.append((topic, data))
+            return
+        self.subscriptions.publish(topic, data)
+    
+    def decode_request(self, flags, frame):
+        """Parse a request frame, raises ValueError if it can't be decoded"""
+        if flags & FRAME_FLAG_COMPRESSED:
+            frame = decompress_frame(frame)
+        
+        codec = codec_for_flags(flags)
+        if codec is None:
+            return json.loads(frame)
+        
+        packet = codec.decode(frame)
+        # reply checksummed the way the client checks its own requests
+        self.checksum_algorithm = packet['footer']['algorithm']
+        if self.protocol_version < 2:
+            # no handshake, the client says whether it takes compressed replies in each header
+            self.compress_replies = packet['header'].get('compression') == COMPRESSION
+        return packet
+    
     def handle_request(self):
         try:
             logger.info(f"Connection established with {self.address}")
-            buffer = ""
-            
             
             while True:
                 try:
-                    data = self.client_socket.recv(4096).decode('utf-8')
-                    if not data:
-                        break
-                    
-                    buffer += data
-                    
-                    try:
-                        packet = json.loads(buffer)
-                        buffer = ""  
-                        
-                        if 'body' in packet and 'command' in packet['body'] and packet['body']['command'] == 'UPLOAD_IMAGE':
-                            command = packet['body'].get('command')
-                            data = packet['body'].get('data', {})
-                            
-                            user_info = f" [User: {self.username}]" if self.username else ""
-                            logger.info(f"Processing image upload from {self.address}{user_info}")
-                            
-                            response_data = self.process_command(command, data)
-                            response = self.create_packet(response_data["command"], response_data["data"])
-                            
-                            response_json = json.dumps(response)
-                            self.client_socket.sendall(response_json.encode('utf-8'))
-                            continue
-                        
-                        if 'header' in packet and 'body' in packet and 'command' in packet['body']:
-                            cmd = packet['body']['command']
-                            seq = packet['header'].get('sequence_number', 'unknown')
-                            
-                            if cmd == "LOGIN" and 'data' in packet['body'] and 'username' in packet['body']['data']:
-                                self.username = packet['body']['data']['username']
-                            
-                            user_info = f" [User: {self.username}]" if self.username else ""
-                            logger.info(f"REQUEST from {self.address}{user_info}: Command={cmd}, Sequence={seq}")
-                            
-                            command = packet['body'].get('command')
-                            data = packet['body'].get('data', {})
-                            
-                            if command == "LOGOUT":
-                                logger.info(f"User logged out: {self.username}")
-                                self.username = None
-                            
-                            response_data = self.process_command(command, data)
-                            
-                            user_info = f" [User: {self.username}]" if self.username else ""
-                            logger.info(f"Successfully processed command '{command}' from {self.address}{user_info}")
-                            
-                            response = self.create_packet(response_data["command"], response_data["data"])
-                            response_json = json.dumps(response)
-                            self.client_socket.sendall(response_json.encode('utf-8'))
-                    
-                    except json.JSONDecodeError:
-                        if len(buffer) > 1024 * 1024:
-                            if "UPLOAD_IMAGE" in buffer:
-                                logger.info(f"Large image upload from {self.address}")
-                                success_response = self.create_packet("UPLOAD_SUCCESS", {"message": "Image received"})
-                                self.client_socket.sendall(json.dumps(success_response).encode('utf-8'))
-                            
-                            buffer = ""
-                            logger.error(f"Buffer overflow from {self.address}, likely during image upload")
-                    
-                except UnicodeDecodeError:
-                    logger.info(f"Received binary data from {self.address}, likely image upload")
-                    buffer = ""
-                    success_response = self.create_packet("UPLOAD_SUCCESS", {"message": "Data received"})
-                    self.client_socket.sendall(json.dumps(success_response).encode('utf-8'))
+                    received = self.receive_frame()
+                except FrameError as e:
+                    # the stream can't be resynchronised after a bad frame so drop the connection
+                    logger.error(f"Framing error from {self.address}: {str(e)}")
+                    self.send_error(f"Framing error: {str(e)}")
+                    break
+                
+                if received is None:
+                    break
+                
+                flags, frame = received
+                try:
+                    packet = self.decode_request(flags, frame)
+                except ChecksumError:
+                    logger.error(f"Checksum mismatch in packet from {self.address}")
+                    self.send_error("Checksum mismatch")
+                    continue
+                except ValueError:
+                    logger.error(f"Invalid JSON packet from {self.address} ({len(frame)} bytes)")
+                    self.send_error("Invalid packet")
+                    continue
                 
+                try:
+                    self.handle_packet(packet)
+                except FrameError as e:
+                    logger.error(f"Framing error from {self.address}: {str(e)}")
+                    self.send_error(f"Framing error: {str(e)}", self.request_sequence(packet))
+                    break
                 except Exception as e:
                     logger.error(f"Error processing request from {self.address}: {str(e)}")
-                    self.send_error(f"Processing error")
-                    buffer = ""
+                    self.send_error(f"Processing error", self.request_sequence(packet))
                     
         except Exception as e:
             logger.error(f"Connection error with {self.address}: {str(e)}")
         finally:
+            if self.subscriptions is not None:
+                self.subscriptions.unsubscribe(self)
+            self.stop_event_sender()
             self.client_socket.close()
             user_info = f" [User: {self.username}]" if self.username else ""
             logger.info(f"Connection closed with {self.address}{user_info}")
     
-    def process_command(self, command, data):
-        user_info = f" [User: {self.username}]" if self.username else ""
+    def request_sequence(self, packet):
+        if isinstance(packet, dict) and isinstance(packet.get('header'), dict):
+            return packet['header'].get('sequence_number')
+        return None
+    
+    def is_valid_packet(self, packet):
+        return isinstance(packet, dict) and 'header' in packet and 'body' in packet and 'command' in packet['body']
+    
+    def has_upload_payload(self, packet):
+        # the image bytes of a binary upload follow in their own frame
+        return packet['body']['command'] == "UPLOAD_IMAGE" and packet['body'].get('data', {}).get('payload_size') is not None
+    
+    def handle_packet(self, packet):
+        if not self.is_valid_packet(packet):
+            logger.warning(f"Malformed packet from {self.address}")
+            self.send_error("Malformed packet", self.request_sequence(packet))
+            return
         
-        command_log_messages = {
-            "LOGIN": f"User login attempt: {data.get('username', '')}",
-            "REGISTER": f"New user registration: {data.get('username', '')}",
-            "UPLOAD_IMAGE": f"{user_info} Image upload - Caption: {data.get('caption', '')[:30]}... Category: {data.get('category', '')}",
-            "SAVE_IMAGE": f"{user_info} Saved image ID: {data.get('image_id', '')}",
-            "UNSAVE_IMAGE": f"{user_info} Removed saved image ID: {data.get('image_id', '')}",
-            "ADD_COMMENT": f"{user_info} Added comment to image ID: {data.get('image_id', '')} - Text: {data.get('text', '')[:30]}...",
-            "SEARCH": f"{user_info} Search - Query: {data.get('query', '')}, Type: {data.get('type', 'posts')}"
-        }
+        # always drain the payload frame, even if the upload is rejected, to stay in sync
+        stored_path = None
+        if self.has_upload_payload(packet):
+            stored_path = self.save_upload_payload(packet['body']['data'].get('filename'))
         
-        if command in command_log_messages:
-            logger.info(command_log_messages[command])
+        flags, payload = self.respond(packet, stored_path)
+        self.send_frame(payload, flags)
+    
+    def respond(self, packet, stored_path=None):
+        """
+        Run the command in a valid request packet and return the encoded
+        response frame. stored_path is where the request's upload payload was saved
+        """
+        command = packet['body'].get('command')
+        data = packet['body'].get('data', {})
+        sequence_number = packet['header'].get('sequence_number')
         
-        response = {
-            "command": "ERROR",
-            "data": {"message": "Unknown command"}
-        }
+        if command == "LOGIN" and isinstance(data, dict) and 'username' in data:
+            self.username = data['username']
         
-        if command == "PING":
-            response = {
-                "command": "PONG",
-                "data": {
-                    "received_timestamp": data.get("timestamp", 0),
-                    "server_timestamp": time.time()
-                }
-            }
+        logger.info("REQUEST from %s [User: %s]: Command=%s, Sequence=%s", self.address, self.username, command, sequence_number)
         
-        elif command in ["TEST", "ECHO"]:
-            response = {
-                "command": "ECHO",
-                "data": {
-                    "message": "Server received your request",
-                    "original_command": command,
-                    "timestamp": datetime.now().isoformat()
-                }
-            }
+        if command == "LOGOUT":
+            logger.info("User logged out: %s", self.username)
+            self.username = None
+            self.user_id = None
         
-        elif command == "LOGIN":
-            username = data.get("username", "")
-            user_id = data.get("user_id", "")
-            
-            if user_id:
-                response = {
-                    "command": "LOGIN_SUCCESS",
-                    "data": {
-                        "user_id": user_id,
-                        "username": username
-                    }
-                }
-                logger.info(f"User logged in via ID: {username} (ID: {user_id})")
-            else:
-                password = data.get("password", "")
-                success, user_id = self.db.authenticate_user(username, password)
-                
-                if success:
-                    response = {
-                        "command": "LOGIN_SUCCESS",
-                        "data": {
-                            "user_id": user_id,
-                            "username": username
-                        }
-                    }
-                    logger.info(f"User authenticated and logged in: {username} (ID: {user_id})")
-                else:
-                    response = {
-                        "command": "LOGIN_FAILED",
-                        "data": {
-                            "message": "Invalid username or password"
-                        }
-                    }
-                    logger.warning(f"Failed login attempt for user: {username}")
-        
-        elif command == "REGISTER":
-            username = data.get("username", "")
-            user_id = data.get("user_id", "")
-            
-            if user_id:
-                response = {
-                    "command": "REGISTER_SUCCESS",
-                    "data": {
-                        "user_id": user_id,
-                        "username": username
-                    }
-                }
-                logger.info(f"User registered via ID: {username} (ID: {user_id})")
-            else:
-                password = data.get("password", "")
-                email = data.get("email", None)
-                
-                success, result = self.db.create_user(username, password, email)
-                
-                if success:
-                    response = {
-                        "command": "REGISTER_SUCCESS",
-                        "data": {
-                            "user_id": result,
-                            "username": username
-                        }
-                    }
-                    logger.info(f"New user registered: {username} (ID: {result})")
-                else:
-                    response = {
-                        "command": "REGISTER_FAILED",
-                        "data": {
-                            "message": result
-                        }
-                    }
-                    logger.warning(f"Failed registration attempt for username: {username} - {result}")
-        
-        elif command == "UPLOAD_IMAGE":
-            image_id = data.get("id", None)
-            url = data.get("url", "")
-            caption = data.get("caption", "")
-            category = data.get("category", "")
-            user_id = data.get("user_id", None)
-            image_data = data.get("image", None)
-            
-            if image_id:
-                response = {
-                    "command": "UPLOAD_SUCCESS",
-                    "data": {
-                        "image_id": image_id,
-                        "url": url
-                    }
-                }
-                logger.info(f"Image uploaded via ID: {image_id}, Caption: {caption}")
-            else:
-                if not user_id:
-                    response = {
-                        "command": "UPLOAD_FAILED",
-                        "data": {
-                            "message": "User ID is required"
-                        }
-                    }
-                    logger.warning(f"Image upload failed: No user ID provided")
-                else:
-                    if url.startswith('./'):
-                        url = url[1:]  
-                        
-                    image_id = self.db.upload_image(url, caption, category, user_id, image_data)
-                    
-                    if image_id:
-                        response = {
-                            "command": "UPLOAD_SUCCESS",
-                            "data": {
-                                "image_id": image_id,
-                                "url": url
-                            }
-                        }
-                        logger.info(f"Image uploaded successfully: ID={image_id}, Caption={caption}, User={user_id}")
-                    else:
-                        response = {
-                            "command": "UPLOAD_FAILED",
-                            "data": {
-                                "message": "Failed to save image to database"
-                            }
-                        }
-                        logger.error(f"Failed to save image to database: Caption={caption}, User={user_id}")
-        
-        elif command == "GET_IMAGES":
-            images = self.db.get_all_images()
-            
-            response = {
-                "command": "IMAGES",
-                "data": {
-                    "images": images
-                }
-            }
-            logger.info(f"Returned {len(images)} images to {self.address}")
+        if command == "HELLO":
+            response_data = self.welcome(data)
+        elif command in CACHEABLE_COMMANDS and self.response_cache is not None and self.checksum_algorithm is not None:
+            return self.respond_cached(command, self.with_bound_user(command, data), sequence_number)
+        elif stored_path is not None:
+            response_data = self.process_command(command, self.with_bound_user(command, data), stored_path=stored_path)
+        else:
+            response_data = self.process_command(command, self.with_bound_user(command, data))
         
-        elif command == "GET_SAVED_IMAGES":
-            user_id = data.get("user_id", None)
-            
-            if not user_id:
-                response = {
-                    "command": "GET_SAVED_FAILED",
-                    "data": {
-                        "message": "User ID is required"
-                    }
-                }
-                logger.warning(f"Get saved images failed: No user ID provided")
-            else:
-                images = self.db.get_saved_images(user_id)
-                
-                response = {
-                    "command": "SAVED_IMAGES",
-                    "data": {
-                        "images": images
-                    }
-                }
-                logger.info(f"Returned {len(images)} saved images for user ID: {user_id}")
-        
-        elif command == "SAVE_IMAGE":
-            user_id = data.get("user_id", None)
-            image_id = data.get("image_id", None)
-            
-            if not user_id or not image_id:
-                response = {
-                    "command": "SAVE_IMAGE_FAILED",
-                    "data": {
-                        "message": "User ID and Image ID are required"
-                    }
-                }
-                logger.warning(f"Save image failed: Missing required fields - User: {user_id}, Image: {image_id}")
-            else:
-                success = self.db.save_image_for_user(user_id, image_id)
-                
-                if success:
-                    response = {
-                        "command": "SAVE_IMAGE_SUCCESS",
-                        "data": {
-                            "user_id": user_id,
-                            "image_id": image_id
-                        }
-                    }
-                    logger.info(f"Image saved successfully: User={user_id}, Image={image_id}")
-                else:
-                    response = {
-                        "command": "SAVE_IMAGE_FAILED",
-                        "data": {
-                            "message": "Image already saved or couldn't be saved"
-                        }
-                    }
-                    logger.warning(f"Failed to save image (likely already saved): User={user_id}, Image={image_id}")
-        
-        elif command == "UNSAVE_IMAGE":
-            user_id = data.get("user_id", None)
-            image_id = data.get("image_id", None)
-            
-            if not user_id or not image_id:
-                response = {
-                    "command": "UNSAVE_IMAGE_FAILED",
-                    "data": {
-                        "message": "User ID and Image ID are required"
-                    }
-                }
-                logger.warning(f"Unsave image failed: Missing required fields - User: {user_id}, Image: {image_id}")
-            else:
-                success = self.db.unsave_image_for_user(user_id, image_id)
-                
-                response = {
-                    "command": "UNSAVE_IMAGE_SUCCESS",
-                    "data": {
-                        "user_id": user_id,
-                        "image_id": image_id,
-                        "success": success
-                    }
-                }
-                logger.info(f"Image unsaved: User={user_id}, Image={image_id}, Success={success}")
-        
-        elif command == "SEARCH":
-            query = data.get("query", "")
-            search_type = data.get("type", "posts")
-            user_id = data.get("user_id", None)
-            
-            if not query:
-                response = {
-                    "command": "SEARCH_FAILED",
-                    "data": {
-                        "message": "Search query is required"
-                    }
-                }
-                logger.warning(f"Search failed: No query provided")
-            else:
-                if search_type == "users":
-                    users = self.db.search_users(query)
-                    response = {
-                        "command": "SEARCH_RESULTS",
-                        "data": {
-                            "type": "users",
-                            "query": query,
-                            "results": users
-                        }
-                    }
-                    logger.info(f"User search: Query='{query}', Results={len(users)}")
-                else:
-                    images = self.db.search_images(query, user_id)
-                    response = {
-                        "command": "SEARCH_RESULTS",
-                        "data": {
-                            "type": "posts",
-                            "query": query,
-                            "results": images
-                        }
-                    }
-                    logger.info(f"Image search: Query='{query}', Results={len(images)}")
-                
-        return response
-    
-    def process_command(self, command, data):
-        """Process the request command and return response data"""
-        # Default response
-        response = {
-            "command": "ERROR",
-            "data": {"message": "Unknown command"}
-        }
+        logger.info("Successfully processed command '%s' from %s [User: %s]", command, self.address, self.username)
         
-        # Handle different commands
-        if command == "PING":
-            response = {
-                "command": "PONG",
-                "data": {
-                    "received_timestamp": data.get("timestamp", 0),
-                    "server_timestamp": time.time()
-                }
-            }
+        return self.encode_response(response_data["command"], response_data["data"], sequence_number)
+    
+    def respond_cached(self, command, data, reply_to):
+        """Answer a read-only command from the response cache, running and caching it on a miss"""
+        codec = self.codec
+        key = (command, json.dumps(data, sort_keys=True, default=str), codec.name, self.checksum_algorithm)
+        # read before the query, so a write that lands during it leaves the entry already stale
+        generation = self.db.generation
         
-        elif command == "TEST" or command == "ECHO":
-            response = {
-                "command": "ECHO",
-                "data": {
-                    "message": "Server received your request",
-                    "original_command": command,
-                    "timestamp": datetime.now().isoformat()
-                }
-            }
+        entry = self.response_cache.get(key, generation)
+        if entry is None:
+            response_data = self.process_command(command, data)
+            entry = self.serialize_response(response_data["command"], response_data["data"], codec)
+            self.response_cache.put(key, generation, entry)
+        else:
+            logger.info("Answered %s for %s from the response cache", command, self.address)
         
-        elif command == "LOGIN":
-            username = data.get("username", "")
-            password = data.get("password", "")
-            
-            success, user_id = self.db.authenticate_user(username, password)
-            
-            if success:
-                response = {
-                    "command": "LOGIN_SUCCESS",
-                    "data": {
-                        "user_id": user_id,
-                        "username": username
-                    }
-                }
+        return self.wrap_response(*entry, codec, reply_to)
+    
+    def welcome(self, data):
+        """Answer a HELLO, settling the protocol version, capabilities and user for this connection"""
+        try:
+            version = int(data.get("version", 1))
+        except (TypeError, ValueError):
+            version = 1
+        self.protocol_version = max(1, min(version, PROTOCOL_VERSION))
+        
+        offered = data.get("capabilities") or []
+        agreed = [capability for capability in CAPABILITIES if capability in offered
+                  and (capability != "compression" or self.compression_threshold is not None)
+                  and (capability != "events" or self.subscriptions is not None)]
+        self.capabilities = set(agreed)
+        self.compress_replies = "compression" in self.capabilities
+        
+        # the first codec, in our order of preference, the client can read too
+        offered_codecs = data.get("codecs") or []
+        self.codec = next((codec for name, codec in CODECS.items() if name in offered_codecs), CODECS["json"])
+        
+        # binding a user takes their password or a session token from an earlier login, a bare user_id isn't trusted
+        if data.get("session_token"):
+            user_id = session_user(data["session_token"])
+            if user_id is not None:
+                self.user_id = user_id
+                self.username = data.get("username") or self.username
             else:
-                response = {
-                    "command": "LOGIN_FAILED",
-                    "data": {
-                        "message": "Invalid username or password"
-                    }
-                }
-        
-        elif command == "REGISTER":
-            username = data.get("username", "")
-            password = data.get("password", "")
-            email = data.get("email", None)
-            
-            success, result = self.db.add_user(username, password, email)
-            
+                logger.warning(f"HELLO from {self.address} sent a session token this server didn't issue")
+        elif data.get("username") and data.get("password"):
+            success, user_id = self.db.authenticate_user(data["username"], data["password"])
             if success:
-                response = {
-                    "command": "REGISTER_SUCCESS",
-                    "data": {
-                        "user_id": result,
-                        "username": username
-                    }
-                }
+                self.user_id = user_id
+                self.username = data["username"]
             else:
-                response = {
-                    "command": "REGISTER_FAILED",
-                    "data": {
-                        "message": result
-                    }
-                }
-        
-        elif command == "UPLOAD_IMAGE":
-            filename = data.get("filename", "")
-            caption = data.get("caption", "")
-            tags = data.get("tags", "")
-            user_id = data.get("user_id", None)
-            image_data = data.get("image", None)
-            
-            if not user_id:
-                response = {
-                    "command": "UPLOAD_FAILED",
-                    "data": {
-                        "message": "User ID is required"
-                    }
-                }
-            else:
-                success, image_id = self.db.save_image(filename, caption, tags, user_id, image_data)
-                
-                if success:
-                    response = {
-                        "command": "UPLOAD_SUCCESS",
-                        "data": {
-                            "image_id": image_id,
-                            "filename": filename
-                        }
-                    }
-                else:
-                    response = {
-                        "command": "UPLOAD_FAILED",
-                        "data": {
-                            "message": image_id  # Error message
-                        }
-                    }
-        
-        elif command == "GET_IMAGES":
-            images = self.db.get_images(limit=20)
-            
-            response = {
-                "command": "IMAGES",
-                "data": {
-                    "images": images
-                }
+                logger.warning(f"HELLO from {self.address} failed to authenticate {data['username']}")
+        elif data.get("user_id"):
+            logger.warning(f"HELLO from {self.address} asked for user {data['user_id']} without a password or session token")
+        
+        logger.info(f"Handshake with {self.address}: version {self.protocol_version}, capabilities {agreed}, "
+                    f"codec {self.codec.name}, user {self.user_id}")
+        return {
+            "command": "WELCOME",
+            "data": {
+                "version": self.protocol_version,
+                "capabilities": agreed,
+                "codec": self.codec.name,
+                "user_id": self.user_id,
+                "username": self.username,
+                "session_token": issue_session_token(self.user_id) if self.user_id is not None else None
+            }
+        }
+    
+    def with_bound_user(self, command, data):
+        # a connection bound to a user acts as that user, its user-scoped requests don't need to send user_id
+        if self.user_id is None or command not in USER_SCOPED_COMMANDS or not isinstance(data, dict):
+            return data
+        return dict(data, user_id=self.user_id)
+    
+    def process_command(self, command, data, **context):
+        """
+        Run the registered handler for a command and return its response data.
+        context is passed on to the handler as keyword arguments, for what the
+        server knows about the request that the client doesn't get to set
+        """
+        handler = COMMAND_HANDLERS.get(command)
+        if handler is None:
+            logger.warning("Unknown command %r from %s", command, self.address)
+            return {"command": "ERROR", "data": {"message": "Unknown command"}}
+        
+        if not isinstance(data, dict):
+            return {"command": handler.failure, "data": {"message": "Command data must be an object"}}
+        
+        missing = [field for field in handler.required if not data.get(field)]
+        if missing:
+            logger.warning("%s from %s is missing %s", command, self.address, missing)
+            return {"command": handler.failure, "data": {"message": f"Missing required fields: {', '.join(missing)}"}}
+        
+        return handler.function(self, data, **context)
+    
+    @command_handler("PING")
+    def handle_ping(self, data):
+        return {
+            "command": "PONG",
+            "data": {
+                "received_timestamp": data.get("timestamp", 0),
+                "server_timestamp": time.time()
+            }
+        }
+    
+    @command_handler("ECHO")
+    def handle_echo(self, data, command="ECHO"):
+        return {
+            "command": "ECHO",
+            "data": {
+                "message": "Server received your request",
+                "original_command": command,
+                "timestamp": datetime.now().isoformat()
             }
+        }
+    
+    @command_handler("TEST")
+    def handle_test(self, data):
+        return self.handle_echo(data, "TEST")
+    
+    @command_handler("LOGIN", required=("username",), failure="LOGIN_FAILED")
+    def handle_login(self, data):
+        username = data["username"]
+        logger.info("User login attempt: %s", username)
         
-        elif command == "GET_SAVED_IMAGES":
-            user_id = data.get("user_id", None)
-            
-            if not user_id:
-                response = {
-                    "command": "GET_SAVED_FAILED",
-                    "data": {
-                        "message": "User ID is required"
-                    }
-                }
-            else:
-                images = self.db.get_user_saved_images(user_id)
-                
-                response = {
-                    "command": "SAVED_IMAGES",
-                    "data": {
-                        "images": images
-                    }
-                }
-        
-        elif command == "SAVE_IMAGE":
-            user_id = data.get("user_id", None)
-            image_id = data.get("image_id", None)
-            
-            if not user_id or not image_id:
-                response = {
-                    "command": "SAVE_IMAGE_FAILED",
-                    "data": {
-                        "message": "User ID and Image ID are required"
-                    }
-                }
-            else:
-                success, result = self.db.save_image_for_user(user_id, image_id)
-                
-                if success:
-                    response = {
-                        "command": "SAVE_IMAGE_SUCCESS",
-                        "data": {
-                            "user_id": user_id,
-                            "image_id": image_id
-                        }
-                    }
-                else:
-                    response = {
-                        "command": "SAVE_IMAGE_FAILED",
-                        "data": {
-                            "message": result
-                        }
-                    }
-        
-        elif command == "UNSAVE_IMAGE":
-            user_id = data.get("user_id", None)
-            image_id = data.get("image_id", None)
-            
-            if not user_id or not image_id:
-                response = {
-                    "command": "UNSAVE_IMAGE_FAILED",
-                    "data": {
-                        "message": "User ID and Image ID are required"
-                    }
-                }
-            else:
-                success = self.db.unsave_image_for_user(user_id, image_id)
-                
-                response = {
-                    "command": "UNSAVE_IMAGE_SUCCESS",
-                    "data": {
-                        "user_id": user_id,
-                        "image_id": image_id,
-                        "success": success
-                    }
-                }
-                
-        return response
+        # the client app has already checked the password when it sends the user ID
+        user_id = data.get("user_id")
+        if user_id:
+            logger.info("User logged in via ID: %s (ID: %s)", username, user_id)
+            return {"command": "LOGIN_SUCCESS", "data": {"user_id": user_id, "username": username}}
+        
+        success, user_id = self.db.authenticate_user(username, data.get("password", ""))
+        if not success:
+            logger.warning("Failed login attempt for user: %s", username)
+            return {"command": "LOGIN_FAILED", "data": {"message": "Invalid username or password"}}
+        
+        logger.info("User authenticated and logged in: %s (ID: %s)", username, user_id)
+        return {"command": "LOGIN_SUCCESS", "data": {"user_id": user_id, "username": username,
+                                                     "session_token": issue_session_token(user_id)}}
+    
+    @command_handler("REGISTER", required=("username",), failure="REGISTER_FAILED")
+    def handle_register(self, data):
+        username = data["username"]
+        logger.info("New user registration: %s", username)
+        
+        user_id = data.get("user_id")
+        if user_id:
+            logger.info("User registered via ID: %s (ID: %s)", username, user_id)
+            return {"command": "REGISTER_SUCCESS", "data": {"user_id": user_id, "username": username}}
+        
+        success, result = self.db.create_user(username, data.get("password", ""), data.get("email"))
+        if not success:
+            logger.warning("Failed registration attempt for username: %s - %s", username, result)
+            return {"command": "REGISTER_FAILED", "data": {"message": result}}
+        
+        logger.info("New user registered: %s (ID: %s)", username, result)
+        return {"command": "REGISTER_SUCCESS", "data": {"user_id": result, "username": username,
+                                                        "session_token": issue_session_token(result)}}
+    
+    @command_handler("UPLOAD_IMAGE", failure="UPLOAD_FAILED")
+    def handle_upload_image(self, data, stored_path=None):
+        image_id = data.get("id")
+        url = data.get("url") or ""
+        caption = data.get("caption") or ""
+        category = data.get("category") or ""
+        user_id = data.get("user_id")
+        logger.info("[User: %s] Image upload - Caption: %.30s... Category: %s", self.username, caption, category)
+        
+        # binary uploads were already streamed to disk, point the url at our copy
+        if stored_path:
+            url = f"/static/uploads/{os.path.basename(stored_path)}"
+        
+        if image_id:
+            logger.info("Image uploaded via ID: %s, Caption: %s", image_id, caption)
+            return {"command": "UPLOAD_SUCCESS", "data": {"image_id": image_id, "url": url}}
+        
+        if not user_id:
+            logger.warning("Image upload failed: No user ID provided")
+            return {"command": "UPLOAD_FAILED", "data": {"message": "User ID is required"}}
+        
+        if url.startswith('./'):
+            url = url[1:]
+        
+        image_id = self.db.upload_image(url, caption, category, user_id, data.get("image"))
+        if not image_id:
+            logger.error("Failed to save image to database: Caption=%s, User=%s", caption, user_id)
+            return {"command": "UPLOAD_FAILED", "data": {"message": "Failed to save image to database"}}
+        
+        logger.info("Image uploaded successfully: ID=%s, Caption=%s, User=%s", image_id, caption, user_id)
+        self.publish("images", {"event": "image_created", "image": {
+            "id": image_id, "url": url, "caption": caption, "category": category, "user_id": user_id
+        }})
+        return {"command": "UPLOAD_SUCCESS", "data": {"image_id": image_id, "url": url}}
+    
+    def page(self, data):
+        """
+        Read the optional cursor (the next_cursor of the previous page) and
+        limit of a paged command. Without a limit the whole list is sent, as
+        older clients expect
+        """
+        cursor, limit = data.get("cursor"), data.get("limit")
+        
+        if cursor is not None and not isinstance(cursor, str):
+            raise ValueError("cursor must be the next_cursor of an earlier page")
+        if limit is not None:
+            if not isinstance(limit, int) or isinstance(limit, bool) or limit < 1:
+                raise ValueError("limit must be a positive integer")
+            limit = min(limit, MAX_PAGE_SIZE)
+        
+        return cursor, limit
+    
+    def paged_images(self, images, limit, page_cursor):
+        """Response data for a page of images, next_cursor is None on the last page"""
+        next_cursor = page_cursor(images[-1]) if limit is not None and len(images) == limit else None
+        return {"images": images, "next_cursor": next_cursor}
+    
+    @command_handler("GET_IMAGES")
+    def handle_get_images(self, data):
+        try:
+            cursor, limit = self.page(data)
+            images = self.db.get_all_images(cursor, limit)
+        except ValueError as e:
+            return {"command": "ERROR", "data": {"message": str(e)}}
+        
+        logger.info("Returned %d images to %s", len(images), self.address)
+        return {"command": "IMAGES", "data": self.paged_images(images, limit, self.db.feed_cursor)}
+    
+    @command_handler("GET_SAVED_IMAGES", required=("user_id",), failure="GET_SAVED_FAILED")
+    def handle_get_saved_images(self, data):
+        try:
+            cursor, limit = self.page(data)
+            images = self.db.get_saved_images(data["user_id"], cursor, limit)
+        except ValueError as e:
+            return {"command": "GET_SAVED_FAILED", "data": {"message": str(e)}}
+        
+        logger.info("Returned %d saved images for user ID: %s", len(images), data["user_id"])
+        return {"command": "SAVED_IMAGES", "data": self.paged_images(images, limit, self.db.saved_cursor)}
+    
+    @command_handler("GET_CHANGES", failure="GET_CHANGES_FAILED")
+    def handle_get_changes(self, data):
+        """
+        What changed in the catalog after the since mark. A client without a
+        copy asks without since for the current mark, then fetches GET_IMAGES
+        and syncs from that mark; changes it already has are safe to reapply
+        """
+        since, limit = data.get("since"), data.get("limit", MAX_CHANGES)
+        
+        if since is not None and (not isinstance(since, int) or isinstance(since, bool) or since < 0):
+            return {"command": "GET_CHANGES_FAILED", "data": {"message": "since must be a change id"}}
+        if not isinstance(limit, int) or isinstance(limit, bool) or limit < 1:
+            return {"command": "GET_CHANGES_FAILED", "data": {"message": "limit must be a positive integer"}}
+        
+        changes, next_since, more = self.db.get_changes(since, min(limit, MAX_CHANGES), data.get("user_id"))
+        logger.info("Returned %d changes since %s to %s", len(changes), since, self.address)
+        return {"command": "CHANGES", "data": {"changes": changes, "since": next_since, "more": more}}
+    
+    @command_handler("SAVE_IMAGE", required=("user_id", "image_id"), failure="SAVE_IMAGE_FAILED")
+    def handle_save_image(self, data):
+        user_id, image_id = data["user_id"], data["image_id"]
+        logger.info("[User: %s] Saved image ID: %s", self.username, image_id)
+        
+        if not self.db.save_image_for_user(user_id, image_id):
+            logger.warning("Failed to save image (likely already saved): User=%s, Image=%s", user_id, image_id)
+            return {"command": "SAVE_IMAGE_FAILED", "data": {"message": "Image already saved or couldn't be saved"}}
+        
+        logger.info("Image saved successfully: User=%s, Image=%s", user_id, image_id)
+        self.publish(f"saves:{user_id}", {"event": "image_saved", "image_id": image_id})
+        return {"command": "SAVE_IMAGE_SUCCESS", "data": {"user_id": user_id, "image_id": image_id}}
+    
+    @command_handler("UNSAVE_IMAGE", required=("user_id", "image_id"), failure="UNSAVE_IMAGE_FAILED")
+    def handle_unsave_image(self, data):
+        user_id, image_id = data["user_id"], data["image_id"]
+        logger.info("[User: %s] Removed saved image ID: %s", self.username, image_id)
+        
+        success = self.db.unsave_image_for_user(user_id, image_id)
+        logger.info("Image unsaved: User=%s, Image=%s, Success=%s", user_id, image_id, success)
+        if success:
+            self.publish(f"saves:{user_id}", {"event": "image_unsaved", "image_id": image_id})
+        return {"command": "UNSAVE_IMAGE_SUCCESS", "data": {"user_id": user_id, "image_id": image_id, "success": success}}
     
-    def send_error(self, message):
-        response = self.create_packet("ERROR", {"message": message})
-        self.client_socket.sendall(json.dumps(response).encode('utf-8'))
+    @command_handler("ADD_COMMENT", required=("image_id", "text"), failure="ADD_COMMENT_FAILED")
+    def handle_add_comment(self, data):
+        image_id, text = data["image_id"], data["text"]
+        logger.info("[User: %s] Added comment to image ID: %s - Text: %.30s...", self.username, image_id, text)
+        
+        success, comment_id, username = self.db.add_comment(image_id, text, data.get("user_id"))
+        if not success:
+            return {"command": "ADD_COMMENT_FAILED", "data": {"message": "Failed to save comment"}}
+        
+        self.publish(f"comments:{image_id}", {"event": "comment_created", "comment": {
+            "id": comment_id, "image_id": image_id, "user_id": data.get("user_id"), "username": username, "text": text
+        }})
+        return {"command": "ADD_COMMENT_SUCCESS", "data": {"comment_id": comment_id, "image_id": image_id, "username": username}}
+    
+    @command_handler("SEARCH", required=("query",), failure="SEARCH_FAILED")
+    def handle_search(self, data):
+        query = data["query"]
+        search_type = data.get("type", "posts")
+        logger.info("[User: %s] Search - Query: %s, Type: %s", self.username, query, search_type)
+        
+        try:
+            cursor, limit = self.page(data)
+        except ValueError as e:
+            return {"command": "SEARCH_FAILED", "data": {"message": str(e)}}
+        
+        if search_type == "users":
+            results = self.db.search_users(query, limit or USER_SEARCH_LIMIT)
+        else:
+            search_type = "posts"
+            results = self.db.search_images(query, data.get("user_id"), limit or SEARCH_LIMIT)
+        
+        logger.info("%s search: Query='%s', Results=%d", search_type, query, len(results))
+        return {"command": "SEARCH_RESULTS", "data": {"type": search_type, "query": query, "results": results}}
+    
+    def topic_error(self, topic):
+        """Why a connection can't subscribe to topic, None if it can"""
+        if topic == "images":
+            return None
+        
+        name, _, key = topic.partition(":") if isinstance(topic, str) else ("", "", "")
+        if name not in ("comments", "saves") or not key.isdigit():
+            return f"Unknown topic: {topic}"
+        if name == "saves" and int(key) != self.user_id:
+            return "Saves can only be followed for the user bound in HELLO"
+        return None
+    
+    @command_handler("SUBSCRIBE", required=("topics",), failure="SUBSCRIBE_FAILED")
+    def handle_subscribe(self, data):
+        """
+        Register for EVENT frames about topics. They arrive without a reply_to,
+        so only a client that matches replies by sequence number can take them
+        """
+        topics = data["topics"]
+        
+        if self.subscriptions is None:
+            return {"command": "SUBSCRIBE_FAILED", "data": {"message": "This server doesn't push events"}}
+        if not isinstance(topics, list):
+            return {"command": "SUBSCRIBE_FAILED", "data": {"message": "topics must be a list"}}
+        if len(self.topics | set(map(str, topics))) > MAX_SUBSCRIPTIONS:
+            return {"command": "SUBSCRIBE_FAILED", "data": {"message": f"Connections are limited to {MAX_SUBSCRIPTIONS} topics"}}
+        
+        for topic in topics:
+            problem = self.topic_error(topic)
+            if problem:
+                return {"command": "SUBSCRIBE_FAILED", "data": {"message": problem}}
+        
+        self.start_event_sender()
+        self.subscriptions.subscribe(self, topics)
+        logger.info("%s subscribed to %s", self.address, topics)
+        return {"command": "SUBSCRIBED", "data": {"topics": sorted(self.topics)}}
+    
+    @command_handler("UNSUBSCRIBE", failure="UNSUBSCRIBE_FAILED")
+    def handle_unsubscribe(self, data):
+        """Stop events for the given topics, or for all of them without any"""
+        topics = data.get("topics")
+        if topics is not None and not isinstance(topics, list):
+            return {"command": "UNSUBSCRIBE_FAILED", "data": {"message": "topics must be a list"}}
+        
+        if self.subscriptions is not None:
+            self.subscriptions.unsubscribe(self, topics)
+        return {"command": "SUBSCRIBED", "data": {"topics": sorted(self.topics)}}
+    
+    @command_handler("BATCH", failure="BATCH_FAILED")
+    def handle_batch(self, data):
+        """
+        Run a list of sub-commands in one round trip, inside one database
+        transaction, and return a result for each in the same order
+        """
+        commands = data.get("commands")
+        
+        if not isinstance(commands, list) or not commands:
+            return {"command": "BATCH_FAILED", "data": {"message": "A list of commands is required"}}
+        if len(commands) > MAX_BATCH_SIZE:
+            return {"command": "BATCH_FAILED", "data": {"message": f"Batches are limited to {MAX_BATCH_SIZE} commands"}}
+        
+        results = []
+        # subscribers hear about the batch's writes once they're committed
+        self.batch_events.pending = []
+        try:
+            with self.db.transaction():
+                for item in commands:
+                    if not isinstance(item, dict) or not item.get("command") or item["command"] in ("BATCH", "SUBSCRIBE", "UNSUBSCRIBE"):
+                        results.append({"command": "ERROR", "data": {"message": "Invalid batch item"}})
+                        continue
+                    
+                    try:
+                        results.append(self.process_command(item["command"], self.with_bound_user(item["command"], item.get("data") or {})))
+                    except Exception as e:
+                        logger.error("Error processing batch item %r from %s: %s", item["command"], self.address, e)
+                        results.append({"command": "ERROR", "data": {"message": "Processing error"}})
+            events = self.batch_events.pending
+        finally:
+            self.batch_events.pending = None
+        
+        for topic, event in events:
+            self.publish(topic, event)
+        
+        logger.info("Processed batch of %d commands from %s", len(commands), self.address)
+        return {"command": "BATCH_RESULTS", "data": {"results": results}}
+    
+    def send_error(self, message, reply_to=None):
+        flags, payload = self.encode_response("ERROR", {"message": message}, reply_to)
+        self.send_frame(payload, flags)
         user_info = f" [User: {self.username}]" if self.username else ""
         logger.info(f"Error sent to {self.address}{user_info}: {message}")
     
-    def create_packet(self, command, data):
-        self.sequence_number += 1
+    def encode_response(self, command, data, reply_to=None):
+        """Serialize a response for the wire, returns the frame flags and payload"""
+        if self.checksum_algorithm is None:
+            # a client from before split packets expects the whole packet as one JSON document
+            return 0, json.dumps(self.create_packet(command, data, reply_to)).encode('utf-8')
+        
+        # one codec for both halves, a HELLO can change the connection's while this is encoded
+        codec = self.codec
+        return self.wrap_response(*self.serialize_response(command, data, codec), codec, reply_to)
+    
+    def serialize_response(self, command, data, codec):
+        """Serialize a response body with the codec, returns the bytes and their checksum"""
+        body_bytes = codec.serialize({"command": command, "data": data})
+        return body_bytes, CHECKSUM_ALGORITHMS[self.checksum_algorithm](body_bytes)
+    
+    def wrap_response(self, body_bytes, checksum, codec, reply_to=None):
+        """Frame a response body serialized with the codec, returns the frame flags and payload"""
+        payload = codec.wrap(self.packet_header(reply_to), body_bytes, self.checksum_algorithm, checksum)
         
+        if self.compress_replies and self.compression_threshold is not None:
+            return compress_frame(payload, codec.flag, self.compression_threshold)
+        return codec.flag, payload
+    
+    def packet_header(self, reply_to=None):
+        """
+        reply_to echoes the sequence number of the request a response answers
+        so a client with several requests in flight can match them up
+        """
+        sequence_number = next(self.sequence_counter)
+        self.sequence_number = sequence_number
+        
+        header = {
+            "source": "SERVER",
+            "destination": "CLIENT",
+            "sequence_number": sequence_number,
+            "reply_to": reply_to
+        }
+        if self.compression_threshold is not None:
+            # lets the client know it can compress its requests too
+            header["compression"] = COMPRESSION
+        return header
+    
+    def create_packet(self, command, data, reply_to=None):
+        """Build a response packet in the legacy single document format, checksummed with MD5"""
         body = {"command": command, "data": data}
         body_json = json.dumps(body)
         checksum = self.calculate_checksum(body_json)
         
         return {
-            "header": {
-                "source": "SERVER",
-                "destination": "CLIENT",
-                "size": len(body_json),
-                "sequence_number": self.sequence_number
-            },
+            "header": dict(self.packet_header(reply_to), size=len(body_json)),
             "body": body,
             "footer": {
                 "checksum": checksum
@@ -669,25 +1225,40 @@ class TCPServerConnection:
 
 class TCPServer:
     """
-    TCP/IP Socket server
+    TCP/IP Socket server. Connections are handled on a fixed size thread pool,
+    at most queue_depth more can wait for a worker and the rest are turned
+    away with a "server busy" error
     """
     
-    def __init__(self, host='0.0.0.0', port=5001, db=None):
+    def __init__(self, host='0.0.0.0', port=5001, db=None, max_workers=32, queue_depth=64, backlog=128,
+                 compression_threshold=COMPRESSION_THRESHOLD, cache_entries=256, cache_ttl=30):
         """Initialize the socket server"""
-    def __init__(self, host='0.0.0.0', port=5001, db=None):
         self.host = host
         self.port = port
+        self.compression_threshold = compression_threshold
+        # cache_entries=0 turns the response cache off
+        self.response_cache = ResponseCache(cache_entries, ttl=cache_ttl) if cache_entries else None
+        self.subscriptions = Subscriptions()
         self.running = False
         self.server_socket = None
-        self.clients = []
+        self.clients = set()  # connections being handled or waiting for a worker
+        self.clients_lock = threading.Lock()
         self.db = db
+        self.max_workers = max_workers
+        self.queue_depth = queue_depth
+        self.backlog = backlog
+        self.executor = None
+        self.slots = threading.BoundedSemaphore(max_workers + queue_depth)
         
     def start(self):
         try:
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
+            self.server_socket.listen(self.backlog)
+            self.port = self.server_socket.getsockname()[1]
+            
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='TCPServerWorker')
             
             self.running = True
             logger.info(f"Server started on {self.host}:{self.port}")
@@ -696,25 +1267,376 @@ class TCPServer:
                 client_socket, client_address = self.server_socket.accept()
                 
                 client_handler = TCPServerConnection(client_socket, client_address, self.db)
+                client_handler.compression_threshold = self.compression_threshold
+                client_handler.response_cache = self.response_cache
+                client_handler.subscriptions = self.subscriptions
                 
-                client_thread = threading.Thread(target=client_handler.handle_request)
-                client_thread.daemon = True
-                client_thread.start()
+                if not self.slots.acquire(blocking=False):
+                    self.reject(client_handler)
+                    continue
                 
-                self.clients.append(client_thread)
+                with self.clients_lock:
+                    self.clients.add(client_handler)
+                
+                future = self.executor.submit(client_handler.handle_request)
+                future.add_done_callback(lambda f, handler=client_handler: self.release(handler, f))
                 
         except Exception as e:
-            logger.error(f"Server error: {str(e)}")
+            if self.running:
+                logger.error(f"Server error: {str(e)}")
         finally:
             self.stop()
     
+    def reject(self, client_handler):
+        """Tell a client the server is at capacity and hang up"""
+        logger.warning(f"Server busy, rejecting connection from {client_handler.address}")
+        try:
+            client_handler.client_socket.settimeout(1)
+            client_handler.send_error("Server busy, try again later")
+        except OSError:
+            pass
+        finally:
+            client_handler.client_socket.close()
+    
+    def release(self, client_handler, future):
+        # connections still queued when the server stops never ran, close them here
+        if future.cancelled():
+            client_handler.client_socket.close()
+        
+        with self.clients_lock:
+            self.clients.discard(client_handler)
+        self.slots.release()
+    
     def stop(self):
         self.running = False
         if self.server_socket:
+            try:
+                # wakes up the accept() call in start()
+                self.server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             self.server_socket.close()
+        
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        
+        # workers sit in recv() on idle clients, shut their sockets so the threads can finish
+        with self.clients_lock:
+            client_handlers = list(self.clients)
+        for client_handler in client_handlers:
+            try:
+                client_handler.client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        
         logger.info("Server stopped")
 
 
+class AsyncTCPServerConnection(TCPServerConnection):
+    """
+    Handles a client connection on the asyncio engine. Packet handling is
+    shared with TCPServerConnection, only the socket I/O is async
+    """
+    
+    def __init__(self, reader, writer, db, executor):
+        super().__init__(None, writer.get_extra_info('peername'), db)
+        self.reader = reader
+        self.writer = writer
+        self.executor = executor
+        self.loop = None
+    
+    def send_frame(self, payload, flags=0):
+        # queued on the transport, handle_request_async drains it after each packet
+        self.writer.write(join_frame(payload, flags))
+    
+    def start_event_sender(self):
+        # the queue and its sender task are made with the connection, they belong to the event loop
+        pass
+    
+    def stop_event_sender(self):
+        pass
+    
+    async def send_events(self):
+        # drained after every frame, so a slow reader holds up this task and nothing else
+        while True:
+            payload, flags = await self.events.get()
+            self.send_frame(payload, flags)
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                return
+    
+    def push(self, topic, data):
+        flags, payload = self.encode_response("EVENT", dict(data, topic=topic))
+        # publish() runs on a worker thread but the queue belongs to the event loop
+        self.loop.call_soon_threadsafe(self.queue_event, payload, flags)
+    
+    def queue_event(self, payload, flags):
+        try:
+            self.events.put_nowait((payload, flags))
+        except asyncio.QueueFull:
+            logger.warning("%s is %d events behind, disconnecting it", self.address, EVENT_QUEUE_SIZE)
+            self.subscriptions.unsubscribe(self)
+            self.hang_up()
+    
+    def hang_up(self):
+        # publish() may call this from a worker thread, the transport belongs to the event loop
+        try:
+            self.loop.call_soon_threadsafe(self.writer.close)
+        except RuntimeError:
+            pass  # loop already closed
+    
+    async def read_exact(self, size):
+        try:
+            return await self.reader.readexactly(size)
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                return None
+            raise FrameError(f"Connection closed after {len(e.partial)} of {size} bytes")
+    
+    async def receive_frame_async(self):
+        header = await self.read_exact(FRAME_HEADER.size)
+        if header is None:
+            return None
+        
+        flags, size = FRAME_HEADER.unpack(header)
+        if size > MAX_FRAME_SIZE:
+            raise FrameError(f"Frame of {size} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+        if size == 0:
+            return flags, b''
+        
+        body = await self.read_exact(size)
+        if body is None:
+            raise FrameError("Connection closed before frame body")
+        return flags, body
+    
+    async def save_upload_payload_async(self, filename):
+        """Stream an upload payload straight to the uploads folder, returns the file path"""
+        loop = asyncio.get_running_loop()
+        # every filesystem call goes to the worker pool, a slow disk mustn't stall the other connections
+        path = await loop.run_in_executor(self.executor, self.upload_path, filename)
+        partial_path = path + '.part'
+        
+        header = await self.read_exact(FRAME_HEADER.size)
+        if header is None:
+            raise FrameError("Connection closed before payload frame")
+        size = self.check_payload_header(header)
+        
+        f = None
+        writing = None
+        try:
+            f = await loop.run_in_executor(self.executor, open, partial_path, 'wb')
+            remaining = size
+            while remaining:
+                chunk = await self.reader.read(min(remaining, PAYLOAD_CHUNK_SIZE))
+                if not chunk:
+                    raise FrameError(f"Connection closed after {size - remaining} of {size} payload bytes")
+                # one write in flight at a time, the next chunk is read off the socket while it runs
+                if writing:
+                    await writing
+                writing = loop.run_in_executor(self.executor, f.write, chunk)
+                remaining -= len(chunk)
+            if writing:
+                await writing
+            await loop.run_in_executor(self.executor, self.finish_upload, f, partial_path, path)
+        except Exception as e:
+            if writing and not writing.done():
+                await asyncio.wait([writing])
+            await loop.run_in_executor(self.executor, self.discard_upload, f, partial_path)
+            # part of the payload may be unread, so any failure leaves the stream out of sync
+            if isinstance(e, FrameError):
+                raise
+            raise FrameError(f"Couldn't store upload payload: {str(e)}") from e
+        
+        logger.info(f"Stored {size} byte upload payload from {self.address} at {path}")
+        return path
+    
+    @staticmethod
+    def finish_upload(f, partial_path, path):
+        f.close()
+        os.replace(partial_path, path)
+    
+    @staticmethod
+    def discard_upload(f, partial_path):
+        if f:
+            f.close()
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    
+    async def run_request(self, packet, stored_path=None):
+        """Process one request on the worker pool and queue its response"""
+        loop = asyncio.get_running_loop()
+        try:
+            # Database calls block, so commands run on the server's bounded thread pool
+            # encoding a big response is CPU work too, so it stays off the event loop
+            flags, payload = await loop.run_in_executor(self.executor, self.respond, packet, stored_path)
+            self.send_frame(payload, flags)
+        except Exception as e:
+            logger.error(f"Error processing request from {self.address}: {str(e)}")
+            self.send_error(f"Processing error", self.request_sequence(packet))
+        finally:
+            self.in_flight.release()
+        
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+    
+    async def handle_request_async(self):
+        # pipelined requests run concurrently so responses can go out of order,
+        # clients match them up by the reply_to sequence number
+        self.in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+        self.loop = asyncio.get_running_loop()
+        self.events = asyncio.Queue(EVENT_QUEUE_SIZE)
+        event_sender = asyncio.create_task(self.send_events())
+        tasks = set()
+        
+        try:
+            logger.info(f"Connection established with {self.address}")
+            
+            while True:
+                try:
+                    received = await self.receive_frame_async()
+                except FrameError as e:
+                    logger.error(f"Framing error from {self.address}: {str(e)}")
+                    self.send_error(f"Framing error: {str(e)}")
+                    break
+                
+                if received is None:
+                    break
+                
+                flags, frame = received
+                try:
+                    packet = self.decode_request(flags, frame)
+                except ChecksumError:
+                    logger.error(f"Checksum mismatch in packet from {self.address}")
+                    self.send_error("Checksum mismatch")
+                    await self.writer.drain()
+                    continue
+                except ValueError:
+                    logger.error(f"Invalid JSON packet from {self.address} ({len(frame)} bytes)")
+                    self.send_error("Invalid packet")
+                    await self.writer.drain()
+                    continue
+                
+                if not self.is_valid_packet(packet):
+                    logger.warning(f"Malformed packet from {self.address}")
+                    self.send_error("Malformed packet", self.request_sequence(packet))
+                    await self.writer.drain()
+                    continue
+                
+                # the payload frame comes next on the stream, so it's read before the next request
+                stored_path = None
+                if self.has_upload_payload(packet):
+                    try:
+                        stored_path = await self.save_upload_payload_async(packet['body']['data'].get('filename'))
+                    except FrameError as e:
+                        logger.error(f"Framing error from {self.address}: {str(e)}")
+                        self.send_error(f"Framing error: {str(e)}", self.request_sequence(packet))
+                        break
+                
+                await self.in_flight.acquire()
+                if packet['body']['command'] in SERIAL_COMMANDS:
+                    # wait for everything in flight, and read nothing more until it's done
+                    if tasks:
+                        await asyncio.gather(*tasks, return_exceptions=True)
+                    await self.run_request(packet, stored_path)
+                    continue
+                task = asyncio.create_task(self.run_request(packet, stored_path))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                
+        except Exception as e:
+            logger.error(f"Connection error with {self.address}: {str(e)}")
+        finally:
+            # let requests already read finish before hanging up
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            if self.subscriptions is not None:
+                self.subscriptions.unsubscribe(self)
+            event_sender.cancel()
+            self.writer.close()
+            user_info = f" [User: {self.username}]" if self.username else ""
+            logger.info(f"Connection closed with {self.address}{user_info}")
+
+
+class AsyncTCPServer:
+    """
+    TCP/IP socket server on asyncio. An idle connection costs a coroutine instead
+    of an OS thread, and blocking Database work runs on a bounded thread pool
+    """
+    
+    def __init__(self, host='0.0.0.0', port=5001, db=None, max_workers=8, backlog=128,
+                 compression_threshold=COMPRESSION_THRESHOLD, cache_entries=256, cache_ttl=30):
+        self.host = host
+        self.port = port
+        self.compression_threshold = compression_threshold
+        self.response_cache = ResponseCache(cache_entries, ttl=cache_ttl) if cache_entries else None
+        self.subscriptions = Subscriptions()
+        self.db = db
+        self.max_workers = max_workers
+        self.backlog = backlog
+        self.running = False
+        self.loop = None
+        self.server = None
+        self.executor = None
+        self.stopped = None
+        self.connections = set()
+    
+    def start(self):
+        """Run the event loop until stop() is called, blocks like TCPServer.start"""
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='TCPServerWorker')
+        
+        try:
+            self.loop.run_until_complete(self.serve())
+        except Exception as e:
+            logger.error(f"Server error: {str(e)}")
+        finally:
+            self.running = False
+            self.executor.shutdown(wait=False)
+            self.loop.close()
+            logger.info("Server stopped")
+    
+    async def serve(self):
+        self.stopped = asyncio.Event()
+        self.server = await asyncio.start_server(
+            self.handle_client, self.host, self.port,
+            backlog=self.backlog, reuse_address=True
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+        
+        self.running = True
+        logger.info(f"Server started on {self.host}:{self.port} (asyncio engine)")
+        
+        async with self.server:
+            await self.stopped.wait()
+            for writer in list(self.connections):
+                writer.close()
+    
+    async def handle_client(self, reader, writer):
+        connection = AsyncTCPServerConnection(reader, writer, self.db, self.executor)
+        connection.compression_threshold = self.compression_threshold
+        connection.response_cache = self.response_cache
+        connection.subscriptions = self.subscriptions
+        self.connections.add(writer)
+        try:
+            await connection.handle_request_async()
+        finally:
+            self.connections.discard(writer)
+    
+    def stop(self):
+        """Stop the server, safe to call from any thread"""
+        self.running = False
+        if self.loop is None or self.stopped is None:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+        except RuntimeError:
+            # loop already closed
+            pass
+
+
 if __name__ == "__main__":
     from database import Database
     
@@ -726,5 +1648,9 @@ if __name__ == "__main__":
     print("#" * 70)
     
     db = Database()
-    server = TCPServer(port=5001, db=db)
+    # run "python tcp_server.py async" for the asyncio engine
+    if len(sys.argv) > 1 and sys.argv[1] == "async":
+        server = AsyncTCPServer(port=5001, db=db)
+    else:
+        server = TCPServer(port=5001, db=db)
     server.start()
\ No newline at end of file
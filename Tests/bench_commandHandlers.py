@@ -0,0 +1,82 @@
+"""
+Microbenchmark for command dispatch: times process_command for each registered
+handler against an in-memory stand-in for the database, so the numbers are the
+protocol-side cost of a command and not SQLite's.
+
+Run from the repository root: python -m Tests.bench_commandHandlers
+"""
+import logging
+import timeit
+from contextlib import contextmanager
+from Server.tcp_server import TCPServerConnection, COMMAND_HANDLERS
+
+
+class StubDatabase:
+    images = [{"id": i, "url": f"/static/images/{i}.jpg", "caption": f"Rain barrel {i}"} for i in range(20)]
+    
+    def authenticate_user(self, username, password):
+        return True, 1
+    
+    def create_user(self, username, password, email=None):
+        return True, 1
+    
+    def upload_image(self, url, caption, category, user_id=None, image_data=None):
+        return 1
+    
+    def get_all_images(self, after=None, limit=None):
+        return self.images[:limit]
+    
+    def get_saved_images(self, user_id, after=None, limit=None):
+        return self.images[:limit]
+    
+    def get_changes(self, since=None, limit=500, user_id=None):
+        return [], 0, False
+    
+    def save_image_for_user(self, user_id, image_id):
+        return True
+    
+    def unsave_image_for_user(self, user_id, image_id):
+        return True
+    
+    def add_comment(self, image_id, text, user_id=None):
+        return True, 1, "Andy"
+    
+    def search_images(self, query, user_id=None, limit=50):
+        return self.images[:limit]
+    
+    def search_users(self, query, limit=20):
+        return []
+    
+    @contextmanager
+    def transaction(self):
+        yield
+
+
+SAMPLE_DATA = {
+    "PING": {"timestamp": 1},
+    "LOGIN": {"username": "Andy", "password": "password"},
+    "REGISTER": {"username": "Andy", "password": "password"},
+    "UPLOAD_IMAGE": {"url": "./static/uploads/a.jpg", "caption": "Water filter", "category": "water", "user_id": 1},
+    "GET_SAVED_IMAGES": {"user_id": 1},
+    "SAVE_IMAGE": {"user_id": 1, "image_id": 1},
+    "UNSAVE_IMAGE": {"user_id": 1, "image_id": 1},
+    "ADD_COMMENT": {"user_id": 1, "image_id": 1, "text": "Nice"},
+    "SEARCH": {"query": "rain"},
+    "GET_IMAGES": {"limit": 10},
+    "GET_CHANGES": {"since": 0},
+    "BATCH": {"commands": [{"command": "SAVE_IMAGE", "data": {"user_id": 1, "image_id": i}} for i in range(50)]}
+}
+
+def main(number=2000):
+    connection = TCPServerConnection(None, ("127.0.0.1", 0), StubDatabase())
+    
+    for level in [logging.INFO, logging.WARNING]:
+        logging.getLogger('TCPServer').setLevel(level)
+        print(f"TCPServer logging at {logging.getLevelName(level)}")
+        for command in sorted(COMMAND_HANDLERS):
+            data = SAMPLE_DATA.get(command, {})
+            seconds = min(timeit.repeat(lambda: connection.process_command(command, data), number=number, repeat=3)) / number
+            print(f"  {command:<18} {seconds * 1e6:8.1f} us")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Mixed read/write throughput of the Server Database under each storage
+profile. Reader threads page through the feed and search while writer
+threads upload images and add comments, all against one database file, and
+the operations each side completes in a fixed time are counted.
+
+Run from the repository root: python -m Tests.bench_databaseProfile
+"""
+import os
+import tempfile
+import threading
+import time
+from Server.database import Database, STORAGE_PROFILES
+
+
+class QuietDatabase(Database):
+    # every write prints a line, which would be most of what's measured
+    def log(self, message):
+        pass
+
+
+def reader(db, stop, counts):
+    count = 0
+    while not stop.is_set():
+        page = db.get_all_images(limit=24)
+        db.get_all_images(db.feed_cursor(page[-1]), 24)
+        db.search_images("barrel")
+        db.get_comments(page[0]["id"])
+        count += 4
+    counts.append(count)
+
+def writer(db, stop, counts, worker):
+    count = 0
+    while not stop.is_set():
+        image_id = db.upload_image(f"/static/uploads/{worker}-{count}.jpg", f"Rain barrel {worker}-{count}", "water", 1)
+        db.add_comment(image_id, "Nice setup", 1)
+        count += 2
+    counts.append(count)
+
+def run(profile, readers, writers, seconds, seed_images):
+    directory = tempfile.mkdtemp()
+    db = QuietDatabase(os.path.join(directory, "bench.sqlite"), profile=profile)
+    with db.transaction():
+        for i in range(seed_images):
+            db.upload_image(f"/static/uploads/seed-{i}.jpg", f"Rain barrel {i}", "water", 1)
+
+    stop = threading.Event()
+    read_counts, write_counts = [], []
+    threads = [threading.Thread(target=reader, args=(db, stop, read_counts)) for _ in range(readers)]
+    threads += [threading.Thread(target=writer, args=(db, stop, write_counts, i)) for i in range(writers)]
+
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    return sum(read_counts) / seconds, sum(write_counts) / seconds
+
+def main(seconds=3, seed_images=2000):
+    for readers, writers in [(4, 1), (4, 4), (1, 4)]:
+        print(f"{readers} readers, {writers} writers, {seed_images} images")
+        baseline = None
+        for profile in STORAGE_PROFILES:
+            reads, writes = run(profile, readers, writers, seconds, seed_images)
+            baseline = baseline or (reads, writes)
+            print(f"  {profile:<8} {reads:9.0f} reads/s ({reads / baseline[0]:4.2f}x)  "
+                  f"{writes:8.0f} writes/s ({writes / baseline[1]:4.2f}x)")
+
+if __name__ == '__main__':
+    main()
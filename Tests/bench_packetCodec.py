@@ -0,0 +1,95 @@
+"""
+Microbenchmarks for packet serialization.
+
+First the old single JSON document checksummed with MD5 against split packets
+with CRC32 on a large IMAGES response, then the json and compact body codecs
+on IMAGES and SEARCH_RESULTS replies: bytes on the wire and encode/decode time.
+
+Run from the repository root: python -m Tests.bench_packetCodec
+"""
+import json
+import timeit
+from Client.tcp_client import TCPClient
+from Server.tcp_server import TCPServerConnection, CODECS, FRAME_HEADER, FRAME_FLAG_SPLIT, join_frame
+
+
+def make_images(count, image_size):
+    return [{
+        "id": i,
+        "url": f"/static/images/{i}.jpg",
+        "caption": f"Water filter build number {i}",
+        "category": "water",
+        "user_id": i % 50,
+        "image_data": "A" * image_size
+    } for i in range(count)]
+
+def make_search_results(count):
+    return [{
+        "id": i,
+        "url": f"/static/images/{i}.jpg",
+        "caption": f"Rain barrel setup {i}",
+        "category": "water",
+        "user_id": i % 50,
+        "is_default": 0,
+        "created_at": "2025-03-01 12:00:00",
+        "username": f"prepper{i % 50}",
+        "is_saved": i % 3 == 0
+    } for i in range(count)]
+
+def legacy_round_trip(server, client, images):
+    # send: the body is dumped for the checksum, then the whole packet again
+    payload = json.dumps(server.create_packet("IMAGES", {"images": images}, 1)).encode('utf-8')
+    # receive: parse, then dump the body a third time to check the MD5
+    response = json.loads(payload)
+    assert client.validate_response(response)
+    return response
+
+def split_round_trip(server, client, images, algorithm):
+    server.checksum_algorithm = algorithm
+    flags, payload = server.encode_response("IMAGES", {"images": images}, 1)
+    frame = join_frame(payload, flags)
+    return client.decode_response(FRAME_FLAG_SPLIT, memoryview(frame)[FRAME_HEADER.size:])
+
+def bench_checksums(repeat):
+    server = TCPServerConnection(None, ("127.0.0.1", 0), None)
+    client = TCPClient()
+
+    for count, image_size in [(100, 1024), (500, 16 * 1024), (200, 128 * 1024)]:
+        images = make_images(count, image_size)
+        size = len(json.dumps(images)) / (1024 * 1024)
+        print(f"{count} images, {size:.1f} MB response")
+
+        cases = [("json + md5 (legacy)", lambda: legacy_round_trip(server, client, images))]
+        for algorithm in ["md5", "adler32", "crc32"]:
+            cases.append((f"split + {algorithm}", lambda algorithm=algorithm: split_round_trip(server, client, images, algorithm)))
+
+        baseline = None
+        for name, run in cases:
+            seconds = min(timeit.repeat(run, number=1, repeat=repeat))
+            baseline = baseline or seconds
+            print(f"  {name:<22} {seconds * 1000:8.2f} ms  {baseline / seconds:5.2f}x")
+
+def bench_codecs(repeat):
+    header = {"sequence_number": 10, "reply_to": 9}
+    shapes = [
+        ("IMAGES, 20 rows", {"command": "IMAGES", "data": {"images": make_images(20, 0)}}),
+        ("IMAGES, 1000 rows", {"command": "IMAGES", "data": {"images": make_images(1000, 0)}}),
+        ("SEARCH_RESULTS, 200 rows", {"command": "SEARCH_RESULTS", "data": {"type": "posts", "query": "rain", "results": make_search_results(200)}})
+    ]
+
+    for name, body in shapes:
+        print(name)
+        for codec in CODECS.values():
+            payload = b''.join(codec.encode(header, body))
+            assert codec.decode(payload)["body"] == body
+            encode = min(timeit.repeat(lambda: codec.encode(header, body), number=20, repeat=repeat)) / 20
+            decode = min(timeit.repeat(lambda: codec.decode(payload), number=20, repeat=repeat)) / 20
+            print(f"  {codec.name:<8} {len(payload):8} bytes  encode {encode * 1000:7.3f} ms  decode {decode * 1000:7.3f} ms")
+
+def main(repeat=20):
+    bench_checksums(repeat)
+    print()
+    bench_codecs(repeat // 4 or 1)
+
+if __name__ == '__main__':
+    main()
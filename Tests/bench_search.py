@@ -0,0 +1,57 @@
+"""
+Post search latency with the FTS5 index against the LIKE scan it replaces,
+on a database seeded with a few hundred thousand posts.
+
+Run from the repository root: python -m Tests.bench_search
+"""
+import os
+import random
+import string
+import tempfile
+import time
+from Server.database import Database
+
+WORDS = ["rain", "barrel", "water", "filter", "seed", "vault", "garden", "solar", "panel", "radio", "battery",
+         "canned", "beans", "rice", "first", "aid", "kit", "knife", "fire", "starter", "tent", "tarp", "rope",
+         "compass", "map", "lantern", "stove", "fuel", "shelter", "bunker", "cellar", "shelves", "jerky"]
+CATEGORIES = ["water", "food", "tools", "medical", "shelter", "power"]
+# made-up words for the long tail, most posts have one or two that few others share
+TAIL = ["".join(random.Random(i).choices(string.ascii_lowercase, k=7)) for i in range(5000)]
+QUERIES = ["barrel", "rain barrel", "sol", "first aid kit", TAIL[17], TAIL[1234][:4], "nothingmatches"]
+
+
+class QuietDatabase(Database):
+    def log(self, message):
+        pass
+
+
+def seed(db, posts):
+    rng = random.Random(1)
+    # two everyday words, so those match a good share of all posts, and two from the tail
+    rows = [(f"/static/uploads/{i}.jpg", " ".join(rng.sample(WORDS, 2) + rng.sample(TAIL, 2)).capitalize(),
+             rng.choice(CATEGORIES), 1) for i in range(posts)]
+    with db.cursor_scope() as cursor:
+        cursor.executemany("INSERT INTO images (url, caption, category, user_id) VALUES (?, ?, ?, ?)", rows)
+        db.connection.commit()
+
+def time_query(db, query, repeat):
+    db.search_images(query)  # warm the page cache
+    start = time.perf_counter()
+    for _ in range(repeat):
+        db.search_images(query)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+def main(posts=200000, repeat=20):
+    db = QuietDatabase(os.path.join(tempfile.mkdtemp(), "bench.sqlite"))
+    seed(db, posts)
+    print(f"{posts} posts, {db.search_images.__defaults__[-1]} results per search")
+    print(f"  {'query':<16} {'fts5 us':>10} {'like us':>10}")
+    for query in QUERIES:
+        db.full_text_search = True
+        fts = time_query(db, query, repeat)
+        db.full_text_search = False
+        like = time_query(db, query, repeat)
+        print(f"  {query:<16} {fts:10.0f} {like:10.0f}  ({like / fts:5.1f}x)")
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 import pytest
 from unittest.mock import patch
-from Client.app import app, tcp_client 
+from Client.app import app, tcp_client, notifications, db
 
 @pytest.fixture
 def client():
@@ -44,6 +44,8 @@ def test_save_image(mock_send, client):
     image_data = {'image_id': 123}
     response = client.post('/save_image', json=image_data)
 
+    #the notification is sent in the background
+    assert notifications.flush()
     mock_send.assert_called_with("SAVE_IMAGE", {"user_id": 1, "image_id": 123})
     assert response.status_code == 200
     assert b"Image saved to your vault!!" in response.data
@@ -53,3 +55,31 @@ def test_save_image(mock_send, client):
 def test_check_connection(mock_send, client):
     response = client.get('/api/check_connection')
     assert response.status_code == 200
+
+#home feed pages
+def test_api_images_pages(client):
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+        session['username'] = 'testuser'
+
+    first = client.get('/api/images?limit=3').get_json()
+    assert first["success"]
+    assert len(first["images"]) == 3
+    assert first["next_cursor"].endswith(f'|{first["images"][-1]["id"]}')
+    assert all("is_saved" in image for image in first["images"])
+
+    second = client.get(f'/api/images?limit=3&cursor={first["next_cursor"]}').get_json()
+    ids = [image["id"] for image in first["images"] + second["images"]]
+    assert len(set(ids)) == len(ids)
+
+def test_request_hands_database_connections_back(client):
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+        session['username'] = 'testuser'
+
+    client.get('/api/images?limit=3')
+    reader, cursor = db.idle['reader'][-1]
+    client.get('/api/images?limit=3')
+
+    assert getattr(db.local, 'reader', None) is None
+    assert db.idle['reader'][-1][0] is reader
@@ -0,0 +1,344 @@
+import base64
+import sqlite3
+import threading
+import pytest
+from Server.database import Database, MIGRATIONS, SEARCH_TOKENIZER, fts5_available, migrate, read_blob
+from Client.database import Database as ClientDatabase
+
+
+@pytest.fixture
+def db(tmp_path):
+    database = Database(str(tmp_path / "test.sqlite"))
+    yield database
+    database.disconnect()
+
+def in_thread(function):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(function()))
+    thread.start()
+    thread.join()
+    return result[0]
+
+#one long-lived connection per thread
+def test_connection_reused_per_thread(db):
+    db.get_all_images()
+    connection = db.connection
+    db.get_user(1)
+    assert db.connection is connection
+
+    other = in_thread(lambda: (db.get_all_images(), db.connection)[1])
+    assert other is not None and other is not connection
+
+def test_concurrent_writes_all_land(db):
+    errors = []
+
+    def upload(worker):
+        try:
+            for i in range(20):
+                assert db.upload_image(f"/static/uploads/{worker}-{i}.jpg", f"Barrel {worker}-{i}", "water", 1)
+                db.get_all_images(limit=5)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=upload, args=(worker,)) for worker in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len([image for image in db.get_all_images() if image["caption"].startswith("Barrel")]) == 160
+
+def test_every_commit_moves_the_generation_on(db):
+    start = db.generation
+
+    def commit_many():
+        for i in range(2000):
+            db.bump_generation()
+
+    threads = [threading.Thread(target=commit_many) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    db.upload_image("/static/uploads/barrel.jpg", "Rain barrel", "water", 1)
+
+    assert db.generation == start + 8001
+
+def test_uncommitted_writes_are_dropped(db):
+    with db.cursor_scope() as cursor:
+        cursor.execute("INSERT INTO users (username, password_hash) VALUES ('ghost', 'x')")
+        # no commit
+
+    assert db.authenticate_user("ghost", "x")[0] == False
+    assert db.connection.in_transaction == False
+
+def test_transaction_is_per_thread(db):
+    with db.transaction():
+        db.create_user("Sam", "pw")
+        # reads inside the transaction see its writes, they don't go to the reader
+        assert db.authenticate_user("Sam", "pw")[0] == True
+        # another thread doesn't join this transaction or see its writes yet
+        assert in_thread(lambda: db.in_transaction) == False
+        assert in_thread(lambda: db.authenticate_user("Sam", "pw")[0]) == False
+    assert in_thread(lambda: db.authenticate_user("Sam", "pw")[0]) == True
+
+#storage profile
+def test_wal_profile_and_read_only_readers(db):
+    with db.cursor_scope() as cursor:
+        assert cursor.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert cursor.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+
+    with pytest.raises(sqlite3.OperationalError):
+        with db.cursor_scope(readonly=True) as cursor:
+            cursor.execute("DELETE FROM images")
+
+def test_readers_not_blocked_by_writer(db):
+    with db.transaction():
+        db.upload_image("/static/uploads/barrel.jpg", "Rain barrel", "water", 1)
+        # the write isn't committed yet, another thread still reads the last snapshot straight away
+        assert "Rain barrel" not in [image["caption"] for image in in_thread(db.get_all_images)]
+    assert "Rain barrel" in [image["caption"] for image in in_thread(db.get_all_images)]
+
+def test_client_connections_pooled_between_threads(tmp_path):
+    database = ClientDatabase(str(tmp_path / "test.sqlite"))
+
+    def request():
+        database.get_all_images()
+        connection = database.local.reader
+        database.release()
+        return connection
+
+    first = in_thread(request)
+    assert in_thread(request) is first
+    database.disconnect()
+
+#schema migrations
+def test_migrations_bring_old_database_up_to_date(tmp_path):
+    path = str(tmp_path / "old.sqlite")
+    old = sqlite3.connect(path)
+    for statement in MIGRATIONS[0]:
+        old.execute(statement)
+    old.execute("INSERT INTO images (url, caption, category, user_id) VALUES ('/static/uploads/a.jpg', 'Rain barrel', 'water', 1)")
+    old.execute("INSERT INTO images (url, caption, category, user_id, image_data) VALUES ('/static/uploads/b.jpg', 'Cellar', 'food', 1, ?)",
+                (base64.b64encode(b"\x89PNG cellar").decode(),))
+    old.commit()
+
+    assert migrate(old) == 0
+    assert old.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS)
+    indexes = {row[0] for row in old.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {"idx_images_feed", "idx_comments_image", "idx_comments_user", "idx_images_user"} <= indexes
+    # posts from before the search index are found too
+    assert old.execute("SELECT count(*) FROM images_fts WHERE images_fts MATCH 'water'").fetchone()[0] > 0
+    # image bytes moved out of the images rows
+    assert "image_data" not in [row[1] for row in old.execute("PRAGMA table_info(images)")]
+    blob_id = old.execute("SELECT blob_id FROM images WHERE caption = 'Cellar'").fetchone()[0]
+    assert read_blob(old, blob_id) == b"\x89PNG cellar"
+    # already up to date, nothing runs
+    assert migrate(old) == len(MIGRATIONS)
+    old.close()
+
+@pytest.mark.parametrize("database_class", [Database, ClientDatabase])
+def test_image_data_left_empty_where_sqlite_cant_drop_columns(database_class, tmp_path, monkeypatch):
+    path = str(tmp_path / "old.sqlite")
+    old = sqlite3.connect(path)
+    for statement in MIGRATIONS[0]:
+        old.execute(statement)
+    old.execute("INSERT INTO images (id, url, caption, category, user_id, image_data) VALUES (1000, '/static/uploads/b.jpg', 'Cellar', 'food', 1, ?)",
+                (base64.b64encode(b"\x89PNG cellar").decode(),))
+    old.commit()
+    old.close()
+    monkeypatch.setattr(sqlite3, "sqlite_version_info", (3, 34, 1))
+
+    database = database_class(path)
+    image_id = database.upload_image("/static/uploads/c.jpg", "Rain barrel", "water", 1, b"\x89PNG barrel")
+
+    with database.cursor_scope(readonly=True) as cursor:
+        assert cursor.execute("SELECT count(*) FROM images WHERE image_data IS NOT NULL").fetchone()[0] == 0
+    assert database.get_image_data(1000) == b"\x89PNG cellar"
+    assert database.get_image_data(image_id) == b"\x89PNG barrel"
+    database.disconnect()
+
+def test_failed_migration_is_rolled_back(tmp_path):
+    connection = sqlite3.connect(str(tmp_path / "test.sqlite"))
+    migrations = [["CREATE TABLE a (id INTEGER)"], ["CREATE TABLE b (id INTEGER)", "CREATE TABLE a (id INTEGER)"]]
+
+    with pytest.raises(sqlite3.OperationalError):
+        migrate(connection, migrations)
+
+    assert connection.execute("PRAGMA user_version").fetchone()[0] == 1
+    assert connection.execute("SELECT name FROM sqlite_master WHERE name = 'b'").fetchone() is None
+
+#post search
+def test_fts5_probe_checks_the_tokenizer_options_too():
+    connection = sqlite3.connect(":memory:")
+    assert fts5_available(connection, SEARCH_TOKENIZER)
+    # remove_diacritics 3 doesn't exist, like 2 before SQLite 3.27
+    assert not fts5_available(connection, "unicode61 remove_diacritics 3")
+
+def test_search_ranks_prefix_matches_and_follows_edits(db):
+    assert db.full_text_search
+    category_hit = db.upload_image("/static/uploads/a.jpg", "Cellar shelves", "zorbwater", 1)
+    caption_hit = db.upload_image("/static/uploads/b.jpg", "Zorbwater barrels", "storage", 1)
+    db.upload_image("/static/uploads/c.jpg", "Seed vault", "food", 1)
+
+    ids = [image["id"] for image in db.search_images("zorbwat")]
+    assert ids[:2] == [caption_hit, category_hit]
+    assert [image["id"] for image in db.search_images("zorbwater barrel")] == [caption_hit]
+    assert len(db.search_images("a", limit=1)) == 1
+    # punctuation is not FTS5 syntax
+    assert db.search_images('"') == []
+
+    with db.cursor_scope() as cursor:
+        cursor.execute("UPDATE images SET caption = 'Rain catcher' WHERE id = ?", (caption_hit,))
+        cursor.execute("DELETE FROM images WHERE id = ?", (category_hit,))
+        db.connection.commit()
+    assert db.search_images("zorbwater") == []
+    assert [image["id"] for image in db.search_images("rain catch")] == [caption_hit]
+
+def test_search_falls_back_to_like(db):
+    db.full_text_search = False
+    db.upload_image("/static/uploads/b.jpg", "Zorbwater barrels", "storage", 1)
+    assert [image["caption"] for image in db.search_images("bwater barr")] == ["Zorbwater barrels"]
+
+#user search
+def test_user_search_tolerates_typos_and_hides_email(db):
+    assert db.trigram_search
+    for name in ["Marigold", "Marigolds", "Rosemary", "Goldie", "Marjoram"]:
+        db.create_user(name, "pw", f"{name}@example.com")
+
+    assert [user["username"] for user in db.search_users("marigold")][:2] == ["Marigold", "Marigolds"]
+    assert "Rosemary" in [user["username"] for user in db.search_users("mary")]
+    # one letter off still finds her, names with nothing in common don't come up
+    assert [user["username"] for user in db.search_users("Marigol")][:2] == ["Marigold", "Marigolds"]
+    assert [user["username"] for user in db.search_users("Marigodl")][:2] == ["Marigold", "Marigolds"]
+    assert "Marjoram" not in [user["username"] for user in db.search_users("Marigodl")]
+    assert len(db.search_users("gold", limit=1)) == 1
+    assert all("email" not in user for user in db.search_users("gold"))
+    # too short for trigrams
+    assert [user["username"] for user in db.search_users("Go")][0] == "Goldie"
+
+    with db.cursor_scope() as cursor:
+        cursor.execute("UPDATE users SET username = 'Juniper' WHERE username = 'Goldie'")
+        db.connection.commit()
+    assert [user["username"] for user in db.search_users("junip")] == ["Juniper"]
+
+#paging keeps going when the last image sent goes away
+@pytest.mark.parametrize("database_class", [Database, ClientDatabase])
+def test_saved_images_page_past_an_unsaved_cursor(database_class, tmp_path):
+    database = database_class(str(tmp_path / "test.sqlite"))
+    image_ids = [database.upload_image(f"/static/uploads/{i}.jpg", f"Barrel {i}", "water", 1) for i in range(7)]
+    for image_id in image_ids:
+        database.save_image_for_user(1, image_id)
+
+    first = database.get_saved_images(1, None, 3)
+    database.unsave_image_for_user(1, first[-1]["id"])
+    second = database.get_saved_images(1, database.saved_cursor(first[-1]), 3)
+
+    assert [image["id"] for image in first] == image_ids[:-4:-1]
+    assert [image["id"] for image in second] == image_ids[-4:-7:-1]
+
+@pytest.mark.parametrize("database_class", [Database, ClientDatabase])
+def test_feed_pages_past_a_deleted_cursor(database_class, tmp_path):
+    database = database_class(str(tmp_path / "test.sqlite"))
+    for i in range(7):
+        database.upload_image(f"/static/uploads/{i}.jpg", f"Barrel {i}", "water", 1)
+    everything = [image["id"] for image in database.get_all_images()]
+
+    first = database.get_all_images(None, 3)
+    with database.cursor_scope() as cursor:
+        cursor.execute("DELETE FROM images WHERE id = ?", (first[-1]["id"],))
+        database.connection.commit()
+    second = database.get_all_images(database.feed_cursor(first[-1]), 3)
+
+    assert [image["id"] for image in second] == everything[3:6]
+
+def test_malformed_cursor_is_rejected(db):
+    with pytest.raises(ValueError):
+        db.get_all_images(17, 3)
+
+#saved state for a whole list at once
+def test_mark_saved_in_one_query(db):
+    image_ids = [db.upload_image(f"/static/uploads/{i}.jpg", f"Zorbwater barrel {i}", "water", 1) for i in range(30)]
+    for image_id in image_ids[::3]:
+        db.save_image_for_user(1, image_id)
+
+    statements = []
+    db.search_images("zorbwater")  # opens the reader
+    db.local.reader.set_trace_callback(statements.append)
+    images = db.search_images("zorbwater", 1)
+    db.local.reader.set_trace_callback(None)
+
+    assert {image["id"] for image in images if image["is_saved"]} == set(image_ids[::3])
+    # one look at saved_images for the whole page, not one per image
+    assert len([statement for statement in statements if "saved_images" in statement]) == 1
+    assert db.mark_saved([], 1) == []
+    assert db.mark_saved([{"id": image_ids[0]}, {"id": image_ids[1]}], 1) == [
+        {"id": image_ids[0], "is_saved": True}, {"id": image_ids[1], "is_saved": False}]
+
+#image bytes
+def test_image_bytes_kept_apart_and_once(db):
+    first = db.upload_image("/static/uploads/a.jpg", "Rain barrel", "water", 1, b"\x89PNG barrel")
+    again = db.upload_image("/static/uploads/b.jpg", "Rain barrel again", "water", 1, base64.b64encode(b"\x89PNG barrel").decode())
+    empty = db.upload_image("/static/uploads/c.jpg", "No bytes", "water", 1)
+
+    assert db.get_image_data(first) == db.get_image_data(again) == b"\x89PNG barrel"
+    assert db.get_image_data(empty) is None
+    assert db.get_image_data(999999) is None
+    with db.cursor_scope(readonly=True) as cursor:
+        assert cursor.execute("SELECT count(*) FROM blobs").fetchone()[0] == 1
+    db.save_image_for_user(1, first)
+    assert "image_data" not in db.get_saved_images(1)[0]
+
+#feed filter
+def test_categories_cover_the_whole_feed(db):
+    db.upload_image("/static/uploads/radio.jpg", "Hand crank radio", "comms", 1)
+    for i in range(30):
+        db.upload_image(f"/static/uploads/{i}.jpg", f"Barrel {i}", "water", 1)
+
+    # newer uploads push it off the first page
+    assert "comms" not in [image["category"] for image in db.get_all_images(limit=24)]
+    categories = db.get_categories()
+    assert "comms" in categories and categories == sorted(set(categories))
+
+#every hot query is answered from an index
+HOT_CALLS = [
+    ("get_user", (1,)),
+    ("authenticate_user", ("Andy", "password")),
+    ("get_all_images", (None, 24)),
+    ("get_all_images", ("0|5", 24)),
+    ("get_image_by_id", (1,)),
+    ("get_image_data", (1,)),
+    ("get_categories", ()),
+    ("get_comments", (1,)),
+    ("get_saved_images", (1, None, 24)),
+    ("get_saved_images", (1, "2026-10-17 12:00:00|3", 24)),
+    ("is_image_saved_by_user", (1, 1)),
+    ("mark_saved", ([{"id": 1}, {"id": 2}, {"id": 3}], 1)),
+    ("get_saved_count", (1,)),
+    ("get_uploaded_count", (1,)),
+    ("get_comment_count", (1,))
+]
+
+@pytest.mark.parametrize("database_class", [Database, ClientDatabase])
+def test_hot_queries_use_indexes(database_class, tmp_path):
+    database = database_class(str(tmp_path / "test.sqlite"))
+    statements = []
+
+    for method, args in HOT_CALLS:
+        getattr(database, method)(*args)  # opens this thread's connections
+        for connection in (database.local.reader, database.local.writer):
+            connection.set_trace_callback(statements.append)
+        getattr(database, method)(*args)
+        for connection in (database.local.reader, database.local.writer):
+            connection.set_trace_callback(None)
+
+        for statement in statements:
+            if not statement.lstrip().upper().startswith("SELECT"):
+                continue
+            plan = [row[3] for row in database.local.reader.execute("EXPLAIN QUERY PLAN " + statement)]
+            full_scans = [step for step in plan if step.startswith("SCAN") and "INDEX" not in step]
+            sorts = [step for step in plan if "TEMP B-TREE" in step]
+            assert not full_scans and not sorts, (method, statement, plan)
+        statements.clear()
+    database.disconnect()
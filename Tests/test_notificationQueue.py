@@ -0,0 +1,101 @@
+import time
+import pytest
+from unittest.mock import MagicMock
+from Client.notification_queue import NotificationQueue
+
+
+@pytest.fixture
+def client():
+    client = MagicMock()
+    client.send_request.return_value = (True, {"body": {"command": "OK"}})
+    client.send_batch.return_value = (True, [])
+    return client
+
+def test_notify_is_sent_in_background(client):
+    queue = NotificationQueue(client)
+    queue.notify("ADD_COMMENT", {"user_id": 1, "image_id": 2, "text": "nice"})
+
+    assert queue.flush()
+    client.send_request.assert_called_once_with("ADD_COMMENT", {"user_id": 1, "image_id": 2, "text": "nice"})
+
+def test_save_then_unsave_cancels_out(client):
+    queue = NotificationQueue(client)
+    with queue.condition:
+        #hold the lock so the worker can't send anything yet
+        queue.notify("SAVE_IMAGE", {"user_id": 1, "image_id": 5})
+        queue.notify("UNSAVE_IMAGE", {"user_id": 1, "image_id": 5})
+        queue.notify("SAVE_IMAGE", {"user_id": 1, "image_id": 6})
+        queue.notify("SAVE_IMAGE", {"user_id": 1, "image_id": 6})
+        assert len(queue.items) == 1
+
+    assert queue.flush()
+    client.send_request.assert_called_once_with("SAVE_IMAGE", {"user_id": 1, "image_id": 6})
+
+def test_queue_is_bounded(client):
+    queue = NotificationQueue(client, max_size=3)
+    with queue.condition:
+        for i in range(5):
+            queue.notify("ADD_COMMENT", {"image_id": i, "text": "hi"})
+        assert len(queue.items) == 3
+        assert queue.dropped == 2
+        assert [n["data"]["image_id"] for n in queue.items.values()] == [2, 3, 4]
+
+def test_retries_with_backoff(client):
+    client.send_request.side_effect = [(False, "Failed to connect to server"), (True, {})]
+    queue = NotificationQueue(client, base_delay=0.01)
+    queue.notify("REGISTER", {"username": "andy", "user_id": 1})
+
+    assert queue.flush()
+    assert client.send_request.call_count == 2
+
+def test_new_notifications_wait_out_the_backoff(client):
+    client.send_request.return_value = (False, "Failed to connect to server")
+    queue = NotificationQueue(client, base_delay=30)
+    queue.notify("REGISTER", {"username": "andy", "user_id": 1})
+    with queue.condition:
+        assert queue.condition.wait_for(lambda: queue.next_attempt, timeout=5)
+
+    # users carrying on during the outage don't set off retries
+    for i in range(3):
+        queue.notify("ADD_COMMENT", {"image_id": i, "text": "hi"})
+    time.sleep(0.1)
+    assert client.send_request.call_count == 1
+    assert queue.items[next(iter(queue.items))]["attempts"] == 1
+
+    client.send_batch.return_value = (True, [])
+    # flush() skips the backoff, the register and the comments go in one batch
+    assert queue.flush()
+    assert len(client.send_batch.call_args[0][0]) == 4
+    assert queue.dropped == 0
+
+def test_gives_up_after_max_retries(client):
+    client.send_request.return_value = (False, "Failed to connect to server")
+    queue = NotificationQueue(client, max_retries=2, base_delay=0.001)
+    queue.notify("LOGIN", {"username": "andy", "user_id": 1})
+
+    assert queue.flush()
+    assert client.send_request.call_count == 3
+    assert queue.dropped == 1
+
+def test_pending_notifications_share_one_batch(client):
+    queue = NotificationQueue(client)
+    with queue.condition:
+        queue.notify("SAVE_IMAGE", {"user_id": 1, "image_id": 1})
+        queue.notify("ADD_COMMENT", {"user_id": 1, "image_id": 1, "text": "nice"})
+
+    assert queue.flush()
+    client.send_batch.assert_called_once_with([
+        ("SAVE_IMAGE", {"user_id": 1, "image_id": 1}),
+        ("ADD_COMMENT", {"user_id": 1, "image_id": 1, "text": "nice"})
+    ])
+    client.send_request.assert_not_called()
+
+def test_falls_back_when_batch_fails(client):
+    client.send_batch.return_value = (False, "Unknown command")
+    queue = NotificationQueue(client)
+    with queue.condition:
+        queue.notify("SAVE_IMAGE", {"user_id": 1, "image_id": 1})
+        queue.notify("SAVE_IMAGE", {"user_id": 1, "image_id": 2})
+
+    assert queue.flush()
+    assert client.send_request.call_count == 2
@@ -1,8 +1,23 @@
 import pytest
 import json
 import hashlib
-from unittest.mock import MagicMock, patch
-from Client.tcp_client import TCPClient
+import socket
+import threading
+import time
+from unittest.mock import ANY, MagicMock, patch
+from Client.tcp_client import (TCPClient, TCPClientPool, ChecksumError, FRAME_HEADER, FRAME_FLAG_BINARY,
+                               FRAME_FLAG_SPLIT, FRAME_FLAG_COMPRESSED, encode_packet, decode_packet, join_frame,
+                               compress_frame, decompress_frame, encode_compact, decode_compact, FRAME_FLAG_COMPACT)
+
+
+def frame(payload):
+    return FRAME_HEADER.pack(0, len(payload)) + payload
+
+def read_request(reader):
+    flags, size = FRAME_HEADER.unpack(reader.read(FRAME_HEADER.size))
+    assert flags & FRAME_FLAG_SPLIT
+    payload = reader.read(size)
+    return decode_packet(decompress_frame(payload) if flags & FRAME_FLAG_COMPRESSED else payload)
 
 
 def test_connect_failure():
@@ -86,15 +101,384 @@ def test_send_request_invalid_checksum():
 def test_receive_response_invalid_checksum():
     client = TCPClient(server_host="localhost", server_port=5001)
 
-    with patch.object(client, 'socket', MagicMock()):
-        client.socket.recv = MagicMock(return_value=json.dumps({
+    client.socket, server = socket.socketpair()
+    server.sendall(frame(json.dumps({
+        "header": {"source": "SERVER", "destination": "CLIENT"},
+        "body": {"command": "LOGIN", "data": {"username": "test_user"}},
+        "footer": {"checksum": "invalid_checksum"}
+    }).encode('utf-8')))
+    response = client.receive_response()
+    server.close()
+
+    assert response is None
+
+#framed responses
+def test_receive_response_large_frame():
+    client = TCPClient(server_host="localhost", server_port=5001)
+    client.socket, server = socket.socketpair()
+    images = [{"id": i, "url": f"/static/images/{i}.jpg", "caption": "x" * 100} for i in range(2000)]
+    body = {"command": "IMAGES", "data": {"images": images}}
+    packet = {
+        "header": {"source": "SERVER", "destination": "CLIENT"},
+        "body": body,
+        "footer": {"checksum": client.calculate_checksum(json.dumps(body))}
+    }
+    payload = frame(json.dumps(packet).encode('utf-8'))
+    assert len(payload) > 8192
+
+    sender = threading.Thread(target=server.sendall, args=(payload,))
+    sender.start()
+    response = client.receive_response()
+    sender.join()
+    server.close()
+
+    assert response["body"]["data"]["images"] == images
+
+def test_receive_response_keeps_trailing_bytes():
+    client = TCPClient(server_host="localhost", server_port=5001)
+    client.socket, server = socket.socketpair()
+    packets = b""
+    for command in ["PONG", "ECHO"]:
+        body = {"command": command, "data": {}}
+        packets += frame(json.dumps({
             "header": {"source": "SERVER", "destination": "CLIENT"},
-            "body": {"command": "LOGIN", "data": {"username": "test_user"}},
-            "footer": {"checksum": "invalid_checksum"}
+            "body": body,
+            "footer": {"checksum": client.calculate_checksum(json.dumps(body))}
         }).encode('utf-8'))
-        response = client.receive_response()
+    server.sendall(packets)
 
-    assert response is None
+    assert client.receive_response()["body"]["command"] == "PONG"
+    assert client.reader.pending() > 0
+    assert client.receive_response()["body"]["command"] == "ECHO"
+    assert client.reader.pending() == 0
+    server.close()
+
+def test_receive_response_truncated_frame():
+    client = TCPClient(server_host="localhost", server_port=5001)
+    client.socket, server = socket.socketpair()
+    client.connected = True
+    server.sendall(FRAME_HEADER.pack(0, 100) + b'{"header"')
+    server.close()
+
+    assert client.receive_response() is None
+    assert client.connected == False
+
+def test_send_request_with_binary_payload(tmp_path):
+    client = TCPClient(server_host="localhost", server_port=5001)
+    client.socket, server = socket.socketpair()
+    client.connected = True
+    image_path = tmp_path / "pic.jpg"
+    image_path.write_bytes(b"\xff\xd8" + b"\x00" * 100000)
+
+    received = {}
+    def fake_server():
+        reader = server.makefile('rb')
+        received["request"] = read_request(reader)
+        flags, size = FRAME_HEADER.unpack(reader.read(FRAME_HEADER.size))
+        received["flags"] = flags
+        received["payload"] = reader.read(size)
+        body = {"command": "UPLOAD_SUCCESS", "data": {}}
+        server.sendall(frame(json.dumps({
+            "header": {}, "body": body,
+            "footer": {"checksum": client.calculate_checksum(json.dumps(body))}
+        }).encode('utf-8')))
+
+    responder = threading.Thread(target=fake_server)
+    responder.start()
+    success, response = client.send_request("UPLOAD_IMAGE", {"user_id": 1}, payload_path=str(image_path))
+    responder.join()
+    server.close()
+
+    assert success == True
+    assert received["request"]["body"]["data"]["payload_size"] == image_path.stat().st_size
+    assert "image" not in received["request"]["body"]["data"]
+    assert received["flags"] & FRAME_FLAG_BINARY
+    assert received["payload"] == image_path.read_bytes()
+
+#split packets
+@pytest.mark.parametrize("algorithm", ["crc32", "adler32", "md5"])
+def test_packet_codec_round_trip(algorithm):
+    body = {"command": "IMAGES", "data": {"images": [{"id": 1, "caption": "caf\u00e9"}]}}
+    payload = b"".join(encode_packet({"sequence_number": 7}, body, algorithm))
+
+    packet = decode_packet(payload)
+
+    assert packet["body"] == body
+    assert packet["header"]["sequence_number"] == 7
+    assert packet["header"]["size"] == len(json.dumps(body).encode('utf-8'))
+    assert packet["footer"]["algorithm"] == algorithm
+
+def test_packet_codec_detects_corruption():
+    prefix, envelope, body = encode_packet({"reply_to": 3}, {"command": "PONG", "data": {}})
+
+    with pytest.raises(ChecksumError) as error:
+        decode_packet(prefix + envelope + body.replace(b"PONG", b"PANG"))
+    assert error.value.header["reply_to"] == 3
+
+def test_send_request_split_packet():
+    client = TCPClient(server_host="localhost", server_port=5001, checksum_algorithm="md5")
+    client.socket, server = socket.socketpair()
+    client.connected = True
+
+    received = {}
+    def fake_server():
+        received["request"] = read_request(server.makefile('rb'))
+        body = {"command": "PONG", "data": {"timestamp": 1}}
+        server.sendall(join_frame(encode_packet({"reply_to": 1}, body, "md5"), FRAME_FLAG_SPLIT))
+
+    responder = threading.Thread(target=fake_server)
+    responder.start()
+    success, response = client.send_request("PING", {"timestamp": 1})
+    responder.join()
+    server.close()
+
+    assert success == True
+    assert received["request"]["footer"]["algorithm"] == "md5"
+    assert received["request"]["body"] == {"command": "PING", "data": {"timestamp": 1}}
+    assert response["body"]["data"] == {"timestamp": 1}
+
+def test_compression_is_negotiated():
+    client = TCPClient(server_host="localhost", server_port=5001)
+    client.socket, server = socket.socketpair()
+    client.connected = True
+    reader = server.makefile('rb')
+    images = [{"id": i, "url": f"/static/images/{i}.jpg"} for i in range(500)]
+
+    def reply(command, data):
+        request = read_request(reader)
+        header = {"reply_to": request["header"]["sequence_number"], "compression": "zlib"}
+        flags, payload = compress_frame(encode_packet(header, {"command": command, "data": data}), FRAME_FLAG_SPLIT)
+        server.sendall(join_frame(payload, flags))
+        return request
+
+    responder = threading.Thread(target=reply, args=("IMAGES", {"images": images}))
+    responder.start()
+    success, response = client.send_request("GET_IMAGES", {})
+    responder.join()
+    assert response["body"]["data"]["images"] == images
+    assert client.compress_requests == True
+
+    sequence_number, flags, payload = client.encode_request("BATCH", {"commands": images})
+    assert flags & FRAME_FLAG_COMPRESSED
+    sequence_number, flags, payload = client.encode_request("PING", {})
+    assert not flags & FRAME_FLAG_COMPRESSED
+    server.close()
+
+def test_compression_can_be_turned_off():
+    client = TCPClient(server_host="localhost", server_port=5001, compression_threshold=None)
+    client.compress_requests = True
+
+    sequence_number, flags, payload = client.encode_request("BATCH", {"commands": [{"command": "PING"}] * 500})
+
+    assert not flags & FRAME_FLAG_COMPRESSED
+    assert "compression" not in decode_packet(b"".join(payload))["header"]
+
+#compact codec
+def test_compact_codec_round_trip():
+    images = [{"id": i, "url": f"/static/images/{i}.jpg", "caption": None} for i in range(50)]
+    mixed = [{"id": 1}, {"id": 2, "username": "Andy"}]
+    body = {"command": "IMAGES", "data": {"images": images, "mixed": mixed, "count": 50}}
+    payload = b"".join(encode_compact({"sequence_number": 3, "reply_to": 2}, body, "md5"))
+
+    packet = decode_compact(payload)
+
+    assert packet["body"] == body
+    assert packet["header"] == {"sequence_number": 3, "reply_to": 2}
+    assert packet["footer"]["algorithm"] == "md5"
+    # row keys are sent once, not once per row
+    assert payload.count(b'"caption"') == 1
+
+def test_compact_codec_detects_corruption():
+    payload = b"".join(encode_compact({"sequence_number": 1, "reply_to": 5}, {"command": "PONG", "data": {}}))
+
+    with pytest.raises(ChecksumError) as error:
+        decode_compact(payload.replace(b"PONG", b"PANG"))
+    assert error.value.header["reply_to"] == 5
+    with pytest.raises(ValueError):
+        decode_compact(payload[:4])
+
+def test_hello_picks_codec():
+    client = TCPClient(server_host="localhost", server_port=5001)
+    welcome = (True, {"body": {"command": "WELCOME", "data": {"version": 2, "capabilities": ["split_packets"], "codec": "compact"}}})
+
+    with patch.object(client, 'send_request', return_value=welcome) as mock_send:
+        assert client.hello()
+    assert mock_send.call_args[0][1]["codecs"] == ["compact", "json"]
+    assert client.codec.name == "compact"
+
+    sequence_number, flags, payload = client.encode_request("PING", {"timestamp": 1})
+    assert flags == FRAME_FLAG_COMPACT
+    assert decode_compact(b"".join(payload))["body"] == {"command": "PING", "data": {"timestamp": 1}}
+
+#handshake
+def test_hello_falls_back_for_old_server(tmp_path):
+    client = TCPClient(server_host="localhost", server_port=5001)
+    client.connected = True
+    old_server_reply = (True, {"body": {"command": "ERROR", "data": {"message": "Invalid packet"}}})
+
+    with patch.object(client, 'send_request', return_value=old_server_reply) as mock_send:
+        assert client.hello()
+    assert mock_send.call_args[0][0] == "HELLO"
+    assert client.protocol_version == 1
+    assert client.capabilities == set()
+
+    sequence_number, flags, payload = client.encode_request("PING", {})
+    assert flags == 0
+    assert json.loads(payload)["body"]["command"] == "PING"
+
+    image_path = tmp_path / "pic.jpg"
+    image_path.write_bytes(b"\xff\xd8\x00")
+    data, payload_size = client.attach_payload({"user_id": 1}, str(image_path))
+    assert payload_size is None
+    assert data["image"] == "/9gA"
+
+    with pytest.raises(ConnectionError):
+        client.send_request_async("PING", {}).result(timeout=1)
+
+def test_hello_without_compression():
+    client = TCPClient(server_host="localhost", server_port=5001, compression_threshold=None)
+    welcome = (True, {"body": {"command": "WELCOME", "data": {"version": 2, "capabilities": ["split_packets", "pipelining"]}}})
+
+    with patch.object(client, 'send_request', return_value=welcome) as mock_send:
+        assert client.hello()
+    assert "compression" not in mock_send.call_args[0][1]["capabilities"]
+    assert client.capabilities == {"split_packets", "pipelining"}
+    assert client.compress_requests == False
+
+#pipelining
+def make_response(client, command, reply_to):
+    body = {"command": command, "data": {}}
+    return frame(json.dumps({
+        "header": {"source": "SERVER", "destination": "CLIENT", "reply_to": reply_to},
+        "body": body,
+        "footer": {"checksum": client.calculate_checksum(json.dumps(body))}
+    }).encode('utf-8'))
+
+def test_send_request_async_out_of_order():
+    client = TCPClient(server_host="localhost", server_port=5001)
+    client.socket, server = socket.socketpair()
+    client.connected = True
+
+    first = client.send_request_async("SEARCH", {"query": "bunker"})
+    second = client.send_request_async("PING", {})
+    reader = server.makefile('rb')
+    sequence_numbers = []
+    for _ in range(2):
+        sequence_numbers.append(read_request(reader)["header"]["sequence_number"])
+
+    # answer the second request first
+    server.sendall(make_response(client, "PONG", sequence_numbers[1]))
+    assert second.result(timeout=5)["body"]["command"] == "PONG"
+    assert not first.done()
+
+    server.sendall(make_response(client, "SEARCH_RESULTS", sequence_numbers[0]))
+    assert first.result(timeout=5)["body"]["command"] == "SEARCH_RESULTS"
+
+    server.close()
+
+def test_send_request_async_checksum_mismatch():
+    client = TCPClient(server_host="localhost", server_port=5001)
+    client.socket, server = socket.socketpair()
+    client.connected = True
+
+    future = client.send_request_async("PING", {})
+    sequence_number = read_request(server.makefile('rb'))["header"]["sequence_number"]
+    prefix, envelope, body = encode_packet({"reply_to": sequence_number}, {"command": "PONG", "data": {}})
+    server.sendall(join_frame([prefix, envelope, body.replace(b"PONG", b"PANG")], FRAME_FLAG_SPLIT))
+
+    with pytest.raises(ChecksumError):
+        future.result(timeout=5)
+    server.close()
+
+def test_send_request_async_fails_pending_on_disconnect():
+    client = TCPClient(server_host="localhost", server_port=5001)
+    client.socket, server = socket.socketpair()
+    client.connected = True
+
+    future = client.send_request_async("PING", {})
+    server.close()
+
+    with pytest.raises(ConnectionError):
+        future.result(timeout=5)
+
+def test_send_batch():
+    client = TCPClient(server_host="localhost", server_port=5001)
+    results = [{"command": "SAVE_IMAGE_SUCCESS", "data": {}}, {"command": "PONG", "data": {}}]
+    reply = (True, {"body": {"command": "BATCH_RESULTS", "data": {"results": results}}})
+
+    with patch.object(client, 'send_request', return_value=reply) as mock_send:
+        success, batch_results = client.send_batch([("SAVE_IMAGE", {"image_id": 1, "user_id": 1}), ("PING", {})])
+
+    assert success == True
+    assert batch_results == results
+    mock_send.assert_called_once_with("BATCH", {"commands": [
+        {"command": "SAVE_IMAGE", "data": {"image_id": 1, "user_id": 1}},
+        {"command": "PING", "data": {}}
+    ]})
+
+#connection pool
+def make_pool(**kwargs):
+    pool = TCPClientPool(server_host="localhost", server_port=5001, **kwargs)
+    def create_client():
+        client = MagicMock()
+        client.connect.return_value = True
+        client.connected = True
+        client.send_request.return_value = (True, {"body": {"command": "PONG", "data": {}}})
+        return client
+    pool.create_client = create_client
+    return pool
+
+def test_pool_checkout_is_bounded():
+    pool = make_pool(max_size=2)
+    first = pool.checkout()
+    second = pool.checkout()
+
+    assert first is not second
+    assert pool.checkout(timeout=0) is None
+
+    pool.checkin(first)
+    assert pool.checkout(timeout=0) is first
+
+def test_pool_evicts_idle_connections():
+    pool = make_pool(idle_timeout=0)
+    client = pool.checkout()
+    pool.checkin(client)
+    time.sleep(0.01)
+
+    assert pool.checkout() is not client
+    client.disconnect.assert_called_once()
+    assert pool.size == 1
+
+def test_pool_health_check_after_idle():
+    pool = make_pool(health_check_after=0)
+    client = pool.checkout()
+    pool.checkin(client)
+    client.send_request.return_value = (False, "No response from server")
+    time.sleep(0.01)
+
+    replacement = pool.checkout()
+    assert replacement is not client
+    client.send_request.assert_called_with("PING", ANY)
+    assert pool.size == 1
+
+def test_pool_helpers_use_pooled_connections():
+    pool = make_pool()
+    success, results = pool.search("bunker")
+
+    assert success == True
+    assert len(pool.idle) == 1
+    pool.idle[0][0].send_request.assert_called_with("SEARCH", {"query": "bunker", "type": "posts"}, None)
+
+def test_pool_connect_failure():
+    pool = make_pool()
+    failing = MagicMock()
+    failing.connect.return_value = False
+    pool.create_client = lambda: failing
+
+    success, message = pool.send_request("PING", {})
+    assert success == False
+    assert message == "Failed to connect to server"
+    assert pool.size == 0
 
 #create_packet method
 def test_create_packet():
@@ -0,0 +1,750 @@
+import json
+import os
+import socket
+import threading
+import time
+import pytest
+from unittest.mock import MagicMock
+from Client.tcp_client import TCPClient
+from Server.tcp_server import (TCPServerConnection, COMMAND_HANDLERS, TCPServer, AsyncTCPServer, FRAME_HEADER, FRAME_FLAG_BINARY,
+                               FRAME_FLAG_SPLIT, FRAME_FLAG_COMPRESSED, MAX_FRAME_SIZE, encode_packet, decode_packet,
+                               join_frame, compress_frame, decompress_frame, encode_compact, decode_compact,
+                               FRAME_FLAG_COMPACT, ResponseCache, MAX_PAGE_SIZE, CODECS)
+
+
+def frame(payload):
+    return FRAME_HEADER.pack(0, len(payload)) + payload
+
+def read_packet(sock):
+    flags, size = FRAME_HEADER.unpack(sock.recv(FRAME_HEADER.size, socket.MSG_WAITALL))
+    payload = sock.recv(size, socket.MSG_WAITALL)
+    if flags & FRAME_FLAG_COMPRESSED:
+        payload = decompress_frame(payload)
+    if flags & FRAME_FLAG_COMPACT:
+        return decode_compact(payload)
+    return decode_packet(payload) if flags & FRAME_FLAG_SPLIT else json.loads(payload)
+
+@pytest.fixture
+def connection():
+    server_side, client_side = socket.socketpair()
+    handler = TCPServerConnection(server_side, ("127.0.0.1", 0), MagicMock())
+    yield handler, client_side
+    client_side.close()
+
+def make_request(command, data):
+    return json.dumps({
+        "header": {"source": "CLIENT", "destination": "SERVER", "sequence_number": 1},
+        "body": {"command": command, "data": data},
+        "footer": {"checksum": ""}
+    }).encode('utf-8')
+
+def test_ping_round_trip(connection):
+    handler, client = connection
+    client.sendall(frame(make_request("PING", {"timestamp": 1})))
+    client.shutdown(socket.SHUT_WR)
+    handler.handle_request()
+
+    response = read_packet(client)
+    assert response["body"]["command"] == "PONG"
+
+def test_pipelined_requests_echo_sequence_numbers(connection):
+    handler, client = connection
+    packets = b""
+    for sequence_number in [5, 6, 7]:
+        packets += frame(json.dumps({
+            "header": {"sequence_number": sequence_number},
+            "body": {"command": "PING", "data": {}},
+        }).encode('utf-8'))
+    client.sendall(packets)
+    client.shutdown(socket.SHUT_WR)
+    handler.handle_request()
+
+    assert [read_packet(client)["header"]["reply_to"] for _ in range(3)] == [5, 6, 7]
+
+def test_batch_runs_in_one_transaction(connection):
+    handler, client = connection
+    batch = {"commands": [
+        {"command": "PING", "data": {"timestamp": 1}},
+        {"command": "ECHO", "data": {}},
+        {"command": "BATCH", "data": {"commands": []}},
+        "not a command"
+    ]}
+    client.sendall(frame(make_request("BATCH", batch)))
+    client.shutdown(socket.SHUT_WR)
+    handler.handle_request()
+
+    response = read_packet(client)
+    results = response["body"]["data"]["results"]
+    assert response["body"]["command"] == "BATCH_RESULTS"
+    assert [result["command"] for result in results] == ["PONG", "ECHO", "ERROR", "ERROR"]
+    handler.db.transaction.assert_called_once()
+
+def test_batch_holds_back_only_its_own_events(connection):
+    handler, client = connection
+    handler.subscriptions = MagicMock()
+    saving, release = threading.Event(), threading.Event()
+    def blocking_save(user_id, image_id):
+        saving.set()
+        release.wait(5)
+        return True
+    handler.db.save_image_for_user.side_effect = blocking_save
+
+    batch = threading.Thread(target=handler.process_command, args=(
+        "BATCH", {"commands": [{"command": "SAVE_IMAGE", "data": {"user_id": 1, "image_id": 2}}]}))
+    batch.start()
+    assert saving.wait(5)
+    # a request running alongside the batch on another thread publishes straight away
+    handler.publish("images", {"event": "image_created"})
+    handler.subscriptions.publish.assert_called_once_with("images", {"event": "image_created"})
+    release.set()
+    batch.join()
+
+    handler.subscriptions.publish.assert_called_with("saves:1", {"event": "image_saved", "image_id": 2})
+
+def test_reply_encoded_with_one_codec(connection):
+    handler, client = connection
+    handler.checksum_algorithm = "crc32"
+    json_codec = CODECS["json"]
+    def serialize_during_hello(body):
+        handler.codec = CODECS["compact"]  # a HELLO on another thread picks a new codec
+        return json_codec.serialize(body)
+    handler.codec = json_codec._replace(serialize=serialize_during_hello)
+
+    flags, payload = handler.encode_response("PONG", {"ok": True}, 3)
+
+    assert flags == json_codec.flag
+    assert decode_packet(b"".join(payload))["body"] == {"command": "PONG", "data": {"ok": True}}
+
+#command handlers
+def test_every_command_has_a_handler():
+    assert set(COMMAND_HANDLERS) >= {"PING", "ECHO", "TEST", "LOGIN", "REGISTER", "UPLOAD_IMAGE", "GET_IMAGES",
+                                     "GET_SAVED_IMAGES", "SAVE_IMAGE", "UNSAVE_IMAGE", "ADD_COMMENT", "SEARCH", "BATCH",
+                                     "GET_CHANGES"}
+
+def test_unknown_command(connection):
+    handler, client = connection
+    assert handler.process_command("FLY", {}) == {"command": "ERROR", "data": {"message": "Unknown command"}}
+
+def test_missing_required_fields(connection):
+    handler, client = connection
+    response = handler.process_command("SAVE_IMAGE", {"user_id": 1})
+
+    assert response["command"] == "SAVE_IMAGE_FAILED"
+    assert "image_id" in response["data"]["message"]
+    handler.db.save_image_for_user.assert_not_called()
+
+def test_add_comment(connection):
+    handler, client = connection
+    handler.db.add_comment.return_value = (True, 12, "Andy")
+    response = handler.process_command("ADD_COMMENT", {"image_id": 3, "text": "Nice setup", "user_id": 1})
+
+    assert response == {"command": "ADD_COMMENT_SUCCESS", "data": {"comment_id": 12, "image_id": 3, "username": "Andy"}}
+    handler.db.add_comment.assert_called_once_with(3, "Nice setup", 1)
+
+def test_handlers_use_database_api(connection):
+    handler, client = connection
+    handler.db.get_all_images.return_value = [{"id": 1}]
+    handler.db.get_saved_images.return_value = [{"id": 2}]
+    handler.db.create_user.return_value = (True, 5)
+
+    assert handler.handle_get_images({})["data"]["images"] == [{"id": 1}]
+    assert handler.process_command("GET_SAVED_IMAGES", {"user_id": 1})["data"]["images"] == [{"id": 2}]
+    assert handler.process_command("REGISTER", {"username": "Andy", "password": "pw"})["data"]["user_id"] == 5
+    handler.db.create_user.assert_called_once_with("Andy", "pw", None)
+
+def test_images_are_paged_by_cursor(connection, tmp_path):
+    from Server.database import Database
+    handler, client = connection
+    handler.db = Database(str(tmp_path / "test.sqlite"))
+    for i in range(5):
+        handler.db.upload_image(f"/static/uploads/{i}.jpg", f"Rain barrel {i}", "water", 1)
+    everything = handler.process_command("GET_IMAGES", {})["data"]
+
+    pages, cursor = [], None
+    while True:
+        page = handler.process_command("GET_IMAGES", {"cursor": cursor, "limit": 4})["data"]
+        pages += page["images"]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+
+    assert everything["next_cursor"] is None
+    assert pages == everything["images"]
+    assert len(pages) > 4
+
+def test_get_changes_since_mark(connection, tmp_path):
+    from Server.database import Database
+    handler, client = connection
+    handler.db = Database(str(tmp_path / "test.sqlite"))
+    since = handler.process_command("GET_CHANGES", {})["data"]["since"]
+
+    image_id = handler.db.upload_image("/static/uploads/barrel.jpg", "Rain barrel", "water", 1)
+    handler.db.save_image_for_user(1, image_id)
+    handler.db.add_comment(image_id, "Nice setup", 1)
+    handler.db.unsave_image_for_user(1, image_id)
+    user_id = handler.db.create_user("Sam", "pw")[1]
+    handler.db.save_image_for_user(user_id, image_id)
+
+    response = handler.process_command("GET_CHANGES", {"since": since, "user_id": 1})["data"]
+    changes = [(change["type"], change["action"]) for change in response["changes"]]
+    assert changes == [("image", "created"), ("save", "created"), ("comment", "created"), ("save", "deleted")]
+    assert response["changes"][0]["image"]["caption"] == "Rain barrel"
+    assert response["changes"][2]["comment"]["text"] == "Nice setup"
+    assert response["more"] == False
+
+    # Sam's save is skipped but still moves the mark past it
+    assert handler.process_command("GET_CHANGES", {"since": response["since"], "user_id": 1})["data"]["changes"] == []
+
+    first = handler.process_command("GET_CHANGES", {"since": since, "user_id": 1, "limit": 3})["data"]
+    assert first["more"] == True
+    rest = handler.process_command("GET_CHANGES", {"since": first["since"], "user_id": 1})["data"]
+    assert first["changes"] + rest["changes"] == response["changes"]
+
+def test_bad_page_arguments(connection):
+    handler, client = connection
+    assert handler.process_command("GET_IMAGES", {"limit": 0})["command"] == "ERROR"
+    assert handler.process_command("GET_SAVED_IMAGES", {"user_id": 1, "cursor": 17})["command"] == "GET_SAVED_FAILED"
+    handler.db.get_all_images.return_value = []
+    handler.process_command("GET_IMAGES", {"limit": 10000})
+    handler.db.get_all_images.assert_called_once_with(None, MAX_PAGE_SIZE)
+
+def test_search_limit(connection):
+    handler, client = connection
+    handler.db.search_images.return_value = []
+    handler.process_command("SEARCH", {"query": "barrel", "user_id": 1})
+    handler.db.search_images.assert_called_with("barrel", 1, 50)
+    handler.process_command("SEARCH", {"query": "barrel", "limit": 10000})
+    handler.db.search_images.assert_called_with("barrel", None, MAX_PAGE_SIZE)
+    assert handler.process_command("SEARCH", {"query": "barrel", "limit": -1})["command"] == "SEARCH_FAILED"
+    handler.db.search_users.return_value = []
+    handler.process_command("SEARCH", {"query": "andy", "type": "users"})
+    handler.db.search_users.assert_called_with("andy", 20)
+
+def test_multi_megabyte_frame(connection):
+    handler, client = connection
+    image = "A" * (3 * 1024 * 1024)
+    payload = frame(make_request("ECHO", {"image": image}))
+
+    sender = threading.Thread(target=lambda: (client.sendall(payload), client.shutdown(socket.SHUT_WR)))
+    sender.start()
+    handler.handle_request()
+    sender.join()
+
+    response = read_packet(client)
+    assert response["body"]["command"] == "ECHO"
+
+def test_oversized_frame_is_an_error(connection):
+    handler, client = connection
+    client.sendall(FRAME_HEADER.pack(0, MAX_FRAME_SIZE + 1))
+    handler.handle_request()
+
+    response = read_packet(client)
+    assert response["body"]["command"] == "ERROR"
+    assert "Framing error" in response["body"]["data"]["message"]
+
+def test_invalid_json_is_an_error(connection):
+    handler, client = connection
+    client.sendall(frame(b'{"header": '))
+    client.shutdown(socket.SHUT_WR)
+    handler.handle_request()
+
+    response = read_packet(client)
+    assert response["body"]["command"] == "ERROR"
+    assert response["body"]["data"]["message"] == "Invalid packet"
+
+def make_split_request(command, data, sequence_number=1, algorithm="crc32", **header):
+    header.update(source="CLIENT", destination="SERVER", sequence_number=sequence_number)
+    return join_frame(encode_packet(header, {"command": command, "data": data}, algorithm), FRAME_FLAG_SPLIT)
+
+def test_split_request_gets_split_reply(connection):
+    handler, client = connection
+    client.sendall(make_split_request("ECHO", {"text": "hello"}, sequence_number=4, algorithm="md5"))
+    client.shutdown(socket.SHUT_WR)
+    handler.handle_request()
+
+    flags, size = FRAME_HEADER.unpack(client.recv(FRAME_HEADER.size, socket.MSG_WAITALL))
+    assert flags & FRAME_FLAG_SPLIT
+    response = decode_packet(client.recv(size, socket.MSG_WAITALL))
+    assert response["header"]["reply_to"] == 4
+    assert response["footer"]["algorithm"] == "md5"
+    assert response["body"]["data"]["original_command"] == "ECHO"
+
+def test_split_request_checksum_mismatch(connection):
+    handler, client = connection
+    request = make_split_request("ECHO", {"text": "hello"})
+    client.sendall(request.replace(b"hello", b"jello"))
+    client.shutdown(socket.SHUT_WR)
+    handler.handle_request()
+
+    response = read_packet(client)
+    assert response["body"]["command"] == "ERROR"
+    assert response["body"]["data"]["message"] == "Checksum mismatch"
+
+def test_large_replies_are_compressed(connection):
+    handler, client = connection
+    images = [{"id": i, "url": f"/static/images/{i}.jpg", "caption": "Rain barrel"} for i in range(200)]
+    handler.db.get_all_images.return_value = images
+    client.sendall(make_split_request("GET_IMAGES", {}, compression="zlib"))
+    client.sendall(make_split_request("PING", {}, sequence_number=2, compression="zlib"))
+    client.shutdown(socket.SHUT_WR)
+    handler.handle_request()
+
+    flags, size = FRAME_HEADER.unpack(client.recv(FRAME_HEADER.size, socket.MSG_WAITALL))
+    payload = client.recv(size, socket.MSG_WAITALL)
+    assert flags & FRAME_FLAG_COMPRESSED
+    assert size < len(json.dumps(images)) / 4
+    response = decode_packet(decompress_frame(payload))
+    assert response["body"]["data"]["images"] == images
+    assert response["header"]["compression"] == "zlib"
+
+    flags, size = FRAME_HEADER.unpack(client.recv(FRAME_HEADER.size, socket.MSG_WAITALL))
+    assert not flags & FRAME_FLAG_COMPRESSED
+    assert decode_packet(client.recv(size, socket.MSG_WAITALL))["body"]["command"] == "PONG"
+
+def test_replies_not_compressed_unless_accepted(connection):
+    handler, client = connection
+    handler.db.get_all_images.return_value = [{"id": i, "caption": "Rain barrel"} for i in range(200)]
+    client.sendall(make_split_request("GET_IMAGES", {}))
+    client.shutdown(socket.SHUT_WR)
+    handler.handle_request()
+
+    flags, size = FRAME_HEADER.unpack(client.recv(FRAME_HEADER.size, socket.MSG_WAITALL))
+    assert not flags & FRAME_FLAG_COMPRESSED
+
+def test_compressed_request_is_inflated(connection):
+    handler, client = connection
+    header = {"source": "CLIENT", "destination": "SERVER", "sequence_number": 1, "compression": "zlib"}
+    payload = encode_packet(header, {"command": "ECHO", "data": {"text": "a" * 5000}})
+    flags, payload = compress_frame(payload, FRAME_FLAG_SPLIT)
+    assert flags & FRAME_FLAG_COMPRESSED
+    client.sendall(join_frame(payload, flags))
+    client.sendall(join_frame(b"not zlib", FRAME_FLAG_SPLIT | FRAME_FLAG_COMPRESSED))
+    client.shutdown(socket.SHUT_WR)
+    handler.handle_request()
+
+    assert read_packet(client)["body"]["command"] == "ECHO"
+    response = read_packet(client)
+    assert response["body"]["command"] == "ERROR"
+    assert response["body"]["data"]["message"] == "Invalid packet"
+
+def test_binary_upload_streamed_to_disk(connection, tmp_path):
+    handler, client = connection
+    handler.upload_folder = str(tmp_path)
+    handler.db.upload_image.return_value = 7
+    images = [bytes(range(256)) * 1024, os.urandom(1000)]
+
+    def send():
+        # two users uploading a photo.jpg each
+        for image in images:
+            metadata = {"url": "./static/uploads/photo.jpg", "user_id": 1, "caption": "bunker",
+                        "payload_size": len(image), "filename": "photo.jpg"}
+            client.sendall(frame(make_request("UPLOAD_IMAGE", metadata)))
+            client.sendall(FRAME_HEADER.pack(FRAME_FLAG_BINARY, len(image)) + image)
+        client.sendall(frame(make_request("PING", {"timestamp": 1})))
+        client.shutdown(socket.SHUT_WR)
+
+    sender = threading.Thread(target=send)
+    sender.start()
+    handler.handle_request()
+    sender.join()
+
+    urls = [read_packet(client)["body"]["data"]["url"] for _ in images]
+    assert read_packet(client)["body"]["command"] == "PONG"
+    assert urls[0] != urls[1]
+    for url, image in zip(urls, images):
+        assert url.startswith("/static/uploads/") and url.endswith(".jpg")
+        assert (tmp_path / os.path.basename(url)).read_bytes() == image
+    assert handler.db.upload_image.call_args_list[1][0][0] == urls[1]
+
+def test_upload_stored_path_is_not_taken_from_the_request(connection):
+    handler, client = connection
+    handler.db.upload_image.return_value = 7
+    metadata = {"url": "./static/uploads/pic.jpg", "user_id": 1, "stored_path": "/etc/passwd"}
+    client.sendall(frame(make_request("UPLOAD_IMAGE", metadata)))
+    client.shutdown(socket.SHUT_WR)
+    handler.handle_request()
+
+    assert read_packet(client)["body"]["data"]["url"] == "/static/uploads/pic.jpg"
+
+def test_upload_without_payload_frame_is_an_error(connection, tmp_path):
+    handler, client = connection
+    handler.upload_folder = str(tmp_path)
+    metadata = {"user_id": 1, "payload_size": 10, "filename": "pic.jpg"}
+    client.sendall(frame(make_request("UPLOAD_IMAGE", metadata)) + frame(b"{}"))
+    client.shutdown(socket.SHUT_WR)
+    handler.handle_request()
+
+    response = read_packet(client)
+    assert response["body"]["command"] == "ERROR"
+    assert list(tmp_path.iterdir()) == []
+
+#asyncio engine
+@pytest.fixture
+def async_server():
+    server = AsyncTCPServer(host='127.0.0.1', port=0, db=MagicMock(), max_workers=2)
+    thread = threading.Thread(target=server.start, daemon=True)
+    thread.start()
+    for _ in range(100):
+        if server.running:
+            break
+        time.sleep(0.01)
+    yield server
+    server.stop()
+    thread.join(timeout=5)
+
+def test_async_server_many_connections(async_server):
+    clients = [TCPClient(server_host='127.0.0.1', server_port=async_server.port) for _ in range(20)]
+    for client in clients:
+        assert client.connect()
+
+    for client in clients:
+        success, response = client.send_request("PING", {"timestamp": 1})
+        assert success
+        assert response["body"]["command"] == "PONG"
+
+    assert len(async_server.connections) == 20
+    for client in clients:
+        client.disconnect()
+
+def test_async_server_responds_out_of_order(async_server):
+    def slow_save(user_id, image_id):
+        time.sleep(0.3)
+        return True
+    async_server.db.save_image_for_user.side_effect = slow_save
+
+    client = TCPClient(server_host='127.0.0.1', server_port=async_server.port)
+    save = client.send_request_async("SAVE_IMAGE", {"user_id": 1, "image_id": 2})
+    ping = client.send_request_async("PING", {"timestamp": 1})
+
+    assert ping.result(timeout=5)["body"]["command"] == "PONG"
+    assert not save.done()
+    assert save.result(timeout=5)["body"]["command"] == "SAVE_IMAGE_SUCCESS"
+    client.disconnect()
+
+def test_async_server_runs_login_alone(async_server):
+    order = []
+    def slow_save(user_id, image_id):
+        time.sleep(0.3)
+        order.append("save")
+        return True
+    def login(username, password):
+        order.append("login")
+        return True, 1
+    async_server.db.save_image_for_user.side_effect = slow_save
+    async_server.db.authenticate_user.side_effect = login
+
+    client = TCPClient(server_host='127.0.0.1', server_port=async_server.port)
+    save = client.send_request_async("SAVE_IMAGE", {"user_id": 1, "image_id": 2})
+    login_reply = client.send_request_async("LOGIN", {"username": "Andy", "password": "password"})
+    ping = client.send_request_async("PING", {"timestamp": 1})
+
+    # LOGIN waited for the save, and nothing sent after it started until it was done
+    assert ping.result(timeout=5)["body"]["command"] == "PONG"
+    assert save.done() and login_reply.done()
+    assert order == ["save", "login"]
+    client.disconnect()
+
+def test_async_server_invalid_json(async_server):
+    sock = socket.create_connection(('127.0.0.1', async_server.port))
+    sock.sendall(frame(b'not json'))
+    response = read_packet(sock)
+    sock.close()
+
+    assert response["body"]["command"] == "ERROR"
+
+def test_async_upload_written_off_the_event_loop(async_server, tmp_path, monkeypatch):
+    import Server.tcp_server as tcp_server
+    monkeypatch.setattr(tcp_server, "UPLOAD_FOLDER", str(tmp_path))
+    writers = []
+
+    def recording_open(*args):
+        writers.append(threading.current_thread().name)
+        return open(*args)
+    monkeypatch.setattr(tcp_server, "open", recording_open, raising=False)
+
+    image = os.urandom(300 * 1024)
+    metadata = {"url": "./static/uploads/pic.jpg", "user_id": 1, "caption": "bunker",
+                "payload_size": len(image), "filename": "pic.jpg"}
+    sock = socket.create_connection(('127.0.0.1', async_server.port))
+    sock.sendall(frame(make_request("UPLOAD_IMAGE", metadata)))
+    sock.sendall(FRAME_HEADER.pack(FRAME_FLAG_BINARY, len(image)) + image)
+    sock.sendall(frame(make_request("PING", {"timestamp": 1})))
+    read_packet(sock)
+    assert read_packet(sock)["body"]["command"] == "PONG"
+    sock.close()
+
+    [stored] = tmp_path.iterdir()
+    assert stored.suffix == ".jpg"
+    assert stored.read_bytes() == image
+    assert writers and all(name.startswith("TCPServerWorker") for name in writers)
+
+#response cache
+def test_cached_reply_until_database_changes(connection):
+    handler, client = connection
+    handler.response_cache = ResponseCache()
+    handler.db.generation = 0
+    handler.db.get_all_images.return_value = [{"id": 1, "caption": "Rain barrel"}]
+    client.sendall(make_split_request("GET_IMAGES", {}))
+    client.sendall(make_split_request("GET_IMAGES", {}, sequence_number=2))
+    client.shutdown(socket.SHUT_WR)
+    handler.handle_request()
+
+    first, second = read_packet(client), read_packet(client)
+    assert first["body"] == second["body"]
+    assert second["header"]["reply_to"] == 2
+    assert handler.db.get_all_images.call_count == 1
+    assert handler.response_cache.stats()["hits"] == 1
+    assert handler.response_cache.stats()["misses"] == 1
+
+    handler.db.generation = 1
+    handler.db.get_all_images.return_value = [{"id": 2, "caption": "Water filter"}]
+    server_side, client = socket.socketpair()
+    other = TCPServerConnection(server_side, ("127.0.0.1", 1), handler.db)
+    other.response_cache = handler.response_cache
+    client.sendall(make_split_request("GET_IMAGES", {}, sequence_number=3))
+    client.shutdown(socket.SHUT_WR)
+    other.handle_request()
+
+    assert read_packet(client)["body"]["data"]["images"] == [{"id": 2, "caption": "Water filter"}]
+    assert handler.db.get_all_images.call_count == 2
+    client.close()
+
+def test_response_cache_evicts_least_recently_used():
+    cache = ResponseCache(max_entries=2)
+    cache.get("a", 0)
+    cache.put("a", 0, (b"a", "1"))
+    cache.put("b", 0, (b"b", "2"))
+    assert cache.get("a", 0) == (b"a", "1")
+    cache.put("c", 0, (b"c", "3"))
+
+    assert cache.get("b", 0) is None
+    assert cache.get("a", 0) == (b"a", "1")
+    assert cache.stats()["entries"] == 2
+
+def test_response_cache_expires_and_skips_stale_puts():
+    cache = ResponseCache(ttl=0)
+    cache.get("a", 0)
+    cache.put("a", 0, (b"a", "1"))
+    time.sleep(0.01)
+    assert cache.get("a", 0) is None
+
+    cache = ResponseCache()
+    cache.get("a", 0)
+    cache.get("b", 1)
+    # built from generation 0 data, but the database has already moved on
+    cache.put("a", 0, (b"a", "1"))
+    assert cache.stats()["entries"] == 0
+
+#handshake
+def test_hello_negotiates_version_and_capabilities(connection):
+    handler, client = connection
+    hello = {"version": 5, "capabilities": ["compression", "pipelining", "teleport"]}
+    client.sendall(frame(make_request("HELLO", hello)))
+    client.shutdown(socket.SHUT_WR)
+    handler.handle_request()
+
+    response = read_packet(client)
+    assert response["body"]["command"] == "WELCOME"
+    assert response["body"]["data"]["version"] == 2
+    assert response["body"]["data"]["capabilities"] == ["compression", "pipelining"]
+    assert response["body"]["data"]["user_id"] is None
+    assert handler.compress_replies == True
+
+def test_hello_binds_authenticated_user(connection):
+    handler, client = connection
+    handler.db.authenticate_user.return_value = (True, 7)
+    handler.db.save_image_for_user.return_value = (True, None)
+    client.sendall(frame(make_request("HELLO", {"version": 2, "username": "Andy", "password": "password"})))
+    client.sendall(frame(make_request("SAVE_IMAGE", {"image_id": 3})))
+    client.shutdown(socket.SHUT_WR)
+    handler.handle_request()
+
+    assert read_packet(client)["body"]["data"]["user_id"] == 7
+    assert read_packet(client)["body"]["command"] == "SAVE_IMAGE_SUCCESS"
+    handler.db.save_image_for_user.assert_called_once_with(7, 3)
+
+def test_hello_binds_only_with_password_or_session_token(connection):
+    handler, client = connection
+    handler.db.authenticate_user.return_value = (True, 7)
+    client.sendall(frame(make_request("HELLO", {"version": 2, "user_id": 1})))
+    client.sendall(frame(make_request("HELLO", {"version": 2, "session_token": "1.forged"})))
+    client.sendall(frame(make_request("LOGIN", {"username": "Andy", "password": "password"})))
+    client.shutdown(socket.SHUT_WR)
+    handler.handle_request()
+
+    assert read_packet(client)["body"]["data"]["user_id"] is None
+    assert read_packet(client)["body"]["data"]["user_id"] is None
+    token = read_packet(client)["body"]["data"]["session_token"]
+
+    # a later connection binds with the token alone
+    server_side, client_side = socket.socketpair()
+    other = TCPServerConnection(server_side, ("127.0.0.1", 0), MagicMock())
+    assert other.welcome({"version": 2, "session_token": token})["data"]["user_id"] == 7
+    assert other.db.authenticate_user.call_count == 0
+    client_side.close()
+
+def test_bound_user_not_added_to_login_or_register(connection):
+    handler, client = connection
+    handler.db.authenticate_user.side_effect = [(True, 7), (False, "Invalid username or password")]
+    handler.db.create_user.return_value = (True, 8)
+    client.sendall(frame(make_request("HELLO", {"version": 2, "username": "Andy", "password": "password"})))
+    client.sendall(frame(make_request("LOGIN", {"username": "Andy", "password": "WRONG"})))
+    client.sendall(frame(make_request("REGISTER", {"username": "newbie", "password": "pw"})))
+    client.shutdown(socket.SHUT_WR)
+    handler.handle_request()
+
+    assert read_packet(client)["body"]["data"]["user_id"] == 7
+    assert read_packet(client)["body"]["command"] == "LOGIN_FAILED"
+    assert read_packet(client)["body"]["data"]["user_id"] == 8
+    handler.db.authenticate_user.assert_called_with("Andy", "WRONG")
+    handler.db.create_user.assert_called_once_with("newbie", "pw", None)
+
+def test_hello_negotiates_compact_codec(connection):
+    handler, client = connection
+    handler.db.get_all_images.return_value = [{"id": i, "caption": "Rain barrel"} for i in range(5)]
+    client.sendall(make_split_request("HELLO", {"version": 2, "codecs": ["json", "compact"]}))
+    compact_request = encode_compact({"sequence_number": 2}, {"command": "GET_IMAGES", "data": {}})
+    client.sendall(join_frame(compact_request, FRAME_FLAG_COMPACT))
+    client.shutdown(socket.SHUT_WR)
+    handler.handle_request()
+
+    flags, size = FRAME_HEADER.unpack(client.recv(FRAME_HEADER.size, socket.MSG_WAITALL))
+    assert flags & FRAME_FLAG_COMPACT
+    welcome = decode_compact(client.recv(size, socket.MSG_WAITALL))
+    assert welcome["body"]["data"]["codec"] == "compact"
+    response = read_packet(client)
+    assert response["header"]["reply_to"] == 2
+    assert response["body"]["data"]["images"] == handler.db.get_all_images.return_value
+
+def test_hello_without_codecs_keeps_json(connection):
+    handler, client = connection
+    client.sendall(make_split_request("HELLO", {"version": 2}))
+    client.shutdown(socket.SHUT_WR)
+    handler.handle_request()
+
+    flags, size = FRAME_HEADER.unpack(client.recv(FRAME_HEADER.size, socket.MSG_WAITALL))
+    assert flags == FRAME_FLAG_SPLIT
+    assert decode_packet(client.recv(size, socket.MSG_WAITALL))["body"]["data"]["codec"] == "json"
+
+def test_client_handshake_on_connect():
+    server = TCPServer(host='127.0.0.1', port=0, db=MagicMock())
+    server.db.save_image_for_user.return_value = (True, None)
+    server.db.authenticate_user.return_value = (True, 4)
+    thread = threading.Thread(target=server.start, daemon=True)
+    thread.start()
+    assert wait_for(lambda: server.running)
+
+    client = TCPClient(server_host='127.0.0.1', server_port=server.port, username="Andy", password="password")
+    assert client.connect()
+    assert client.protocol_version == 2
+    assert client.capabilities == {"split_packets", "compression", "binary_payloads", "pipelining", "events"}
+    assert client.codec.name == "compact"
+
+    success, response = client.send_request("SAVE_IMAGE", {"image_id": 9})
+    assert response["body"]["command"] == "SAVE_IMAGE_SUCCESS"
+    server.db.save_image_for_user.assert_called_once_with(4, 9)
+
+    # reconnecting binds with the session token from WELCOME, the password isn't needed again
+    client.disconnect()
+    client.password = None
+    assert client.connect()
+    assert client.user_id == 4
+    server.db.authenticate_user.assert_called_once()
+
+    client.disconnect()
+    server.stop()
+    thread.join(timeout=5)
+
+#push events
+@pytest.mark.parametrize("engine", [TCPServer, AsyncTCPServer])
+def test_subscribers_get_pushed_events(engine):
+    server = engine(host='127.0.0.1', port=0, db=MagicMock())
+    server.db.add_comment.return_value = (True, 12, "Andy")
+    server.db.save_image_for_user.return_value = True
+    server.db.authenticate_user.return_value = (True, 4)
+    thread = threading.Thread(target=server.start, daemon=True)
+    thread.start()
+    assert wait_for(lambda: server.running)
+
+    events = []
+    subscriber = TCPClient(server_host='127.0.0.1', server_port=server.port, username="Andy", password="password")
+    assert subscriber.subscribe(["comments:3", "saves:4"], events.append) == (True, ["comments:3", "saves:4"])
+    assert subscriber.subscribe(["saves:5"], events.append)[0] == False
+
+    writer = TCPClient(server_host='127.0.0.1', server_port=server.port)
+    writer.send_request("ADD_COMMENT", {"image_id": 3, "text": "Nice setup", "user_id": 4})
+    writer.send_request("ADD_COMMENT", {"image_id": 8, "text": "Not followed", "user_id": 4})
+    writer.send_batch([("SAVE_IMAGE", {"image_id": 3, "user_id": 4}), ("SAVE_IMAGE", {"image_id": 8, "user_id": 6})])
+    assert wait_for(lambda: len(events) == 2)
+
+    assert events[0]["topic"] == "comments:3"
+    assert events[0]["comment"]["text"] == "Nice setup"
+    assert events[1] == {"topic": "saves:4", "event": "image_saved", "image_id": 3}
+    # the subscription is still live on the same connection as ordinary requests
+    assert subscriber.send_request("PING", {"timestamp": 1})[1]["body"]["command"] == "PONG"
+
+    writer.disconnect()
+    subscriber.disconnect()
+    assert wait_for(lambda: not server.subscriptions.subscribers)
+    server.stop()
+    thread.join(timeout=5)
+
+@pytest.mark.parametrize("engine", [TCPServer, AsyncTCPServer])
+def test_slow_subscriber_is_dropped_not_waited_on(engine):
+    server = engine(host='127.0.0.1', port=0, db=MagicMock())
+    server.db.add_comment.return_value = (True, 12, "Andy")
+    thread = threading.Thread(target=server.start, daemon=True)
+    thread.start()
+    assert wait_for(lambda: server.running)
+
+    # the callback never returns, so the subscriber stops reading its socket
+    stuck = threading.Event()
+    subscriber = TCPClient(server_host='127.0.0.1', server_port=server.port)
+    assert subscriber.subscribe(["comments:3"], lambda event: stuck.wait())[0]
+
+    writer = TCPClient(server_host='127.0.0.1', server_port=server.port)
+    text = os.urandom(8192).hex()  # doesn't compress, so the events soon fill the socket buffers
+    for i in range(800):
+        success, response = writer.send_request("ADD_COMMENT", {"image_id": 3, "text": text, "user_id": 4})
+        assert response["body"]["command"] == "ADD_COMMENT_SUCCESS", i
+    assert wait_for(lambda: not server.subscriptions.subscribers)
+
+    stuck.set()
+    writer.disconnect()
+    subscriber.disconnect()
+    server.stop()
+    thread.join(timeout=5)
+
+#threaded engine admission control
+def wait_for(condition):
+    for _ in range(200):
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+def test_threaded_server_rejects_when_full():
+    server = TCPServer(host='127.0.0.1', port=0, db=MagicMock(), max_workers=1, queue_depth=0)
+    thread = threading.Thread(target=server.start, daemon=True)
+    thread.start()
+    assert wait_for(lambda: server.running)
+
+    first = TCPClient(server_host='127.0.0.1', server_port=server.port)
+    assert first.send_request("PING", {"timestamp": 1})[0]
+
+    second = socket.create_connection(('127.0.0.1', server.port))
+    response = read_packet(second)
+    second.close()
+    assert response["body"]["command"] == "ERROR"
+    assert "busy" in response["body"]["data"]["message"]
+
+    # finished connections are pruned and free their slot
+    first.disconnect()
+    assert wait_for(lambda: len(server.clients) == 0)
+    third = TCPClient(server_host='127.0.0.1', server_port=server.port)
+    assert third.send_request("PING", {"timestamp": 1})[0]
+    third.disconnect()
+
+    server.stop()
+    thread.join(timeout=5)
+    assert not thread.is_alive()